@@ -0,0 +1,223 @@
+# %%
+""" Adaptive accuracy maps of the fix error.
+
+The chart extent is covered by a quadtree. The fix error and the label of the
+best marks (the marks chosen by the fix) are evaluated at the corners and the
+centre of each cell. A cell is split in four, down to max_level, when the error
+at its centre differs from the bilinear interpolation of its corners by more
+than tolerance + relative_tolerance * the interpolated error, or when its
+samples do not agree on the best marks and their errors spread over at least
+label_tolerance (default tolerance). The best marks change often where their
+costs are close, and a change that does not move the error by the tolerance
+does not split the cell. Open water where the error is smooth keeps large
+cells, baselines and marks get small ones. label_tolerance 0 splits on every
+change of the best marks (regions of mark_atlas).
+
+Corners are addressed by integer coordinates on the finest lattice (2**max_level
+cells per side) so that the corners shared by neighbour cells are evaluated
+once, and all the new points of a level are evaluated in one call, so a
+vectorized evaluator is used at full speed. """
+import logging
+import time
+from itertools import combinations
+import numpy as np
+import navigation as nav
+import route_planner
+from fleet import best_triples
+
+
+def model_evaluator(marks_map: nav.MarksMap, sigma: float = nav.SIGMA, number_of_marks: int = 6):
+    """ evaluator(points (N, 2)) -> expected 3 LOP fix error (N,) and label (N,) of the
+    best triple of fixed marks with the wedge area model (fleet.best_triples), vectorized.
+    The triple is scored as a whole, so the third mark of a label is a real choice and
+    does not flip between neighbour points as with the cost of the best pair only """
+    marks = np.array([mark.position for mark in marks_map.fixed_marks]).reshape(-1, 2)
+
+    def evaluate(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        distance, bearing, nearest = route_planner.mark_ranges(points, marks, number_of_marks, with_index=True)
+        costs, columns = best_triples(distance, bearing)
+        triples = np.sort(np.take_along_axis(nearest, columns, axis=1), axis=1)
+        labels = (triples[:, 0] * len(marks) + triples[:, 1]) * len(marks) + triples[:, 2]
+        return sigma * np.sqrt(costs), labels
+    return evaluate
+
+
+def fix_evaluator(mark_table: list[nav.Mark], fix_type: nav.FixType = nav.FixType.FIX_3LOP,
+                  sigma: float = nav.SIGMA):
+    """ evaluator(points (N, 2)) -> error (N,) of the headless fix of a boat at each point
+    and label (N,) of the marks selected by get_3best_marks or get_2best_marks """
+    size = 3 if fix_type == nav.FixType.FIX_3LOP else 2
+    labels = {combination: i for i, combination in enumerate(combinations(range(len(mark_table)), size))}
+    index = {id(mark): i for i, mark in enumerate(mark_table)}
+
+    def evaluate(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        errors = np.empty(len(points))
+        point_labels = np.empty(len(points), dtype=np.int64)
+        for i, point in enumerate(points):
+            boat_simu = nav.BoatSimu(point, point, sigma=sigma)
+            if size == 3:
+                marks = boat_simu.get_3best_marks(mark_table)
+                estimate = boat_simu.compute_position_3lop(*marks, show_lop=False, show_area=False)
+            else:
+                marks = boat_simu.get_2best_marks(mark_table)
+                estimate = boat_simu.compute_position_2lop(*marks, show_lop=False, show_area=False)
+            errors[i] = np.hypot(estimate[0] - point[0], estimate[1] - point[1])
+            point_labels[i] = labels[tuple(sorted(index[id(mark)] for mark in marks))]
+        return errors, point_labels
+    return evaluate
+
+
+class AccuracyMap:
+    """ quadtree of the fix error over extent (x_min, x_max, y_min, y_max),
+    evaluator(points) -> (errors, labels) as model_evaluator or fix_evaluator """
+    def __init__(self, evaluator, extent: tuple[float, float, float, float], tolerance: float,
+                 min_level: int = 2, max_level: int = 8, relative_tolerance: float = 0.0,
+                 label_tolerance: float = None):
+        self.evaluator = evaluator
+        self.extent = extent
+        self.tolerance = tolerance
+        self.relative_tolerance = relative_tolerance
+        self.label_tolerance = tolerance if label_tolerance is None else label_tolerance
+        self.min_level = min_level
+        self.max_level = max_level
+        self.side = 2 ** max_level
+        # values at the lattice points already evaluated, (i, j) -> index in errors / labels
+        self._points : dict[tuple[int, int], int] = {}
+        self.errors = np.empty(0)
+        self.labels = np.empty(0, dtype=np.int64)
+        # leaves (i, j, size) in lattice units, i along x
+        self.leaves : list[tuple[int, int, int]] = []
+        self._build()
+
+    @property
+    def evaluations(self) -> int:
+        return len(self._points)
+
+    def position(self, lattice) -> np.ndarray:
+        """ chart coordinates of lattice points (N, 2) """
+        lattice = np.asarray(lattice, dtype=float).reshape(-1, 2)
+        x_min, x_max, y_min, y_max = self.extent
+        return np.column_stack([x_min + lattice[:, 0] * (x_max - x_min) / self.side,
+                                y_min + lattice[:, 1] * (y_max - y_min) / self.side])
+
+    def _evaluate(self, lattice_points) -> None:
+        """ evaluate the lattice points not evaluated yet, in one call """
+        new = list(dict.fromkeys(point for point in lattice_points if point not in self._points))
+        if not new:
+            return
+        errors, labels = self.evaluator(self.position(new))
+        for point in new:
+            self._points[point] = len(self._points)
+        self.errors = np.concatenate([self.errors, np.asarray(errors, dtype=float)])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=np.int64)])
+
+    @staticmethod
+    def _samples(cell: tuple[int, int, int]) -> list[tuple[int, int]]:
+        """ corners then centre of a cell """
+        i, j, size = cell
+        half = size // 2
+        return [(i, j), (i + size, j), (i, j + size), (i + size, j + size), (i + half, j + half)]
+
+    def _split(self, cell: tuple[int, int, int]) -> bool:
+        if cell[2] < 2:
+            return False
+        indices = [self._points[point] for point in self._samples(cell)]
+        errors = self.errors[indices]
+        finite = np.isfinite(errors)
+        if not finite.all():
+            return bool(finite.any()) or len(set(self.labels[indices].tolist())) > 1
+        if len(set(self.labels[indices].tolist())) > 1 and errors.max() - errors.min() >= self.label_tolerance:
+            return True
+        interpolated = errors[:4].mean()
+        return abs(errors[4] - interpolated) > self.tolerance + self.relative_tolerance * abs(interpolated)
+
+    def _build(self) -> None:
+        size = self.side // 2 ** self.min_level
+        cells = [(i, j, size) for i in range(0, self.side, size) for j in range(0, self.side, size)]
+        while cells:
+            self._evaluate(point for cell in cells for point in self._samples(cell))
+            refined = []
+            for cell in cells:
+                if self._split(cell):
+                    i, j, size = cell
+                    half = size // 2
+                    refined += [(i, j, half), (i + half, j, half), (i, j + half, half), (i + half, j + half, half)]
+                else:
+                    self.leaves.append(cell)
+            cells = refined
+
+    def value(self, lattice_point: tuple[int, int]) -> float:
+        return self.errors[self._points[lattice_point]]
+
+    def to_grid(self, shape: tuple[int, int] = None) -> np.ndarray:
+        """ error on a regular grid of shape (rows along y, columns along x), the finest
+        lattice by default, bilinear interpolation of the corners of each leaf """
+        rows, columns = (self.side + 1, self.side + 1) if shape is None else shape
+        grid_x = np.linspace(0, self.side, columns)
+        grid_y = np.linspace(0, self.side, rows)
+        grid = np.full((rows, columns), np.nan)
+        for i, j, size in self.leaves:
+            column_slice = slice(np.searchsorted(grid_x, i), np.searchsorted(grid_x, i + size, 'right'))
+            row_slice = slice(np.searchsorted(grid_y, j), np.searchsorted(grid_y, j + size, 'right'))
+            u = (grid_x[column_slice] - i) / size
+            v = (grid_y[row_slice] - j) / size
+            corners = [self.value(point) for point in self._samples((i, j, size))[:4]]
+            with np.errstate(invalid='ignore'):
+                bottom = corners[0] * (1 - u) + corners[1] * u
+                top = corners[2] * (1 - u) + corners[3] * u
+                grid[row_slice, column_slice] = bottom[None, :] * (1 - v[:, None]) + top[None, :] * v[:, None]
+        return grid
+
+    def plot(self, ax=None, show_cells: bool = True):
+        """ error map with the quadtree cells """
+        plt = nav.plt
+        ax = plt.gca() if ax is None else ax
+        image = ax.imshow(self.to_grid(), origin='lower', extent=self.extent, cmap='viridis_r')
+        if show_cells:
+            x_min, x_max, y_min, y_max = self.extent
+            scale_x, scale_y = (x_max - x_min) / self.side, (y_max - y_min) / self.side
+            rectangles = [[(x_min + i * scale_x, y_min + j * scale_y), (x_min + (i + size) * scale_x, y_min + j * scale_y),
+                           (x_min + (i + size) * scale_x, y_min + (j + size) * scale_y),
+                           (x_min + i * scale_x, y_min + (j + size) * scale_y)] for i, j, size in self.leaves]
+            from matplotlib.collections import PolyCollection
+            ax.add_collection(PolyCollection(rectangles, facecolors='none', edgecolors='w', linewidths=0.2))
+        return image
+
+
+def main():
+    logging.disable(logging.WARNING)
+    plt = nav.plt
+    mark_table = [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                  nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                  nav.Mark([100.0, 100.0], 'church')]
+    marks_map = nav.MarksMap()
+    for mark in mark_table:
+        marks_map.append_mark(mark)
+    extent = (0.0, 600.0, 0.0, 600.0)
+    for name, evaluator, tolerance, max_level in (('model', model_evaluator(marks_map), 0.5, 8),
+                                                  ('fix', fix_evaluator(mark_table), 1.0, 6)):
+        start = time.perf_counter()
+        accuracy_map = AccuracyMap(evaluator, extent, tolerance, max_level=max_level)
+        elapsed = time.perf_counter() - start
+        side = accuracy_map.side + 1
+        grid_x = np.linspace(extent[0], extent[1], side)
+        grid_y = np.linspace(extent[2], extent[3], side)
+        mesh_x, mesh_y = np.meshgrid(grid_x, grid_y)
+        uniform, _ = evaluator(np.column_stack([mesh_x.ravel(), mesh_y.ravel()]))
+        difference = np.abs(accuracy_map.to_grid() - uniform.reshape(side, side))
+        print(f'{name}: {accuracy_map.evaluations} evaluations in {elapsed:.2f} s instead of {side**2} '
+              f'({100 * accuracy_map.evaluations / side**2:.1f} %), {len(accuracy_map.leaves)} cells, '
+              f'difference to the fine grid: median {np.nanmedian(difference):.3f}, '
+              f'95 % {np.nanpercentile(difference, 95):.3f}, max {np.nanmax(difference):.2f}, '
+              f'{100 * np.mean(difference[np.isfinite(difference)] <= tolerance):.1f} % within tolerance {tolerance}')
+    plt.figure(1)
+    accuracy_map.plot()
+    for mark in mark_table:
+        mark.plot_mark()
+    plt.title('adaptive fix error map')
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,159 @@
+# %%
+""" Anytime fixes: the hat estimate at once, the LOP polygone estimate later.
+
+compute_position_3lop intersects the error polygones of the LOP with shapely
+before it returns, and only falls back to the hat barycentre when the
+intersection is empty. For interactive use AnytimeFixer.fix returns the closed
+form hat barycentre (fix_service.hat_barycentre) immediately, and submits the
+polygone intersection (fix_service.solve_batch) to a thread or process executor.
+
+The returned future is resolved with the refined answer when it is ready within
+the latency budget of the call, and with the hat answer when the budget runs
+out (the refinement is then cancelled if it has not started). Answers are the
+dicts of fix_service with a 'refined' flag:
+    {'position': [x, y], 'area': a, 'method': 'lop' or 'hat', 'refined': True or False} """
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import navigation as nav
+import fix_service
+
+AnytimeFix = namedtuple('AnytimeFix', ['position', 'area', 'future'])
+AnytimeFix.__doc__ = """ hat position and area, future of the refined answer """
+
+
+def hat_answer(marks: np.ndarray, bearings: np.ndarray) -> dict:
+    """ answer of the hat barycentre of the LOP of marks (k, 2) """
+    position, area = fix_service.hat_barycentre(marks[None], bearings[None])
+    return {'position': position[0].tolist(), 'area': float(area[0]), 'method': 'hat', 'refined': False}
+
+
+class AnytimeFixer:
+    """ anytime fixes refined on executor (a ThreadPoolExecutor of one thread by
+    default), budget the default latency budget in second """
+    def __init__(self, executor=None, budget: float = 0.05):
+        self._own_executor = executor is None
+        self.executor = ThreadPoolExecutor(1) if executor is None else executor
+        self.budget = budget
+        self.refined_count = 0
+        self.expired_count = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self) -> None:
+        if self._own_executor:
+            self.executor.shutdown(cancel_futures=True)
+
+    def _settle(self, future: Future, answer: dict) -> bool:
+        """ resolve future with answer unless it is already resolved """
+        with self._lock:
+            if future.done():
+                return False
+            future.set_result(answer)
+            if answer['refined']:
+                self.refined_count += 1
+            else:
+                self.expired_count += 1
+            return True
+
+    def fix(self, marks, bearings, position=None, sigma: float = nav.SIGMA, budget: float = None) -> AnytimeFix:
+        """ anytime fix from the bearings (radian) of marks (k, 2), position the dead
+        reckoning position (default the centre of the marks) """
+        budget = self.budget if budget is None else budget
+        marks = np.asarray(marks, dtype=float).reshape(-1, 2)
+        bearings = np.asarray(bearings, dtype=float)
+        if len(marks) < 2 or len(marks) != len(bearings):
+            raise ValueError(f'{len(marks)} marks and {len(bearings)} bearings, at least 2 of each are needed')
+        hat = hat_answer(marks, bearings)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        request = {'marks': marks.tolist(), 'bearings': bearings.tolist(), 'sigma': sigma, 'method': 'lop',
+                   'position': None if position is None else list(position)}
+        refinement = self.executor.submit(fix_service.solve_batch, [request])
+        timer = threading.Timer(budget, self._expire, (future, refinement, hat))
+        timer.daemon = True
+
+        def refined(done: Future) -> None:
+            timer.cancel()
+            if done.cancelled():
+                # cancelled by _expire (already settled) or by the shutdown of the executor
+                self._settle(future, hat)
+                return
+            if done.exception() is not None:
+                logging.warning('fix refinement failed: %s', done.exception())
+                self._settle(future, hat)
+                return
+            answer = done.result()[0]
+            if 'error' in answer:
+                logging.warning('fix refinement failed: %s', answer['error'])
+                self._settle(future, hat)
+                return
+            self._settle(future, {'position': answer['position'], 'area': answer['area'],
+                                  'method': answer['method'], 'refined': True})
+        timer.start()
+        refinement.add_done_callback(refined)
+        return AnytimeFix(hat['position'], hat['area'], future)
+
+    def _expire(self, future: Future, refinement: Future, hat: dict) -> None:
+        if self._settle(future, hat):
+            refinement.cancel()
+
+    def fix_boat(self, boat_simu: nav.BoatSimu, marks: list[nav.Mark], budget: float = None) -> AnytimeFix:
+        """ anytime fix of boat_simu with the LOP of marks, as compute_position_3lop:
+        the estimated position is the hat barycentre until apply is called """
+        for mark in marks:
+            mark.compute_bearing(boat_simu.boat_true, 0)
+        fix = self.fix([mark.position for mark in marks], [mark.bearing for mark in marks],
+                       boat_simu.boat_true.position, boat_simu.sigma, budget)
+        boat_simu.fix_marks = tuple(marks)
+        boat_simu.fix_area = fix.area
+        boat_simu.boat_estimate.set_position(fix.position)
+        return fix
+
+    @staticmethod
+    def apply(boat_simu: nav.BoatSimu, fix: AnytimeFix) -> dict:
+        """ wait for the answer of fix (at most its budget) and set it as the estimated position """
+        answer = fix.future.result()
+        boat_simu.fix_area = answer['area']
+        boat_simu.boat_estimate.set_position(answer['position'])
+        return answer
+
+
+def main():
+    logging.disable(logging.WARNING)
+    mark_table = [nav.Mark([100.0, 300.0], 'church'), nav.Mark([500.0, 500.0], 'lighthouse'),
+                  nav.Mark([500.0, 100.0], 'land_tower')]
+    rng = np.random.default_rng(0)
+    boats = rng.uniform(150.0, 450.0, (200, 2))
+    for name, executor in (('thread', None), ('process', ProcessPoolExecutor(2))):
+        for budget in (0.0005, 0.05):
+            with AnytimeFixer(executor, budget) as fixer:
+                hat_latency = []
+                refined_latency = []
+                differences = []
+                for boat in boats:
+                    boat_simu = nav.BoatSimu(boat, boat)
+                    start = time.perf_counter()
+                    fix = fixer.fix_boat(boat_simu, mark_table)
+                    hat_latency.append(time.perf_counter() - start)
+                    answer = fixer.apply(boat_simu, fix)
+                    refined_latency.append(time.perf_counter() - start)
+                    differences.append(np.hypot(*np.subtract(answer['position'], fix.position)))
+                print(f'{name:7s} budget {budget * 1000:5.1f} ms: hat {np.median(hat_latency) * 1000:.2f} ms, '
+                      f'answer {np.median(refined_latency) * 1000:.2f} ms, {fixer.refined_count} refined, '
+                      f'{fixer.expired_count} expired, mean refinement {np.mean(differences):.2f}')
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,150 @@
+# %%
+""" Batch rendering of fix figures in worker processes.
+
+A FigureSpec describes one figure like the ones of test_navigation.py and
+test_running_fix.py: marks, boats, fix method, optional chart image and extent.
+render_figures sends the specs to a process pool whose workers use the Agg
+backend. Each worker keeps its own caches: the marker Paths built by BuildPath
+(the same symbols are built again for every mark of every figure otherwise) and
+the memory maps of the decoded chart images of chart_store, so the workers share
+the pages of a chart image and none of them decodes it. """
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+import numpy as np
+import navigation as nav
+import chart_store
+
+FigureSpec = namedtuple('FigureSpec', ['file_name', 'marks', 'boats', 'fix_type', 'sigma', 'chart_image',
+                                       'extent', 'title', 'course', 'speed', 'fix_period', 'steps',
+                                       'figsize', 'dpi'],
+                        defaults=[nav.FixType.FIX_3LOP, nav.SIGMA, None, None, None, 0.0, 100.0,
+                                  nav.FIX_PERIOD, 8, (8, 6), 100])
+FigureSpec.__doc__ = """ one figure: marks (list of Mark), boats (list of true positions or of
+(true, estimate) positions), fix_type, sigma (radian), chart_image (file) shown on
+extent (x_min, x_max, y_min, y_max). FIX_RUNNING figures run steps fixes of
+fix_period at course and speed from each boat """
+
+def cache_marker_paths() -> None:
+    """ memoize the BuildPath constructors, the Paths are never modified in place """
+    build_path = nav.marker.BuildPath
+    for name, value in vars(build_path).copy().items():
+        if isinstance(value, staticmethod) and not hasattr(value.__func__, 'cache_info'):
+            setattr(build_path, name, staticmethod(functools.lru_cache(maxsize=None)(value.__func__)))
+
+
+def chart_image(file_name: str) -> np.ndarray:
+    """ decoded chart image, memory mapped from the chart_store cache """
+    return chart_store.chart_image(file_name)
+
+
+def _init_worker() -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+    logging.disable(logging.WARNING)
+    cache_marker_paths()
+
+
+def _boat_simu(boat, spec: FigureSpec) -> nav.BoatSimu:
+    boat = np.asarray(boat, dtype=float)
+    true, estimate = (boat[0], boat[1]) if boat.shape == (2, 2) else (boat, boat)
+    return nav.BoatSimu(true, estimate, sigma=spec.sigma, fix_period=spec.fix_period)
+
+
+def _draw_fix(spec: FigureSpec, boat_simu: nav.BoatSimu, fixed_marks: list[nav.Mark]) -> None:
+    match spec.fix_type:
+        case nav.FixType.FIX_3LOP:
+            marks = boat_simu.get_3best_marks(fixed_marks) if len(fixed_marks) > 3 else fixed_marks
+            boat_simu.compute_position_3lop(*marks[:3], show_lop=True)
+        case nav.FixType.FIX_2LOP:
+            marks = boat_simu.get_2best_marks(fixed_marks) if len(fixed_marks) > 2 else fixed_marks
+            boat_simu.compute_position_2lop(*marks[:2], show_lop=True)
+        case nav.FixType.FIX_RUNNING:
+            for boat in (boat_simu.boat_true, boat_simu.boat_estimate):
+                boat.ground_track.course = boat.water_track.course = spec.course
+                boat.ground_track.speed = spec.speed
+            boat_simu.boat_true.ground_track.plot_track()
+            for _ in range(spec.steps):
+                best_mark = boat_simu.get_1best_mark(fixed_marks)
+                boat_simu.run_fix(best_mark, spec.fix_period, spec.sigma, True)
+                boat_simu.plot_boat()
+    boat_simu.plot_boat()
+
+
+def render(spec: FigureSpec) -> str:
+    """ draw spec with matplotlib and save it to spec.file_name """
+    plt = nav.plt
+    figure = plt.figure(figsize=spec.figsize)
+    try:
+        if spec.chart_image is not None:
+            plt.imshow(chart_image(spec.chart_image), origin='upper', extent=spec.extent)
+        for mark in spec.marks:
+            mark.plot_mark()
+        fixed_marks = [mark for mark in spec.marks if mark.category & nav.mark_types.MarkCategory.LANDMARK]
+        for boat in spec.boats:
+            boat_simu = _boat_simu(boat, spec)
+            for mark in fixed_marks:
+                mark.compute_bearing(boat_simu.boat_true, spec.sigma)
+            _draw_fix(spec, boat_simu, fixed_marks)
+        if spec.extent is not None:
+            plt.xlim(spec.extent[0], spec.extent[1])
+            plt.ylim(spec.extent[2], spec.extent[3])
+        if spec.title is not None:
+            plt.title(spec.title)
+        figure.savefig(spec.file_name, dpi=spec.dpi)
+    finally:
+        plt.close(figure)
+    return spec.file_name
+
+
+def render_figures(specs: list[FigureSpec], processes: int = None, chunksize: int = 1) -> list[str]:
+    """ render the figures of specs in processes workers (processes=1 renders in
+    the calling process, on the current backend), return the written files in the
+    order of specs """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(specs)))
+    for directory in {os.path.dirname(spec.file_name) for spec in specs}:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    for file_name in {spec.chart_image for spec in specs if spec.chart_image is not None}:
+        # decoded once here, the workers only map the cache
+        chart_store.chart_image(file_name)
+    if processes == 1:
+        return [render(spec) for spec in specs]
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        return pool.map(render, specs, chunksize)
+
+
+def main():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    layouts = [[nav.Mark([100.0, 300.0], 'church'), nav.Mark([500.0, 500.0], 'lighthouse'),
+                nav.Mark([500.0, 100.0], 'land_tower')],
+               [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                nav.Mark([100.0, 100.0], 'church'), nav.Mark([200.0, 100.0], 'pillar', 'green')]]
+    boats = [[i, j] for i in range(150, 500, 100) for j in range(150, 500, 100)]
+    specs = []
+    for number, (layout, sigma, fix_type) in enumerate(
+            (layout, sigma, fix_type) for layout in layouts for sigma in (np.pi/180, np.pi/90, np.pi/45)
+            for fix_type in (nav.FixType.FIX_3LOP, nav.FixType.FIX_2LOP)):
+        specs.append(FigureSpec(os.path.join(directory, f'figure_{number}.png'), layout, boats, fix_type, sigma,
+                                title=f'{fix_type.name} sigma {np.degrees(sigma):.0f} degree'))
+    timings = {}
+    for processes in sorted({1, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        if processes == 1:
+            _init_worker()
+        render_figures(specs, processes)
+        timings[processes] = time.perf_counter() - start
+        print(f'{processes:3d} processes: {len(specs)} figures in {timings[processes]:.2f} s, '
+              f'speedup x{timings[1]/timings[processes]:.1f}')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,45 @@
+""" Import time benchmark of the navigation core.
+
+Each import is timed in a fresh interpreter. 'navigation' only loads numpy,
+'navigation + plot libraries' forces the libraries that navigation used to import
+eagerly (matplotlib.pyplot, pandas, shapely, nautical_marker).
+usage: python bench_import.py [repeat] """
+import statistics
+import subprocess
+import sys
+import os
+
+STATEMENTS = {
+    'numpy': 'import numpy',
+    'navigation': 'import navigation',
+    'navigation + plot libraries': ('import navigation, matplotlib.pyplot, matplotlib.transforms, '
+                                    'pandas, shapely, nautical_marker'),
+}
+
+
+def time_import(statement: str, repeat: int) -> list[float]:
+    """ wall time of statement measured in a new interpreter, repeat times """
+    code = ('import time; start = time.perf_counter(); ' + statement +
+            '; print(time.perf_counter() - start)')
+    env = dict(os.environ, MPLBACKEND='Agg')
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), env=env, check=True)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    medians = {}
+    for name, statement in STATEMENTS.items():
+        medians[name] = statistics.median(time_import(statement, repeat))
+        print(f'{name:<30} {medians[name]*1000:8.1f} ms')
+    speedup = medians['navigation + plot libraries'] / medians['navigation']
+    print(f'lazy import speedup: x{speedup:.1f}')
+
+
+if __name__ == "__main__":
+
+    main()
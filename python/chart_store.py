@@ -0,0 +1,219 @@
+# %%
+""" Decoded chart images shared through memory mapped files.
+
+plt.imread decodes a PNG / JPG chart completely in every process that shows it.
+ChartStore decodes each file once into a raw .npy array in a cache directory
+(map/.chart_cache by default), named after the SHA-1 of the file contents, with a
+small JSON file holding the shape, the dtype, the source file and the extent of
+the chart. Later runs and the worker processes open the .npy file with
+np.load(mmap_mode='r'): the pages of the image are read on demand from the page
+cache of the system and shared by all the processes, there is no decode and no
+private copy.
+
+The cache files are written under a temporary name and renamed, so processes
+decoding the same chart at the same time never read a partial file. """
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+import numpy as np
+
+MAP_DIRECTORY : str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'map')
+CACHE_NAME : str = '.chart_cache'
+CACHE_VERSION : int = 1
+
+ChartImage = namedtuple('ChartImage', ['image', 'extent', 'file_name'])
+ChartImage.__doc__ = """ image: read only memory mapped array (rows, columns[, channels]),
+extent: (x_min, x_max, y_min, y_max) or None, file_name: the source chart """
+
+
+def file_hash(file_name: str) -> str:
+    """ hash of the contents of the chart file, the key of its cache entry """
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    with open(file_name, 'rb') as chart:
+        for block in iter(lambda: chart.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chart_files(directory: str = MAP_DIRECTORY) -> list[str]:
+    """ sorted list of the png and jpg files of the directory """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(('.png', '.jpg', '.jpeg')))
+
+
+def _replace(write, path: str) -> None:
+    """ write(temporary path) then rename it to path """
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class ChartStore:
+    """ cache of the decoded charts in cache_directory """
+    def __init__(self, cache_directory: str = None):
+        self.cache_directory = os.path.join(MAP_DIRECTORY, CACHE_NAME) if cache_directory is None else cache_directory
+        # file name -> (size, modification time, hash), files are hashed once per process
+        self._hashes : dict[str, tuple[int, float, str]] = {}
+        self._images : dict[str, np.ndarray] = {}
+        self.decode_count = 0
+
+    def key(self, file_name: str) -> str:
+        file_name = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        known = self._hashes.get(file_name)
+        if known is None or known[:2] != (stat.st_size, stat.st_mtime):
+            known = (stat.st_size, stat.st_mtime, file_hash(file_name))
+            self._hashes[file_name] = known
+        return known[2]
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.cache_directory, f'{key}.npy'), os.path.join(self.cache_directory, f'{key}.json')
+
+    def metadata(self, file_name: str) -> dict | None:
+        """ shape, dtype, source and extent of the cached chart, None when not cached """
+        try:
+            with open(self._paths(self.key(file_name))[1]) as metadata:
+                return json.load(metadata)
+        except (OSError, ValueError):
+            return None
+
+    def _write_metadata(self, key: str, metadata: dict) -> None:
+        def write(path):
+            with open(path, 'w') as file:
+                json.dump(metadata, file)
+        _replace(write, self._paths(key)[1])
+
+    def _decode(self, file_name: str, key: str) -> dict:
+        import matplotlib.pyplot as plt
+        image = plt.imread(file_name)
+        self.decode_count += 1
+        array_path, _ = self._paths(key)
+        os.makedirs(self.cache_directory, exist_ok=True)
+        def write(path):
+            with open(path, 'wb') as file:
+                np.save(file, image)
+        _replace(write, array_path)
+        previous = self.metadata(file_name) or {}
+        metadata = {'source': os.path.basename(file_name), 'shape': list(image.shape), 'dtype': image.dtype.str,
+                    'extent': previous.get('extent')}
+        self._write_metadata(key, metadata)
+        return metadata
+
+    def image(self, file_name: str) -> np.ndarray:
+        """ read only memory map of the decoded chart, decoded and cached when needed """
+        key = self.key(file_name)
+        if key in self._images:
+            return self._images[key]
+        array_path, _ = self._paths(key)
+        try:
+            image = np.load(array_path, mmap_mode='r')
+        except (OSError, ValueError):
+            logging.info('decoding chart %s into %s', file_name, self.cache_directory)
+            try:
+                self._decode(file_name, key)
+                image = np.load(array_path, mmap_mode='r')
+            except OSError as error:
+                logging.warning('chart cache %s not written: %s', self.cache_directory, error)
+                import matplotlib.pyplot as plt
+                image = plt.imread(file_name)
+        self._images[key] = image
+        return image
+
+    def set_extent(self, file_name: str, extent: tuple[float, float, float, float]) -> None:
+        """ record the extent (x_min, x_max, y_min, y_max) of the chart with its cache entry """
+        self.image(file_name)
+        metadata = self.metadata(file_name)
+        if metadata is None:
+            return
+        metadata['extent'] = [float(value) for value in extent]
+        self._write_metadata(self.key(file_name), metadata)
+
+    def chart(self, file_name: str, extent: tuple[float, float, float, float] = None) -> ChartImage:
+        """ memory mapped image and extent of the chart, extent is recorded when given """
+        if extent is not None:
+            self.set_extent(file_name, extent)
+        image = self.image(file_name)
+        metadata = self.metadata(file_name) or {}
+        saved_extent = metadata.get('extent')
+        return ChartImage(image, tuple(saved_extent) if saved_extent is not None else None, file_name)
+
+    def decode_all(self, directory: str = MAP_DIRECTORY) -> list[str]:
+        """ fill the cache with every chart of directory, e.g. before starting workers """
+        files = chart_files(directory)
+        for file_name in files:
+            self.image(file_name)
+        return files
+
+    def clear(self) -> None:
+        """ drop the cache files and the maps of this process """
+        self._images.clear()
+        if os.path.isdir(self.cache_directory):
+            for name in os.listdir(self.cache_directory):
+                if name.endswith(('.npy', '.json')):
+                    os.remove(os.path.join(self.cache_directory, name))
+
+
+_default_store = None
+
+
+def default_store() -> ChartStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = ChartStore()
+    return _default_store
+
+
+def chart_image(file_name: str) -> np.ndarray:
+    """ drop in replacement of plt.imread for chart images, memory mapped """
+    return default_store().image(file_name)
+
+
+def _touch_pages(file_name: str) -> float:
+    """ sum of a memory mapped chart, run in a worker """
+    return float(np.asarray(chart_image(file_name), dtype=float).sum())
+
+
+def main():
+    import multiprocessing
+    import matplotlib.pyplot as plt
+    import tempfile
+    files = chart_files()
+    if not files:
+        print(f'no chart in {MAP_DIRECTORY}')
+        return
+    store = ChartStore(tempfile.mkdtemp())
+    start = time.perf_counter()
+    for file_name in files:
+        plt.imread(file_name)
+    decoded = time.perf_counter() - start
+    start = time.perf_counter()
+    store.decode_all()
+    first = time.perf_counter() - start
+    store = ChartStore(store.cache_directory)
+    start = time.perf_counter()
+    images = [store.image(file_name) for file_name in files]
+    mapped = time.perf_counter() - start
+    size = sum(image.nbytes for image in images)
+    print(f'{len(files)} charts ({size / 1e6:.1f} MB decoded): imread {decoded:.3f} s, '
+          f'first cache fill {first:.3f} s, memory map {mapped * 1000:.2f} ms')
+    store.set_extent(files[0], (0.0, 600.0, 0.0, 400.0))
+    print(f'{os.path.basename(files[0])}: {store.chart(files[0]).extent}, {store.metadata(files[0])["shape"]}')
+    global _default_store
+    _default_store = store
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        sums = pool.map(_touch_pages, files * 4)
+    print(f'{len(sums)} worker reads, same pixels: {np.allclose(sums[:len(files)], sums[len(files):2 * len(files)])}')
+
+
+if __name__ == "__main__":
+
+    main()
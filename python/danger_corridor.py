@@ -0,0 +1,176 @@
+# %%
+""" Dangers along planned legs.
+
+DangerIndex keeps the positions of the danger marks of a MarksMap (the
+DANGERS_SET types: wrecks, rocks, danger) sorted by x. A corridor query is a
+bounding box prefilter (binary search on x, then a mask on y) followed by an
+exact vectorized distance to segment check. Whole routes are answered in one
+call by expanding all the (leg, candidate) pairs at once.
+
+DangerCorridor follows a boat along its current leg: the candidates of the leg
+are selected once by start_leg, then each step only checks the distance of
+these few marks to the remaining part of the leg, from the boat to the end of
+the leg. The points of this segment are at most d from the leg, d the distance
+of the boat to the leg, so the dangers closer than clearance to it are within
+clearance + d of the leg: the candidates are selected again with a wider margin
+when the boat drifts farther than the margin allows. """
+import logging
+import numpy as np
+import navigation as nav
+import mark_types
+
+
+def segment_distances(points: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """ distances of the points (N, 2) to the segments starts-ends (N, 2) (pairwise) """
+    segment = ends - starts
+    offset = points - starts
+    length_2 = np.einsum('ij,ij->i', segment, segment)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        along = np.where(length_2 > 0, np.einsum('ij,ij->i', offset, segment) / length_2, 0.0)
+    along = np.clip(along, 0.0, 1.0)
+    return np.hypot(*(offset - along[:, None] * segment).T)
+
+
+def cross_track(position, start, end) -> float:
+    """ signed distance of position to the line start-end, positive on starboard """
+    segment = np.subtract(end, start)
+    offset = np.subtract(position, start)
+    length = np.hypot(*segment)
+    if length == 0:
+        return float(np.hypot(*offset))
+    return float((offset[0] * segment[1] - offset[1] * segment[0]) / length)
+
+
+class DangerIndex:
+    """ danger marks of a MarksMap sorted by x for corridor queries """
+    def __init__(self, marks_map: nav.MarksMap):
+        marks = [mark for mark in marks_map.map_marks if mark.category & mark_types.MarkCategory.DANGER]
+        positions = np.array([mark.position for mark in marks], dtype=float).reshape(-1, 2)
+        order = np.argsort(positions[:, 0], kind='stable')
+        self.marks : list[nav.Mark] = [marks[i] for i in order]
+        self.positions = positions[order]
+
+    def __len__(self) -> int:
+        return len(self.marks)
+
+    def query(self, starts, ends, clearance: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ dangers closer than clearance to the legs starts-ends (L, 2):
+        return leg indices, mark indices (in self.marks) and distances, sorted by leg """
+        starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+        ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+        # bounding box prefilter: x range by binary search
+        low = np.searchsorted(self.positions[:, 0], np.minimum(starts[:, 0], ends[:, 0]) - clearance, 'left')
+        high = np.searchsorted(self.positions[:, 0], np.maximum(starts[:, 0], ends[:, 0]) + clearance, 'right')
+        counts = high - low
+        legs = np.repeat(np.arange(len(starts)), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = np.arange(counts.sum()) - first + np.repeat(low, counts)
+        # then y range
+        candidate_y = self.positions[candidates, 1]
+        inside = ((candidate_y >= np.minimum(starts[legs, 1], ends[legs, 1]) - clearance) &
+                  (candidate_y <= np.maximum(starts[legs, 1], ends[legs, 1]) + clearance))
+        legs, candidates = legs[inside], candidates[inside]
+        # exact distance to the legs
+        distances = segment_distances(self.positions[candidates], starts[legs], ends[legs])
+        close = distances < clearance
+        return legs[close], candidates[close], distances[close]
+
+    def leg_dangers(self, start, end, clearance: float) -> list[nav.Mark]:
+        """ danger marks closer than clearance to the leg start-end, nearest first """
+        _, indices, distances = self.query(start, end, clearance)
+        return [self.marks[i] for i in indices[np.argsort(distances, kind='stable')]]
+
+    def route_dangers(self, route: nav.Route | np.ndarray, clearance: float) -> list[list[nav.Mark]]:
+        """ danger marks closer than clearance to each leg of route (a Route or an
+        (N, 2) array of waypoints), in one query """
+        if isinstance(route, nav.Route):
+            route = [waypoint.position for waypoint in route.route]
+        waypoints = np.asarray(route, dtype=float).reshape(-1, 2)
+        dangers = [[] for _ in range(max(len(waypoints) - 1, 0))]
+        if len(waypoints) < 2:
+            return dangers
+        legs, indices, _ = self.query(waypoints[:-1], waypoints[1:], clearance)
+        for leg, index in zip(legs.tolist(), indices.tolist()):
+            dangers[leg].append(self.marks[index])
+        return dangers
+
+
+class DangerCorridor:
+    """ incremental danger check of a boat along its current leg, see
+    BoatSimu.go_to_waypoint """
+    def __init__(self, index: DangerIndex, clearance: float):
+        self.index = index
+        self.clearance = clearance
+        self.start = None
+        self.end = None
+        self._candidates = np.empty(0, dtype=np.int64)
+        self._margin = 0.0
+        self._warned : set[int] = set()
+
+    def _select(self, margin: float) -> None:
+        """ candidates within margin of the leg """
+        _, self._candidates, _ = self.index.query(self.start, self.end, margin)
+        self._margin = margin
+
+    def start_leg(self, start, end) -> list[nav.Mark]:
+        """ select the candidates of the leg start-end and return its dangers """
+        self.start = np.array(start, dtype=float)
+        self.end = np.array(end, dtype=float)
+        # candidates within clearance of the leg plus a margin for the cross track error
+        self._select(2 * self.clearance)
+        self._warned = set()
+        dangers = self.index.leg_dangers(self.start, self.end, self.clearance)
+        for mark in dangers:
+            logging.warning('%s at %s within %s of the leg %s -> %s', mark.mark_type, tuple(mark.position),
+                            self.clearance, self.start.tolist(), self.end.tolist())
+        return dangers
+
+    def check(self, position) -> tuple[float, list[nav.Mark]]:
+        """ cross track error of position and dangers closer than clearance to the
+        remaining part of the leg, from position to the end of the leg """
+        error = cross_track(position, self.start, self.end)
+        position = np.asarray(position, dtype=float)
+        drift = float(segment_distances(position[None], self.start[None], self.end[None])[0])
+        if self.clearance + drift > self._margin:
+            # the boat left the corridor of the candidates, twice its distance keeps some room
+            self._select(self.clearance + 2 * drift)
+        if len(self._candidates) == 0:
+            return error, []
+        points = self.index.positions[self._candidates]
+        remaining = np.broadcast_to(position, points.shape)
+        distances = segment_distances(points, remaining, np.broadcast_to(self.end, points.shape))
+        close = self._candidates[distances < self.clearance]
+        return error, [self.index.marks[i] for i in close]
+
+    def watch(self, boat: nav.Boat) -> list[nav.Mark]:
+        """ check from the position of boat, log the dangers not reported yet on this leg """
+        error, dangers = self.check(boat.position)
+        new = [mark for mark in dangers if id(mark) not in self._warned]
+        for mark in new:
+            self._warned.add(id(mark))
+            logging.warning('%s at %s within %s of the remaining leg, cross track error %.1f',
+                            mark.mark_type, tuple(mark.position), self.clearance, error)
+        return new
+
+
+def main():
+    import time
+    rng = np.random.default_rng(0)
+    marks_map = nav.MarksMap()
+    for position in rng.uniform(0, 10_000, (100_000, 2)):
+        marks_map.append_mark(nav.Mark(position, 'rock_covers'))
+    index = DangerIndex(marks_map)
+    waypoints = np.cumsum(rng.normal(0, 200, (1_000, 2)), axis=0) + 5_000
+    start = time.perf_counter()
+    dangers = index.route_dangers(waypoints, clearance=20.0)
+    elapsed = time.perf_counter() - start
+    brute_force = sum(int(np.sum(segment_distances(index.positions, np.broadcast_to(first, index.positions.shape),
+                                                   np.broadcast_to(second, index.positions.shape)) < 20.0))
+                      for first, second in zip(waypoints[:-1], waypoints[1:]))
+    print(f'{len(index)} dangers, {len(waypoints) - 1} legs: {sum(map(len, dangers))} dangers found '
+          f'in {elapsed*1000:.1f} ms (brute force {brute_force})')
+
+
+if __name__ == "__main__":
+
+    main()
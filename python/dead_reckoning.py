@@ -0,0 +1,225 @@
+# %%
+""" Closed form propagation of the dead reckoning error along a route.
+
+The ground velocity is the water velocity (speed through water, course steered)
+plus the tide velocity. Each of the four values has an error of standard
+deviation given by an Uncertainty. For a velocity s (sin c, cos c) the Jacobian
+with respect to (s, c) is
+
+    J = [[sin c,  s cos c],
+         [cos c, -s sin c]]
+
+so the covariance of the ground velocity is the sum of J diag(sd_s**2, sd_c**2) J^T
+of the water and the tide velocities. The errors are Gauss-Markov processes of
+correlation time tau: the position error after integrating a velocity error of
+covariance V over two intervals has covariance V times the double integral of
+exp(-|t - t'| / tau), in closed form (correlation_integral). tau = inf is a bias
+constant over the whole route (the variance grows as t**2), a small tau a
+random walk (it grows as 2 tau t).
+
+Every function broadcasts over the leading axes, so all the legs of a Route
+and all the scenarios (water speed, tide, uncertainties) are computed in one
+call without Monte Carlo runs. max_fix_interval gives the longest interval
+between fixes keeping the error within a bound. """
+import math
+import time
+from collections import namedtuple
+import numpy as np
+import navigation as nav
+import route_planner
+
+Uncertainty = namedtuple('Uncertainty', ['water_speed', 'water_course', 'tide_speed', 'tide_course'],
+                         defaults=[0.1, np.radians(3), 0.2, np.radians(15)])
+Uncertainty.__doc__ = """ standard deviations of the speed through water, of the course steered
+(radian), of the tide speed and of the tide course (radian) """
+
+
+def velocity_jacobian(speed, course) -> np.ndarray:
+    """ (..., 2, 2) derivatives of speed (sin course, cos course) with respect to (speed, course) """
+    speed, course = np.broadcast_arrays(np.asarray(speed, dtype=float), np.asarray(course, dtype=float))
+    sin, cos = np.sin(course), np.cos(course)
+    return np.stack([np.stack([sin, speed * cos], axis=-1), np.stack([cos, -speed * sin], axis=-1)], axis=-2)
+
+
+def velocity_covariance(water_speed, water_course, tide_speed, tide_course,
+                        uncertainty: Uncertainty = Uncertainty()) -> np.ndarray:
+    """ (..., 2, 2) covariance of the ground velocity """
+    covariance = 0.0
+    for speed, course, speed_sd, course_sd in ((water_speed, water_course, uncertainty.water_speed, uncertainty.water_course),
+                                               (tide_speed, tide_course, uncertainty.tide_speed, uncertainty.tide_course)):
+        jacobian = velocity_jacobian(speed, course)
+        variances = np.stack(np.broadcast_arrays(np.square(speed_sd), np.square(course_sd)), axis=-1)
+        covariance = covariance + (jacobian * variances[..., None, :]) @ np.swapaxes(jacobian, -1, -2)
+    return covariance
+
+
+def track_velocity_covariance(boat: nav.Boat, uncertainty: Uncertainty = Uncertainty()) -> np.ndarray:
+    """ (2, 2) covariance of the ground velocity of boat from its water_track and tide_track """
+    return velocity_covariance(boat.water_track.speed, boat.water_track.course, boat.tide_track.speed,
+                               boat.tide_track.course, uncertainty)
+
+
+def correlation_integral(start1, end1, start2, end2, correlation_time=np.inf) -> np.ndarray:
+    """ integral of exp(-|t - t'| / correlation_time) for t in [start1, end1] and t' in
+    [start2, end2], for identical or disjoint intervals """
+    start1, end1, start2, end2, tau = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in
+                                                            (start1, end1, start2, end2, correlation_time)))
+    constant = (end1 - start1) * (end2 - start2)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        length = end1 - start1
+        same = 2 * tau * (length - tau * -np.expm1(-length / tau))
+        first, second = np.where(end1 <= start2, start1, start2), np.where(end1 <= start2, start2, start1)
+        first_end, second_end = np.where(end1 <= start2, end1, end2), np.where(end1 <= start2, end2, end1)
+        disjoint = tau ** 2 * (np.exp(-(second - first_end) / tau) - np.exp(-(second - first) / tau)
+                               - np.exp(-(second_end - first_end) / tau) + np.exp(-(second_end - first) / tau))
+    identical = (start1 == start2) & (end1 == end2)
+    return np.where(np.isinf(tau), constant, np.where(identical, same, disjoint))
+
+
+def route_legs(route: nav.Route) -> tuple[np.ndarray, np.ndarray]:
+    """ (L,) lengths and ground courses of the legs of route """
+    positions = np.array([waypoint.position for waypoint in route.route], dtype=float).reshape(-1, 2)
+    vectors = np.diff(positions, axis=0)
+    return np.hypot(vectors[:, 0], vectors[:, 1]), np.arctan2(vectors[:, 0], vectors[:, 1])
+
+
+def leg_velocities(courses, water_speed, tide_course, tide_speed) -> tuple[np.ndarray, np.ndarray]:
+    """ ground speed and water course (the course to steer) along the ground courses,
+    broadcast, ground speed 0 where the tide can not be stemmed """
+    ground_speed = route_planner.ground_speeds(water_speed, tide_course, tide_speed, courses)
+    water_x = ground_speed * np.sin(courses) - tide_speed * np.sin(tide_course)
+    water_y = ground_speed * np.cos(courses) - tide_speed * np.cos(tide_course)
+    return ground_speed, np.arctan2(water_x, water_y)
+
+
+def route_covariances(route: nav.Route, water_speed, tide_course=0.0, tide_speed=0.0,
+                      uncertainty: Uncertainty = Uncertainty(), correlation_time=np.inf,
+                      initial=None) -> tuple[np.ndarray, np.ndarray]:
+    """ (..., L, 2, 2) covariances of the position at the end of each leg without any
+    fix, and (..., L) arrival times. water_speed, tide_course, tide_speed and the
+    fields of uncertainty broadcast with shape (..., 1) for scenarios, initial the
+    covariance at the start """
+    lengths, courses = route_legs(route)
+    water_speed, tide_course, tide_speed = (np.asarray(value, dtype=float)[..., None] if np.ndim(value) else value
+                                            for value in (water_speed, tide_course, tide_speed))
+    ground_speed, water_course = leg_velocities(courses, water_speed, tide_course, tide_speed)
+    with np.errstate(divide='ignore'):
+        durations = np.where(ground_speed > 0, lengths / np.where(ground_speed > 0, ground_speed, 1.0), np.inf)
+    uncertainty = Uncertainty(*(np.asarray(value, dtype=float)[..., None] if np.ndim(value) else value
+                                for value in uncertainty))
+    jacobians = []
+    variances = []
+    for speed, course, speed_sd, course_sd in ((water_speed, water_course, uncertainty.water_speed, uncertainty.water_course),
+                                               (tide_speed, tide_course, uncertainty.tide_speed, uncertainty.tide_course)):
+        speed, course, _ = np.broadcast_arrays(speed, course, durations)
+        jacobians.append(velocity_jacobian(speed, course))
+        variances.append(np.stack(np.broadcast_arrays(np.square(speed_sd), np.square(course_sd)), axis=-1))
+    arrivals = np.cumsum(durations, axis=-1)
+    starts = arrivals - durations
+    # (..., L, L) correlation of the errors of leg i and leg j
+    weights = correlation_integral(starts[..., :, None], arrivals[..., :, None], starts[..., None, :],
+                                   arrivals[..., None, :], np.asarray(correlation_time, dtype=float)[..., None, None]
+                                   if np.ndim(correlation_time) else correlation_time)
+    # position error at the end of leg k: sum over i, j <= k of J_i diag J_j^T w_ij
+    legs = len(lengths)
+    covariance = 0.0
+    for jacobian, variance in zip(jacobians, variances):
+        scaled = jacobian * variance[..., None, :]
+        # (..., L, L, 2, 2) cross terms J_i diag J_j^T
+        cross = scaled[..., :, None, :, :] @ np.swapaxes(jacobian, -1, -2)[..., None, :, :, :]
+        cross = cross * weights[..., None, None]
+        # cumulative sums over i <= k and j <= k
+        cumulative = np.cumsum(np.cumsum(cross, axis=-4), axis=-3)
+        index = np.arange(legs)
+        covariance = covariance + cumulative[..., index, index, :, :]
+    if initial is not None:
+        covariance = covariance + np.asarray(initial, dtype=float)
+    return covariance, arrivals
+
+
+def fix_period_covariance(fix_period, velocity_cov, correlation_time=np.inf, fix_covariance=None) -> np.ndarray:
+    """ (..., 2, 2) covariance fix_period after a fix of covariance fix_covariance,
+    at a constant velocity of covariance velocity_cov """
+    fix_period = np.asarray(fix_period, dtype=float)
+    factor = correlation_integral(0.0, fix_period, 0.0, fix_period, correlation_time)
+    covariance = np.asarray(velocity_cov, dtype=float) * factor[..., None, None]
+    if fix_covariance is not None:
+        covariance = covariance + np.asarray(fix_covariance, dtype=float)
+    return covariance
+
+
+def max_fix_interval(velocity_cov, max_error: float, confidence: float = 2.0, correlation_time=np.inf,
+                     fix_error: float = 0.0, iterations: int = 60) -> np.ndarray:
+    """ (...) longest fix period such that confidence times the standard deviation of
+    the position error along its worst direction stays below max_error, after a fix of
+    isotropic standard deviation fix_error. 0 when max_error is already exceeded """
+    eigenvalues = np.linalg.eigvalsh(np.asarray(velocity_cov, dtype=float))[..., -1]
+    budget = (max_error / confidence) ** 2 - fix_error ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        target = np.where(budget > 0, budget / eigenvalues, 0.0)
+    target, tau = np.broadcast_arrays(target, np.asarray(correlation_time, dtype=float))
+    # bias: t**2 = target, the correlation integral is below t**2 so this is a lower bound
+    low = np.sqrt(target)
+    high = np.where(np.isinf(tau), low, np.maximum(low, target / (2 * np.where(np.isinf(tau), 1.0, tau)) + tau))
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        below = correlation_integral(0.0, middle, 0.0, middle, tau) <= target
+        low = np.where(below, middle, low)
+        high = np.where(below, high, middle)
+    return low
+
+
+def monte_carlo_route(route: nav.Route, water_speed: float, tide_course: float, tide_speed: float,
+                      uncertainty: Uncertainty, samples: int, rng: np.random.Generator) -> np.ndarray:
+    """ (L, 2, 2) sample covariances of the end of each leg with errors constant over
+    the route, to check route_covariances with correlation_time inf """
+    lengths, courses = route_legs(route)
+    ground_speed, water_course = leg_velocities(courses, water_speed, tide_course, tide_speed)
+    durations = lengths / ground_speed
+    errors = rng.normal(size=(samples, 4)) * np.array(uncertainty)
+    water = ((water_speed + errors[:, :1])[..., None] * np.stack([np.sin(water_course + errors[:, 1:2]),
+                                                      np.cos(water_course + errors[:, 1:2])], axis=-1))
+    tide = ((tide_speed + errors[:, 2:3])[..., None] * np.stack([np.sin(tide_course + errors[:, 3:4]),
+                                                     np.cos(tide_course + errors[:, 3:4])], axis=-1))
+    nominal = ground_speed[:, None] * np.column_stack([np.sin(courses), np.cos(courses)])
+    displacement = np.cumsum((water + tide - nominal) * durations[None, :, None], axis=1)
+    centred = displacement - displacement.mean(axis=0)
+    return np.einsum('sli,slj->lij', centred, centred) / (samples - 1)
+
+
+def main():
+    route = nav.Route()
+    for position in ([150.0, 150.0], [450.0, 200.0], [450.0, 450.0], [150.0, 400.0], [150.0, 150.0]):
+        route.append_waypoint(nav.Waypoint(position))
+    uncertainty = Uncertainty()
+    covariance, arrivals = route_covariances(route, 2.0, np.pi / 2, 0.5, uncertainty)
+    sampled = monte_carlo_route(route, 2.0, np.pi / 2, 0.5, uncertainty, 20000, np.random.default_rng(0))
+    print('end of leg      time  analytic sd (x, y)   Monte Carlo sd (x, y)')
+    for leg in range(len(arrivals)):
+        analytic = np.sqrt(np.diag(covariance[leg]))
+        sample = np.sqrt(np.diag(sampled[leg]))
+        print(f'{leg + 1:10d} {arrivals[leg]:9.1f}  {analytic[0]:8.2f} {analytic[1]:8.2f}   '
+              f'{sample[0]:8.2f} {sample[1]:8.2f}')
+    # scenarios: 4 water speeds x 3 tide speeds x 3 correlation times, all the legs at once
+    water_speeds = np.array([1.5, 2.0, 3.0, 5.0])[:, None, None]
+    tide_speeds = np.array([0.0, 0.5, 1.0])[None, :, None]
+    correlation_times = np.array([60.0, 600.0, np.inf])[None, None, :]
+    start = time.perf_counter()
+    covariance, arrivals = route_covariances(route, water_speeds, np.pi / 2, tide_speeds, uncertainty,
+                                             correlation_times)
+    lengths, courses = route_legs(route)
+    ground_speed, water_course = leg_velocities(courses, water_speeds[..., None], np.pi / 2, tide_speeds[..., None])
+    velocity = velocity_covariance(water_speeds[..., None], water_course, tide_speeds[..., None], np.pi / 2, uncertainty)
+    intervals = max_fix_interval(velocity, max_error=20.0, correlation_time=correlation_times[..., None],
+                                 fix_error=3.0)
+    elapsed = time.perf_counter() - start
+    print(f'{covariance.shape[:-2]} leg covariances and fix intervals in {elapsed * 1000:.1f} ms')
+    for i, water_speed in enumerate(water_speeds.ravel()):
+        print(f'water speed {water_speed:.1f}, tide 1.0, bias: final sd '
+              f'{math.sqrt(np.linalg.eigvalsh(covariance[i, 2, 2, -1])[-1]):.1f}, longest fix interval per leg '
+              f'{np.array2string(intervals[i, 2, 2], precision=1)} s')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,217 @@
+# %%
+""" Discrete event simulation of a BoatSimu with multi rate sensors.
+
+Instead of the single rhythm of run_and_fix (run fix_period, then fix), every
+activity is an event with its own period and jitter in a priority queue:
+compass bearings of the near marks, log speed, GPS checks, fixes, course
+updates and tide updates. The boats are only moved when an event needs their
+state: between two events the course and speed are constant, so one run of the
+elapsed time is exact and no fixed step work is done.
+
+A fix uses the last compass bearings taken (not older than max_bearing_age)
+and is solved from these bearings with fix_service.solve_batch, so the error of
+the compass and the age of the bearings show in the fix. It is recorded as a
+FIX_2LOP with 2 bearings, a FIX_3LOP with 3 and a FIX_NLOP with more. """
+import heapq
+import itertools
+import logging
+import time
+from collections import namedtuple
+import numpy as np
+import navigation as nav
+import fix_service
+
+Event = namedtuple('Event', ['time', 'sequence', 'name', 'action', 'period', 'jitter'])
+Bearing = namedtuple('Bearing', ['time', 'bearing'])
+
+
+class EventScheduler:
+    """ run boat_simu along route with events, rng draws the sensor noises and the jitters """
+    def __init__(self, boat_simu: nav.BoatSimu, marks_map: nav.MarksMap, route: nav.Route = None,
+                 rng: np.random.Generator = None, start_time: float = 0.0):
+        self.boat_simu = boat_simu
+        self.marks_map = marks_map
+        self.waypoints = [] if route is None else list(route.route)
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.time = start_time
+        self.counts : dict[str, int] = {}
+        self.bearings : dict[int, tuple[nav.Mark, Bearing]] = {}
+        self.gps_errors : list[tuple[float, float]] = []
+        self.recorder = None
+        # log reading minus the true speed through water
+        self.speed_error = 0.0
+        # period of the course updates, the default arrival distance is run in this period
+        self.course_period = 1.0
+        self._queue : list[Event] = []
+        self._sequence = itertools.count()
+        self._boat_time = start_time
+        self._stopped = False
+
+    def every(self, name: str, period: float, action, jitter: float = 0.0, start: float = None) -> None:
+        """ call action(scheduler) every period (plus a uniform jitter in [-jitter, jitter]) """
+        first = self.time + period if start is None else start
+        self._push(Event(first, next(self._sequence), name, action, period, jitter))
+
+    def at(self, event_time: float, name: str, action) -> None:
+        """ call action(scheduler) once at event_time """
+        self._push(Event(event_time, next(self._sequence), name, action, None, 0.0))
+
+    def _push(self, event: Event) -> None:
+        heapq.heappush(self._queue, event)
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    def advance(self) -> None:
+        """ move the boats up to the current time """
+        duration = self.time - self._boat_time
+        if duration > 0:
+            boat_true, boat_estimate = self.boat_simu.boat_true, self.boat_simu.boat_estimate
+            boat_true.run(duration)
+            run = (boat_true.ground_track.speed + self.speed_error) * duration
+            boat_estimate.position[0] += run * np.sin(boat_true.ground_track.course)
+            boat_estimate.position[1] += run * np.cos(boat_true.ground_track.course)
+            self._boat_time = self.time
+
+    def run(self, until: float = np.inf) -> None:
+        """ process the events up to until, or until stop() is called """
+        self._stopped = False
+        while self._queue and not self._stopped:
+            if self._queue[0].time > until:
+                break
+            event = heapq.heappop(self._queue)
+            self.time = event.time
+            event.action(self)
+            self.counts[event.name] = self.counts.get(event.name, 0) + 1
+            if event.period is not None:
+                jitter = self.rng.uniform(-event.jitter, event.jitter) if event.jitter else 0.0
+                self._push(event._replace(time=event.time + max(event.period + jitter, 0.0),
+                                          sequence=next(self._sequence)))
+        if not self._stopped and until < np.inf:
+            self.time = until
+        self.advance()
+
+    # actions
+
+    def take_bearings(self, number_of_marks: int = 3, sigma: float = 0.0) -> None:
+        """ compass bearings of the number_of_marks fixed marks nearest to the estimated
+        position, with a gaussian error of standard deviation sigma """
+        self.advance()
+        boat_true = self.boat_simu.boat_true
+        nearest = self.boat_simu.select_near_fixed_marks(self.marks_map, 0, number_of_marks)
+        for mark in nearest:
+            bearing = mark.bearing + (self.rng.normal(0.0, sigma) if sigma > 0 else 0.0)
+            self.bearings[id(mark)] = (mark, Bearing(self.time, bearing))
+        logging.debug('bearings of %s marks at %s from %s', len(nearest), self.time, boat_true.position)
+
+    def log_speed(self, sigma: float = 0.0) -> None:
+        """ the dead reckoning uses the log reading, the true speed through water
+        with a gaussian error of standard deviation sigma """
+        self.advance()
+        self.speed_error = self.rng.normal(0.0, sigma) if sigma > 0 else 0.0
+
+    def gps_check(self) -> None:
+        """ record the distance between the estimated and the true positions """
+        self.advance()
+        error = np.hypot(*np.subtract(self.boat_simu.boat_estimate.position, self.boat_simu.boat_true.position))
+        self.gps_errors.append((self.time, float(error)))
+
+    def fix(self, max_bearing_age: float = np.inf, method: str = 'lop') -> None:
+        """ fix from the last bearings not older than max_bearing_age """
+        self.advance()
+        recent = [(mark, bearing) for mark, bearing in self.bearings.values()
+                  if self.time - bearing.time <= max_bearing_age]
+        if len(recent) < 2:
+            return
+        request = {'marks': [list(mark.position) for mark, _ in recent],
+                   'bearings': [bearing.bearing for _, bearing in recent],
+                   'position': list(self.boat_simu.boat_estimate.position),
+                   'sigma': self.boat_simu.sigma, 'method': method}
+        answer = fix_service.solve_batch([request])[0]
+        if not np.all(np.isfinite(answer['position'])):
+            logging.warning('no fix at %s from %s bearings', self.time, len(recent))
+            return
+        self.boat_simu.boat_estimate.set_position(answer['position'])
+        self.boat_simu.fix_marks = tuple(mark for mark, _ in recent)
+        self.boat_simu.fix_area = answer['area']
+        if self.recorder is not None:
+            fix_type = {2: nav.FixType.FIX_2LOP, 3: nav.FixType.FIX_3LOP}.get(len(recent), nav.FixType.FIX_NLOP)
+            self.recorder.record(self.boat_simu, self.time - self.recorder.time, fix_type)
+
+    def update_course(self, arrival_distance: float = None) -> None:
+        """ steer to the current waypoint, go to the next one within arrival_distance
+        (default a course update period run) as go_to_waypoint, stop after the last one """
+        self.advance()
+        while self.waypoints:
+            waypoint = self.waypoints[0]
+            self.boat_simu.compute_waypoint_distance(waypoint)
+            distance = arrival_distance
+            if distance is None:
+                distance = self.boat_simu.boat_true.ground_track.speed * self.course_period
+            if self.boat_simu.boat_true.waypoint_distance > distance:
+                self.boat_simu.set_waypoint_course(waypoint.position)
+                return
+            self.waypoints.pop(0)
+        self.stop()
+
+    def update_tide(self, tide) -> None:
+        """ tide(time) -> (course, speed) """
+        self.advance()
+        course, speed = tide(self.time)
+        self.boat_simu.set_tide_track(course, speed)
+        if self.waypoints:
+            self.boat_simu.set_waypoint_course(self.waypoints[0].position)
+
+    def schedule_sensors(self, compass_period: float = 1.0, log_period: float = 1.0, gps_period: float = 10.0,
+                         fix_period: float = None, course_period: float = 1.0, tide_period: float = 60.0,
+                         tide=None, compass_sigma: float = 0.0, log_sigma: float = 0.0, jitter: float = 0.0,
+                         number_of_marks: int = 3, max_bearing_age: float = None) -> None:
+        """ usual events of a voyage, fix_period defaults to the one of the BoatSimu and
+        max_bearing_age to the compass period (one set of bearings), a period of None
+        disables the event """
+        fix_period = self.boat_simu.fix_period if fix_period is None else fix_period
+        if max_bearing_age is None:
+            max_bearing_age = np.inf if compass_period is None else compass_period + jitter
+        self.course_period = course_period
+        self.at(self.time, 'course', lambda scheduler: scheduler.update_course())
+        if tide is not None:
+            self.at(self.time, 'tide', lambda scheduler: scheduler.update_tide(tide))
+        events = (('compass', compass_period, lambda scheduler: scheduler.take_bearings(number_of_marks, compass_sigma)),
+                  ('log', log_period, lambda scheduler: scheduler.log_speed(log_sigma)),
+                  ('gps', gps_period, lambda scheduler: scheduler.gps_check()),
+                  ('fix', fix_period, lambda scheduler: scheduler.fix(max_bearing_age)),
+                  ('course', course_period, lambda scheduler: scheduler.update_course()),
+                  ('tide', tide_period if tide is not None else None,
+                   lambda scheduler: scheduler.update_tide(tide)))
+        for name, period, action in events:
+            if period is not None:
+                self.every(name, period, action, jitter)
+
+
+def main():
+    logging.disable(logging.WARNING)
+    marks_map = nav.MarksMap()
+    for mark in [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                 nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                 nav.Mark([100.0, 100.0], 'church'), nav.Mark([700.0, 400.0], 'major_lighthouse')]:
+        marks_map.append_mark(mark)
+    route = nav.Route()
+    for position in ([150.0, 150.0], [450.0, 200.0], [450.0, 450.0], [150.0, 400.0]):
+        route.append_waypoint(nav.Waypoint(position))
+    boat_simu = nav.BoatSimu(route.route[0].position, route.route[0].position, fix_period=5.0)
+    boat_simu.set_water_speed(2.0)
+    scheduler = EventScheduler(boat_simu, marks_map, route, rng=np.random.default_rng(0))
+    scheduler.schedule_sensors(compass_period=2.0, log_period=1.0, gps_period=30.0, course_period=1.0,
+                               tide_period=60.0, tide=lambda t: (np.pi / 2, 0.5 * np.sin(t / 600)),
+                               compass_sigma=np.radians(1), log_sigma=0.05, jitter=0.2, max_bearing_age=6.0)
+    start = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - start
+    errors = np.array([error for _, error in scheduler.gps_errors])
+    print(f'{scheduler.time:.0f} s of voyage in {elapsed:.2f} s, events {scheduler.counts}, '
+          f'mean gps error {errors.mean():.2f}, max {errors.max():.2f}')
+
+
+if __name__ == "__main__":
+
+    main()
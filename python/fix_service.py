@@ -0,0 +1,323 @@
+# %%
+""" Asyncio fix service.
+
+Clients send one JSON request per line on a TCP connection:
+    {"id": 1, "marks": [[x, y], ...], "bearings": [b, ...], "position": [x, y],
+     "method": "lop" or "hat", "sigma": 0.0349}
+marks are the observed marks, bearings their bearings (radian, from the boat),
+position the dead reckoning position. The answer is one JSON line
+    {"id": 1, "position": [x, y], "area": a, "method": "lop" or "hat"}
+
+Requests arriving within batch_window are grouped and solved as one batch on a
+process pool: the error polygones of the LOP (the wedges of Mark.polygone_estimate)
+are built and intersected with the vectorized shapely functions, and the hat
+barycentre is used when the intersection is empty, as in compute_position_3lop.
+The event loop only parses, queues and answers. """
+import asyncio
+import json
+import logging
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+from fleet import lop_intersection
+
+SIGMA : float = np.pi/90 # 2 degree
+
+
+def wedge_polygones(marks: np.ndarray, bearings: np.ndarray, positions: np.ndarray, sigma: float):
+    """ (N,) shapely polygones of the possible positions given the LOP of marks (N, 2),
+    the same triangles as Mark.polygone_estimate """
+    length = 2 * np.hypot(*(marks - positions).T)
+    lop = bearings - np.pi
+    corners = [marks]
+    for side in (sigma, -sigma):
+        corners.append(marks + length[:, None] * np.column_stack([np.sin(lop + side), np.cos(lop + side)]))
+    return shapely.polygons(np.stack(corners, axis=1))
+
+
+def hat_barycentre(marks: np.ndarray, bearings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ (N, 2) barycentre and (N,) area of the hat formed by the LOP of marks (N, k, 2) """
+    corners = [lop_intersection(marks[:, i], bearings[:, i], marks[:, j], bearings[:, j])
+               for i in range(marks.shape[1]) for j in range(i + 1, marks.shape[1])]
+    corners = np.stack(corners, axis=1)
+    area = np.zeros(len(marks))
+    if corners.shape[1] == 3:
+        first, second, third = corners[:, 0], corners[:, 1], corners[:, 2]
+        area = np.abs((second[:, 0] - first[:, 0]) * (third[:, 1] - first[:, 1]) -
+                      (third[:, 0] - first[:, 0]) * (second[:, 1] - first[:, 1])) / 2
+    return np.nanmean(corners, axis=1), area
+
+
+def solve_group(marks: np.ndarray, bearings: np.ndarray, positions: np.ndarray, sigmas: np.ndarray,
+                use_hat: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ fixes of N requests with the same number k of marks:
+    marks (N, k, 2), bearings (N, k), positions (N, 2), sigmas (N,), use_hat (N,) """
+    result, area = hat_barycentre(marks, bearings)
+    hat = np.array(use_hat, dtype=bool)
+    polygone = ~hat
+    if polygone.any():
+        index = np.flatnonzero(polygone)
+        intersection = None
+        for k in range(marks.shape[1]):
+            wedge = wedge_polygones(marks[index, k], bearings[index, k], positions[index], sigmas[index])
+            intersection = wedge if intersection is None else shapely.intersection(intersection, wedge)
+        empty = shapely.is_empty(intersection)
+        solved = index[~empty]
+        result[solved] = shapely.get_coordinates(shapely.centroid(intersection[~empty]))
+        area[solved] = shapely.area(intersection[~empty])
+        hat[index[empty]] = True
+    return result, area, hat
+
+
+def request_id(request):
+    """ id of a request, None when the request is not an object """
+    return request.get('id') if isinstance(request, dict) else None
+
+
+def _numeric_array(value, shape: tuple) -> np.ndarray | None:
+    """ value as a finite float array of shape (None matches any size), None otherwise """
+    try:
+        array = np.array(value, dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if array.ndim != len(shape) or any(size is not None and size != actual
+                                       for size, actual in zip(shape, array.shape)):
+        return None
+    return array if np.isfinite(array).all() else None
+
+
+def validate_request(request) -> str | None:
+    """ error message of a malformed request, None when it can be solved """
+    if not isinstance(request, dict):
+        return 'a request must be a JSON object'
+    marks = _numeric_array(request.get('marks'), (None, 2))
+    if marks is None or len(marks) < 2:
+        return 'marks must be at least 2 [x, y] pairs of numbers'
+    bearings = _numeric_array(request.get('bearings'), (len(marks),))
+    if bearings is None:
+        return f'bearings must be {len(marks)} numbers, one per mark'
+    if request.get('position') is not None and _numeric_array(request['position'], (2,)) is None:
+        return 'position must be [x, y] numbers'
+    sigma = _numeric_array(request.get('sigma', SIGMA), ())
+    if sigma is None or sigma <= 0:
+        return 'sigma must be a positive number'
+    if request.get('method', 'lop') not in ('lop', 'hat'):
+        return "method must be 'lop' or 'hat'"
+    return None
+
+
+def _solve_requests(requests: list[dict]) -> list[dict]:
+    """ answers of valid requests with the same number of marks """
+    marks = np.array([request['marks'] for request in requests], dtype=float)
+    bearings = np.array([request['bearings'] for request in requests], dtype=float)
+    positions = np.array([request['position'] if request.get('position') is not None
+                          else np.mean(request['marks'], axis=0) for request in requests], dtype=float)
+    sigmas = np.array([request.get('sigma', SIGMA) for request in requests], dtype=float)
+    use_hat = np.array([request.get('method', 'lop') == 'hat' for request in requests])
+    result, area, hat = solve_group(marks, bearings, positions, sigmas, use_hat)
+    return [{'id': request.get('id'), 'position': position.tolist(), 'area': float(fix_area),
+             'method': 'hat' if is_hat else 'lop'}
+            for request, position, fix_area, is_hat in zip(requests, result, area, hat)]
+
+
+def solve_batch(requests: list[dict]) -> list[dict]:
+    """ solve a batch of requests, grouped by number of marks, one answer per request:
+    a malformed request or a failed geometry only gives an error answer for itself """
+    answers = [None] * len(requests)
+    groups = {}
+    for i, request in enumerate(requests):
+        error = validate_request(request)
+        if error is not None:
+            answers[i] = {'id': request_id(request), 'error': error}
+            continue
+        groups.setdefault(len(request['marks']), []).append(i)
+    for indices in groups.values():
+        try:
+            group_answers = _solve_requests([requests[i] for i in indices])
+        except Exception:
+            # solve the requests of the group one by one so that only the failing ones get an error
+            group_answers = []
+            for i in indices:
+                try:
+                    group_answers.extend(_solve_requests([requests[i]]))
+                except Exception as error:
+                    logging.warning('fix of request %s failed: %s', requests[i].get('id'), error)
+                    group_answers.append({'id': requests[i].get('id'), 'error': str(error)})
+        for i, answer in zip(indices, group_answers):
+            answers[i] = answer
+    return answers
+
+
+class FixService:
+    """ TCP fix server batching the concurrent requests """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, batch_window: float = 0.005,
+                 max_batch: int = 512, executor=None):
+        self.host = host
+        self.port = port
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.executor = executor
+        self.batch_sizes : list[int] = []
+        self._queue : asyncio.Queue = None
+        self._server = None
+        self._batcher = None
+        self._clients : set[asyncio.Task] = set()
+        self._solving : set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor()
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout: float = 1.0) -> None:
+        """ stop accepting clients, let the connected ones finish within timeout """
+        self._server.close()
+        if self._clients:
+            _, still_open = await asyncio.wait(self._clients, timeout=timeout)
+            for task in still_open:
+                task.cancel()
+            await asyncio.gather(*still_open, return_exceptions=True)
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        self.executor.shutdown()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def submit(self, request: dict) -> dict:
+        """ queue a request and wait for its fix """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            # the batch is solved while the next one is collected
+            task = asyncio.create_task(self._solve(batch))
+            self._solving.add(task)
+            task.add_done_callback(self._solving.discard)
+
+    async def _solve(self, batch: list) -> None:
+        requests = [request for request, _ in batch]
+        answers = []
+        try:
+            answers = await asyncio.get_running_loop().run_in_executor(self.executor, solve_batch, requests)
+        except Exception as error:
+            logging.exception('fix batch failed')
+            answers = [{'id': request_id(request), 'error': str(error)} for request in requests]
+        finally:
+            # every future is resolved, even when the batch is cancelled or answers are missing
+            for i, (request, future) in enumerate(batch):
+                if not future.done():
+                    answer = answers[i] if i < len(answers) and answers[i] is not None else \
+                        {'id': request_id(request), 'error': 'fix not computed'}
+                    future.set_result(answer)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        pending = set()
+        self._clients.add(asyncio.current_task())
+
+        async def answer(line: bytes):
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as error:
+                response = {'error': f'invalid json: {error}'}
+            else:
+                error = validate_request(request)
+                if error is None:
+                    response = await self.submit(request)
+                else:
+                    response = {'id': request_id(request), 'error': error}
+            writer.write(json.dumps(response).encode() + b'\n')
+
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            self._clients.discard(asyncio.current_task())
+
+
+async def load_test(host: str, port: int, clients: int = 50, requests_per_client: int = 100,
+                    seed: int = 0) -> dict:
+    """ clients send their requests one after the other and wait for each answer,
+    return throughput (fix/s) and latency percentiles (s) """
+    rng = np.random.default_rng(seed)
+    marks = np.array([[100.0, 500.0], [500.0, 500.0], [500.0, 100.0], [100.0, 100.0]])
+    latencies = []
+
+    async def client(number: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(requests_per_client):
+            position = rng.uniform(150, 450, 2)
+            selected = marks[rng.choice(len(marks), 3, replace=False)]
+            vector = selected - position
+            bearings = np.arctan2(vector[:, 0], vector[:, 1]) + rng.normal(0, np.pi/360, 3)
+            request = {'id': [number, i], 'marks': selected.tolist(), 'bearings': bearings.tolist(),
+                       'position': position.tolist()}
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            await reader.readline()
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'fixes': len(latencies), 'throughput': len(latencies) / elapsed,
+            'latency_median': statistics.median(latencies),
+            'latency_p95': latencies[int(0.95 * (len(latencies) - 1))]}
+
+
+async def benchmark(clients: int = 50, requests_per_client: int = 100) -> None:
+    service = FixService(port=0)
+    await service.start()
+    try:
+        result = await load_test(service.host, service.port, clients, requests_per_client)
+    finally:
+        await service.close()
+    print(f"{result['fixes']} fixes, {result['throughput']:.0f} fix/s, "
+          f"latency median {result['latency_median']*1000:.1f} ms, p95 {result['latency_p95']*1000:.1f} ms, "
+          f"mean batch {statistics.mean(service.batch_sizes):.1f} requests")
+
+
+def main():
+    asyncio.run(benchmark())
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,250 @@
+# %%
+""" Fleet simulation: thousands of boats stepped as arrays.
+
+FleetSimu holds the state of N boats as (N,) and (N, 2) arrays (true and
+estimated positions, ground, water and tide tracks) and advances them all in
+one vectorized step. Fixes are batched against the fixed marks of a shared
+MarksMap: the nearest marks of every boat are selected with one distance
+matrix, the best triple is chosen with the wedge area model and the position
+is the barycentre of the hat of the three LOP, like compute_position_3lop_hat.
+
+Wedge area model: near the boat the error wedge of a mark at range r is a strip
+of half width sigma*r across the bearing. Two strips intersect in a
+parallelogram of area 4 sigma**2 r_i*r_j/|sin(angle_ij)|, three strips in a
+centrally symmetric hexagon (or the parallelogram of a pair when the third strip
+does not cut it). The cost of a combination is this area divided by 4 sigma**2,
+so it does not depend on sigma and the fix error is about sigma*sqrt(cost). """
+import time
+from itertools import combinations
+import numpy as np
+import navigation as nav
+
+
+class FleetSimu:
+    """ N boats, dtype=np.float32 halves the memory of the state arrays """
+    def __init__(self, true_positions, estimate_positions=None, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.true_position = np.array(true_positions, dtype=self.dtype).reshape(-1, 2)
+        if estimate_positions is None:
+            estimate_positions = self.true_position
+        self.estimate_position = np.array(estimate_positions, dtype=self.dtype).reshape(-1, 2)
+        size = len(self.true_position)
+        self.ground_course = np.zeros(size, dtype=self.dtype)
+        self.ground_speed = np.zeros(size, dtype=self.dtype)
+        self.water_course = np.zeros(size, dtype=self.dtype)
+        self.water_speed = np.zeros(size, dtype=self.dtype)
+        self.tide_course = np.zeros(size, dtype=self.dtype)
+        self.tide_speed = np.zeros(size, dtype=self.dtype)
+        self.waypoint = np.array(self.true_position)
+        self.arrived = np.zeros(size, dtype=bool)
+        self.fix_marks = np.full((size, 3), -1, dtype=np.int32)
+        self._marks_position = np.zeros((0, 2), dtype=self.dtype)
+        self.fixed_marks : list[nav.Mark] = []
+
+    def __len__(self) -> int:
+        return len(self.true_position)
+
+    def set_marks(self, marks_map: nav.MarksMap) -> None:
+        """ share the fixed marks of marks_map with the whole fleet """
+        self.fixed_marks = list(marks_map.fixed_marks)
+        self._marks_position = np.array([mark.position for mark in self.fixed_marks],
+                                        dtype=self.dtype).reshape(-1, 2)
+
+    def set_tide_track(self, course=0.0, speed=0.0) -> None:
+        """ scalar or (N,) tide """
+        self.tide_course[:] = course
+        self.tide_speed[:] = speed
+
+    def set_water_speed(self, speed) -> None:
+        self.water_speed[:] = speed
+
+    def set_waypoints(self, positions) -> None:
+        """ (2,) or (N, 2) waypoints """
+        self.waypoint[:] = positions
+        self.arrived[:] = False
+
+    def update_course_to_steer(self) -> None:
+        """ vectorized Boat.set_waypoint_course from the estimated positions:
+        ground course to the waypoint, course to steer against the tide and ground speed """
+        vector = self.waypoint - self.estimate_position
+        self.ground_course[:] = np.arctan2(vector[:, 0], vector[:, 1])
+        min_distance_tide_ground = np.sin(self.tide_course - self.ground_course) * self.tide_speed
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(self.water_speed == 0, 0.0, min_distance_tide_ground / self.water_speed)
+        angle_ortho_water = np.where(self.water_speed == 0, 0.0, np.arccos(np.clip(ratio, -1, 1)))
+        self.water_course[:] = self.ground_course - np.pi/2 + angle_ortho_water
+        run_x = self.tide_speed * np.sin(self.tide_course) + self.water_speed * np.sin(self.water_course)
+        run_y = self.tide_speed * np.cos(self.tide_course) + self.water_speed * np.cos(self.water_course)
+        self.ground_speed[:] = np.hypot(run_x, run_y)
+
+    def run(self, duration: float) -> None:
+        """ advance every boat that has not arrived, true and estimated positions """
+        moving = ~self.arrived
+        distance = np.where(moving, self.ground_speed * duration, 0)
+        step = np.column_stack([distance * np.sin(self.ground_course), distance * np.cos(self.ground_course)])
+        self.true_position += step
+        self.estimate_position += step
+
+    def near_marks(self, number: int, chunk_size: int = 4096) -> np.ndarray:
+        """ (N, number) indices in fixed_marks of the marks nearest to the estimated
+        positions, sorted by distance, computed by chunks of boats """
+        number = min(number, len(self._marks_position))
+        nearest = np.empty((len(self), number), dtype=np.int64)
+        for start in range(0, len(self), chunk_size):
+            positions = self.estimate_position[start:start + chunk_size]
+            distances = np.hypot(positions[:, None, 0] - self._marks_position[None, :, 0],
+                                 positions[:, None, 1] - self._marks_position[None, :, 1])
+            if number < distances.shape[1]:
+                candidates = np.argpartition(distances, number - 1, axis=1)[:, :number]
+            else:
+                candidates = np.tile(np.arange(number), (len(positions), 1))
+            order = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1)
+            nearest[start:start + len(positions)] = np.take_along_axis(candidates, order, axis=1)
+        return nearest
+
+    def bearings(self, marks_index: np.ndarray, sigma: float = 0.0, rng=None) -> np.ndarray:
+        """ bearings of the marks from the true positions, with a gaussian error
+        of standard deviation sigma """
+        marks = self._marks_position[marks_index]
+        vector = marks - self.true_position[:, None, :]
+        bearing = np.arctan2(vector[..., 0], vector[..., 1])
+        if sigma > 0:
+            rng = np.random.default_rng() if rng is None else rng
+            bearing = bearing + rng.normal(0.0, sigma, bearing.shape)
+        return bearing
+
+    def best_triples(self, nearest: np.ndarray) -> np.ndarray:
+        """ (N, 3) best triple among the nearest marks of each boat with the wedge area
+        model, see best_triples """
+        marks = self._marks_position[nearest]
+        vector = marks - self.estimate_position[:, None, :]
+        distance = np.hypot(vector[..., 0], vector[..., 1])
+        bearing = np.arctan2(vector[..., 0], vector[..., 1])
+        return np.take_along_axis(nearest, best_triples(distance, bearing)[1], axis=1)
+
+    def fix_3lop(self, number_of_marks: int = 6, sigma: float = 0.0, rng=None) -> None:
+        """ batched 3 LOP fix of every boat, the estimated position becomes the
+        barycentre of the hat formed by the three LOP """
+        if len(self._marks_position) < 3:
+            raise ValueError('a 3 LOP fix needs at least 3 fixed marks, see set_marks')
+        nearest = self.near_marks(number_of_marks)
+        triples = self.best_triples(nearest)
+        bearing = self.bearings(triples, sigma, rng)
+        marks = self._marks_position[triples]
+        corners = []
+        for first, second in ((0, 1), (0, 2), (1, 2)):
+            corners.append(lop_intersection(marks[:, first], bearing[:, first],
+                                            marks[:, second], bearing[:, second]))
+        barycentre = np.nanmean(np.stack(corners), axis=0)
+        valid = np.all(np.isfinite(barycentre), axis=1)
+        self.estimate_position[valid] = barycentre[valid]
+        self.fix_marks[:] = triples
+
+    def update_arrived(self, fix_period: float) -> None:
+        """ boats closer to their waypoint than a step are arrived """
+        distance = np.hypot(*(self.waypoint - self.true_position).T)
+        self.arrived |= distance <= self.ground_speed * fix_period
+
+    def step(self, fix_period: float, number_of_marks: int = 6, sigma: float = 0.0, rng=None) -> None:
+        """ one simulation step for the whole fleet: steer, run and fix """
+        self.update_course_to_steer()
+        self.run(fix_period)
+        self.fix_3lop(number_of_marks, sigma, rng)
+        self.update_arrived(fix_period)
+
+    def nbytes(self) -> int:
+        """ memory of the state arrays """
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+
+def lop_intersection(mark1: np.ndarray, bearing1: np.ndarray, mark2: np.ndarray, bearing2: np.ndarray) -> np.ndarray:
+    """ (N, 2) intersections of the LOP of two arrays of marks, nan for parallel LOP """
+    direction1 = np.column_stack([np.sin(bearing1), np.cos(bearing1)])
+    direction2 = np.column_stack([np.sin(bearing2), np.cos(bearing2)])
+    determinant = direction1[:, 0] * direction2[:, 1] - direction1[:, 1] * direction2[:, 0]
+    delta = mark2 - mark1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        along = (delta[:, 0] * direction2[:, 1] - delta[:, 1] * direction2[:, 0]) / determinant
+    along = np.where(np.abs(determinant) < 1e-12, np.nan, along)
+    return mark1 + along[:, None] * direction1
+
+
+def strip_intersection_costs(distance: np.ndarray, bearing: np.ndarray, combination: np.ndarray) -> np.ndarray:
+    """ (N, C) wedge area model cost of the combinations (C, m) of the marks at ranges
+    and bearings (N, k): area of the intersection of the strips of half width r
+    across the bearings, divided by 4. The area of a convex polygon symmetric about
+    the boat is the sum over its edges of the distance to the boat times the edge
+    length, each strip gives two edges of length the part of its boundary line
+    inside the other strips. inf when the strips are parallel or a range is 0 """
+    distance = distance[:, combination]
+    bearing = bearing[:, combination]
+    area = np.zeros(distance.shape[:2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for first in range(combination.shape[1]):
+            # boundary line of the strip at distance r_first, t along the line
+            lower = np.full(area.shape, -np.inf)
+            upper = np.full(area.shape, np.inf)
+            for second in range(combination.shape[1]):
+                if second == first:
+                    continue
+                cos = np.cos(bearing[..., first] - bearing[..., second])
+                sin = np.sin(bearing[..., first] - bearing[..., second])
+                bound1 = (-distance[..., second] - distance[..., first] * cos) / sin
+                bound2 = (distance[..., second] - distance[..., first] * cos) / sin
+                parallel = np.abs(sin) < 1e-12
+                inside = np.abs(distance[..., first] * cos) <= distance[..., second]
+                lower = np.where(parallel, np.where(inside, lower, np.inf), np.maximum(lower, np.minimum(bound1, bound2)))
+                upper = np.where(parallel, upper, np.minimum(upper, np.maximum(bound1, bound2)))
+            area = area + distance[..., first] * np.where(upper > lower, upper - lower, 0.0)
+        area = area / 4
+    return np.where((distance > 0).all(axis=2) & ~np.isnan(area), area, np.inf)
+
+
+def best_triples(distance: np.ndarray, bearing: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ (N,) cost and (N, 3) columns (in the k marks) of the best triple of the marks
+    at ranges and bearings (N, k) with the wedge area model (strip_intersection_costs),
+    cost inf when k < 3. When the third strip does not cut the parallelogram of a
+    pair, the triples of this pair have the same cost: the triple with the largest
+    sum of the pair information terms (sin(angle_ij)/(r_i*r_j))**2 is chosen """
+    if distance.shape[1] < 3:
+        return np.full(len(distance), np.inf), np.zeros((len(distance), 3), dtype=np.int64)
+    triples = np.array(list(combinations(range(distance.shape[1]), 3)))
+    costs = strip_intersection_costs(distance, bearing, triples)
+    information = np.zeros(costs.shape)
+    for first, second in combinations(range(3), 2):
+        i, j = triples[:, first], triples[:, second]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            information += (np.sin(bearing[:, i] - bearing[:, j]) / (distance[:, i] * distance[:, j])) ** 2
+    minimum = costs.min(axis=1, keepdims=True)
+    tied = costs <= minimum * (1 + 1e-9)
+    best = np.argmax(np.where(tied & np.isfinite(information), information, -1.0), axis=1)
+    best = np.where(np.isfinite(minimum[:, 0]), best, 0)
+    return costs[np.arange(len(costs)), best], triples[best]
+
+
+def main():
+    mark_table = [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                  nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                  nav.Mark([100.0, 100.0], 'church'), nav.Mark([700.0, 400.0], 'major_lighthouse')]
+    marks_map = nav.MarksMap()
+    for mark in mark_table:
+        marks_map.append_mark(mark)
+    rng = np.random.default_rng(0)
+    for dtype in (np.float64, np.float32):
+        fleet = FleetSimu(rng.uniform(150, 450, (10_000, 2)), dtype=dtype)
+        fleet.set_marks(marks_map)
+        fleet.set_tide_track(np.pi, 2)
+        fleet.set_water_speed(10)
+        fleet.set_waypoints(rng.uniform(150, 450, (len(fleet), 2)))
+        start = time.perf_counter()
+        for _ in range(20):
+            fleet.step(1.0, sigma=np.pi/180, rng=rng)
+        elapsed = time.perf_counter() - start
+        error = np.hypot(*(fleet.estimate_position - fleet.true_position).T)
+        print(f'{np.dtype(dtype).name}: {len(fleet)} boats x 20 steps in {elapsed:.2f} s, '
+              f'{fleet.nbytes()/1e6:.1f} MB, mean fix error {error.mean():.2f}')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,162 @@
+# %%
+""" Parallel sweep of a fix method over a grid of boat positions.
+
+The grid is split in chunks of consecutive points evaluated by a process pool.
+Mark positions and the output arrays live in shared memory: the workers attach
+to them once in their initializer and a task is only a (start, stop) pair of
+indices, so nothing is pickled per point. """
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import navigation as nav
+
+# per worker state, filled by _init_worker
+_worker = {}
+
+
+class SharedArray:
+    """ numpy array backed by a multiprocessing SharedMemory block """
+    def __init__(self, shape: tuple, dtype=np.float64, name: str = None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    def spec(self) -> tuple:
+        """ what a worker needs to attach to the block """
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        del self.array
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def fix_position(boat_simu: nav.BoatSimu, marks: list[nav.Mark], fix_type: nav.FixType) -> list[float]:
+    """ headless fix of boat_simu from marks, the best marks are selected when
+    more marks than needed by the fix are given """
+    match fix_type:
+        case nav.FixType.FIX_3LOP:
+            if len(marks) > 3:
+                marks = boat_simu.get_3best_marks(marks)
+            return boat_simu.compute_position_3lop(*marks[:3], show_lop=False, show_area=False)
+        case nav.FixType.FIX_2LOP:
+            if len(marks) > 2:
+                marks = boat_simu.get_2best_marks(marks)
+            return boat_simu.compute_position_2lop(*marks[:2], show_lop=False, show_area=False)
+        case nav.FixType.FIX_ROBUST:
+            return boat_simu.compute_position_robust(marks, show_lop=False, show_area=False)
+        case _:
+            raise ValueError(f'{fix_type} needs a course and a speed, it can not be swept on a grid')
+
+
+def _init_worker(marks_spec, mark_types, points_spec, estimates_spec, fix_method):
+    """ attach the worker to the shared arrays and build its marks once """
+    marks_array = SharedArray(marks_spec[1], marks_spec[2], name=marks_spec[0])
+    _worker['marks'] = [nav.Mark(position, mark_type)
+                        for position, mark_type in zip(marks_array.array, mark_types)]
+    marks_array.close()
+    _worker['points'] = SharedArray(points_spec[1], points_spec[2], name=points_spec[0])
+    _worker['estimates'] = SharedArray(estimates_spec[1], estimates_spec[2], name=estimates_spec[0])
+    _worker['fix_method'] = fix_method
+
+
+def _sweep_chunk(start: int, stop: int) -> int:
+    """ evaluate the points start:stop and write the estimates in shared memory """
+    marks = _worker['marks']
+    points = _worker['points'].array
+    estimates = _worker['estimates'].array
+    fix_method = _worker['fix_method']
+    for index in range(start, stop):
+        boat_simu = nav.BoatSimu(points[index], points[index])
+        if isinstance(fix_method, nav.FixType):
+            estimates[index] = fix_position(boat_simu, marks, fix_method)
+        else:
+            estimates[index] = fix_method(boat_simu, marks)
+    return stop - start
+
+
+def sweep_grid(marks: list[nav.Mark], grid_x, grid_y, fix_method=nav.FixType.FIX_3LOP,
+               processes: int = None, chunk_size: int = None) -> tuple[np.ndarray, np.ndarray]:
+    """ Evaluate fix_method at every point of the grid grid_x x grid_y.
+    fix_method is a FixType (FIX_3LOP or FIX_2LOP) or a picklable function
+    fix_method(boat_simu, marks) -> estimated position.
+    processes=1 runs in the calling process.
+    Return estimated positions, shape (len(grid_y), len(grid_x), 2),
+    and fix errors (distance to the true position), shape (len(grid_y), len(grid_x)) """
+    grid_x = np.asarray(grid_x, dtype=float)
+    grid_y = np.asarray(grid_y, dtype=float)
+    mesh_x, mesh_y = np.meshgrid(grid_x, grid_y)
+    points_count = mesh_x.size
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, points_count))
+    if chunk_size is None:
+        # a few chunks per worker to balance the load
+        chunk_size = max(1, -(-points_count // (processes * 4)))
+
+    marks_array = SharedArray((len(marks), 2))
+    points = SharedArray((points_count, 2))
+    estimates = SharedArray((points_count, 2))
+    try:
+        marks_array.array[:] = [mark.position for mark in marks]
+        points.array[:, 0] = mesh_x.ravel()
+        points.array[:, 1] = mesh_y.ravel()
+        estimates.array[:] = np.nan
+        init_args = (marks_array.spec(), [mark.mark_type for mark in marks],
+                     points.spec(), estimates.spec(), fix_method)
+        chunks = [(start, min(start + chunk_size, points_count))
+                  for start in range(0, points_count, chunk_size)]
+        if processes == 1:
+            _init_worker(*init_args)
+            try:
+                for chunk in chunks:
+                    _sweep_chunk(*chunk)
+            finally:
+                _worker['points'].close()
+                _worker['estimates'].close()
+                _worker.clear()
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+                done = sum(pool.starmap(_sweep_chunk, chunks))
+            if done != points_count:
+                logging.warning('grid sweep evaluated %s points out of %s', done, points_count)
+        estimated = estimates.array.reshape(mesh_x.shape + (2,)).copy()
+        true_positions = points.array.reshape(mesh_x.shape + (2,))
+        errors = np.hypot(*(estimated - true_positions).transpose(2, 0, 1))
+    finally:
+        marks_array.close()
+        points.close()
+        estimates.close()
+    return estimated, errors
+
+
+def main():
+    logging.disable(logging.WARNING)
+    mark_table = [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                  nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                  nav.Mark([100.0, 100.0])]
+    grid_x = np.arange(40, 600, 10)
+    grid_y = np.arange(150, 590, 10)
+    timings = {}
+    for processes in sorted({1, 2, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        _, errors = sweep_grid(mark_table, grid_x, grid_y, nav.FixType.FIX_3LOP, processes=processes)
+        timings[processes] = time.perf_counter() - start
+        print(f'{processes:3d} processes: {timings[processes]:6.2f} s, '
+              f'speedup x{timings[1]/timings[processes]:.1f}, mean error {np.nanmean(errors):.2f}')
+
+
+if __name__ == "__main__":
+
+    main()
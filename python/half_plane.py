@@ -0,0 +1,216 @@
+# %%
+""" Exact uncertainty region of n LOP by half-plane intersection.
+
+The error polygone of a LOP (Mark.polygone_estimate) is the triangle of the
+mark and of the two points at twice the range along bearing - pi +- sigma, the
+intersection of three half-planes: the two sides of the wedge and its far edge.
+The region of n LOP is the intersection of these 3n half-planes, computed in
+one pass by the sort by angle and deque algorithm, O(n log n), on plain floats
+(no GEOS call). The area and the centroid of the convex polygon come from the
+shoelace formula.
+
+A half-plane is a point p and a direction d, the allowed side is on the left:
+cross(d, x - p) >= 0. """
+import logging
+import math
+import time
+from collections import deque, namedtuple
+import numpy as np
+
+Region = namedtuple('Region', ['vertices', 'area', 'centroid'])
+Region.__doc__ = """ counter clockwise vertices (m, 2) of the convex region, (0, 2) when
+empty, its area and its centroid (None when empty) """
+
+EMPTY_REGION = Region(np.zeros((0, 2)), 0.0, None)
+
+
+def wedge_triangles(marks: np.ndarray, bearings: np.ndarray, position, sigma: float) -> np.ndarray:
+    """ (k, 3, 2) triangles of Mark.polygone_estimate of marks (k, 2) and bearings (k,)
+    for a boat at position """
+    marks = np.asarray(marks, dtype=float).reshape(-1, 2)
+    bearings = np.asarray(bearings, dtype=float)
+    length = 2 * np.hypot(marks[:, 0] - position[0], marks[:, 1] - position[1])
+    lop = bearings - np.pi
+    corners = [marks]
+    for side in (sigma, -sigma):
+        corners.append(marks + length[:, None] * np.column_stack([np.sin(lop + side), np.cos(lop + side)]))
+    return np.stack(corners, axis=1)
+
+
+def triangle_half_planes(triangles: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ points (3k, 2) and directions (3k, 2) of the edges of the triangles (k, 3, 2),
+    oriented counter clockwise so that the triangles are on the left """
+    triangles = np.asarray(triangles, dtype=float)
+    first, second, third = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    orientation = ((second[:, 0] - first[:, 0]) * (third[:, 1] - first[:, 1])
+                   - (second[:, 1] - first[:, 1]) * (third[:, 0] - first[:, 0]))
+    clockwise = orientation < 0
+    triangles = triangles.copy()
+    triangles[clockwise] = triangles[clockwise][:, ::-1]
+    points = triangles.reshape(-1, 2)
+    directions = (np.roll(triangles, -1, axis=1) - triangles).reshape(-1, 2)
+    return points, directions
+
+
+def half_plane_intersection(points, directions) -> np.ndarray:
+    """ counter clockwise vertices (m, 2) of the intersection of the half-planes,
+    (0, 2) when it is empty, flat or unbounded """
+    points = np.asarray(points, dtype=float).reshape(-1, 2).tolist()
+    directions = np.asarray(directions, dtype=float).reshape(-1, 2).tolist()
+    vertices = _intersection([(px, py, dx, dy) for (px, py), (dx, dy) in zip(points, directions)])
+    return np.array(vertices).reshape(-1, 2)
+
+
+def _intersection(half_planes: list[tuple[float, float, float, float]]) -> list[tuple[float, float]]:
+    """ half_plane_intersection on (px, py, dx, dy) tuples of plain floats, for the
+    few half-planes of a fix the numpy calls would cost more than the algorithm """
+    lines = []
+    scale = 1.0
+    for px, py, dx, dy in half_planes:
+        norm = math.hypot(dx, dy)
+        if norm > 0:
+            lines.append((px, py, dx / norm, dy / norm, math.atan2(dy, dx)))
+            scale = max(scale, abs(px), abs(py))
+    if len(lines) < 3:
+        return []
+    tolerance = 1e-12 * scale
+    lines.sort(key=lambda line: line[4])
+    unique = []
+    for line in lines:
+        if unique and line[4] - unique[-1][4] < 1e-12:
+            # same direction: keep the most restrictive one, the one on the left of the other
+            px, py, dx, dy, _ = unique[-1]
+            if dx * (line[1] - py) - dy * (line[0] - px) > 0:
+                unique[-1] = line
+            continue
+        unique.append(line)
+
+    def intersection(first, second):
+        px, py, dx, dy, _ = first
+        qx, qy, ex, ey, _ = second
+        denominator = dx * ey - dy * ex
+        if abs(denominator) < 1e-15:
+            return None
+        t = ((qx - px) * ey - (qy - py) * ex) / denominator
+        return px + t * dx, py + t * dy
+
+    def outside(line, point):
+        px, py, dx, dy, _ = line
+        return dx * (point[1] - py) - dy * (point[0] - px) < -tolerance
+
+    def corner(first, second):
+        point = intersection(first, second)
+        if point is None:
+            raise ValueError('parallel half-planes')
+        return point
+
+    queue = deque()
+    try:
+        for line in unique:
+            while len(queue) >= 2 and outside(line, corner(queue[-2], queue[-1])):
+                queue.pop()
+            while len(queue) >= 2 and outside(line, corner(queue[0], queue[1])):
+                queue.popleft()
+            if queue and intersection(queue[-1], line) is None:
+                # opposite directions next to each other in angle: unbounded or empty
+                return []
+            queue.append(line)
+        while len(queue) >= 3 and outside(queue[0], corner(queue[-2], queue[-1])):
+            queue.pop()
+        while len(queue) >= 3 and outside(queue[-1], corner(queue[0], queue[1])):
+            queue.popleft()
+        if len(queue) < 3:
+            return []
+        vertices = [corner(queue[i], queue[(i + 1) % len(queue)]) for i in range(len(queue))]
+    except ValueError:
+        return []
+    # the angular gaps between consecutive directions are below pi for a bounded region
+    for i in range(len(queue)):
+        gap = (queue[(i + 1) % len(queue)][4] - queue[i][4]) % (2 * math.pi)
+        if gap >= math.pi:
+            return []
+    return vertices
+
+
+def polygon_area_centroid(vertices) -> tuple[float, np.ndarray | None]:
+    """ area and centroid of the counter clockwise polygon (m, 2), shoelace formula """
+    vertices = vertices.tolist() if isinstance(vertices, np.ndarray) else list(vertices)
+    if len(vertices) < 3:
+        return 0.0, None
+    area = centroid_x = centroid_y = 0.0
+    for (x, y), (x_next, y_next) in zip(vertices, vertices[1:] + vertices[:1]):
+        cross = x * y_next - x_next * y
+        area += cross
+        centroid_x += (x + x_next) * cross
+        centroid_y += (y + y_next) * cross
+    area /= 2
+    if area <= 0:
+        return 0.0, np.mean(vertices, axis=0)
+    return area, np.array([centroid_x, centroid_y]) / (6 * area)
+
+
+def lop_half_planes(marks, bearings, position, sigma: float) -> list[tuple[float, float, float, float]]:
+    """ (px, py, dx, dy) half-planes of the triangles of wedge_triangles, plain floats """
+    half_planes = []
+    for (mark_x, mark_y), bearing in zip(np.asarray(marks, dtype=float).reshape(-1, 2).tolist(),
+                                         np.asarray(bearings, dtype=float).tolist()):
+        length = 2 * math.hypot(mark_x - position[0], mark_y - position[1])
+        lop = bearing - math.pi
+        corners = [(mark_x, mark_y)] + [(mark_x + length * math.sin(lop + side), mark_y + length * math.cos(lop + side))
+                                        for side in (sigma, -sigma)]
+        (ax, ay), (bx, by), (cx, cy) = corners
+        if (bx - ax) * (cy - ay) - (by - ay) * (cx - ax) < 0:
+            corners.reverse()
+        for i in range(3):
+            (px, py), (qx, qy) = corners[i], corners[(i + 1) % 3]
+            half_planes.append((px, py, qx - px, qy - py))
+    return half_planes
+
+
+def lop_region(marks, bearings, position, sigma: float) -> Region:
+    """ exact region of the LOP of marks (k, 2) with bearings (k,), any k >= 1, for a
+    boat at position (the size of the wedges) """
+    vertices = _intersection(lop_half_planes(marks, bearings, position, sigma))
+    if not vertices:
+        return EMPTY_REGION
+    area, centroid = polygon_area_centroid(vertices)
+    return Region(np.array(vertices), area, centroid)
+
+
+def main():
+    import shapely
+    logging.disable(logging.WARNING)
+    sigma = np.pi / 90
+    rng = np.random.default_rng(0)
+    marks = np.array([[100.0, 500.0], [250.0, 510.0], [500.0, 500.0], [500.0, 100.0],
+                      [100.0, 100.0], [700.0, 400.0], [300.0, 50.0], [50.0, 300.0]])
+    boats = rng.uniform(150.0, 450.0, (300, 2))
+    for count in (2, 3, 5, 8):
+        area_errors = []
+        centroid_errors = []
+        timings = {'half_plane': 0.0, 'shapely': 0.0}
+        for boat in boats:
+            chosen = marks[rng.choice(len(marks), count, replace=False)]
+            bearings = np.arctan2(chosen[:, 0] - boat[0], chosen[:, 1] - boat[1]) + rng.normal(0, sigma / 2, count)
+            start = time.perf_counter()
+            region = lop_region(chosen, bearings, boat, sigma)
+            timings['half_plane'] += time.perf_counter() - start
+            start = time.perf_counter()
+            intersection = None
+            for triangle in wedge_triangles(chosen, bearings, boat, sigma):
+                wedge = shapely.Polygon(triangle)
+                intersection = wedge if intersection is None else intersection.intersection(wedge)
+            timings['shapely'] += time.perf_counter() - start
+            if intersection.is_empty or intersection.area == 0.0:
+                area_errors.append(region.area)
+                continue
+            area_errors.append(abs(region.area - intersection.area) / intersection.area)
+            centroid_errors.append(math.dist(region.centroid, shapely.get_coordinates(intersection.centroid)[0]))
+        print(f'{count} LOP: half-plane {timings["half_plane"] / len(boats) * 1e6:.0f} us, shapely '
+              f'{timings["shapely"] / len(boats) * 1e6:.0f} us per fix, max relative area error '
+              f'{max(area_errors):.1e}, max centroid error {max(centroid_errors, default=0.0):.1e}')
+
+
+if __name__ == "__main__":
+
+    main()
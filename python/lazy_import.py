@@ -0,0 +1,36 @@
+""" Deferred module import.
+
+lazy_module('matplotlib.pyplot') returns a stand-in object that imports the real
+module the first time one of its attributes is used, so modules that only need
+plotting, CSV or polygon features on some code paths do not pay for them at import. """
+import importlib
+import sys
+
+
+class LazyModule:
+    """ module proxy, the module is imported on first attribute access """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """ import and return the real module """
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._module is not None or self._name in sys.modules
+
+    def __getattr__(self, attribute: str):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f'<lazy module {self._name} ({state})>'
+
+
+def lazy_module(name: str) -> LazyModule:
+    """ return a lazy stand-in for module name """
+    return LazyModule(name)
@@ -0,0 +1,279 @@
+# %%
+""" Atlas of the best marks: precomputed selection of the pair or triple of marks.
+
+For a MarksMap, a sigma and the rule of update_2lop_fix / update_3lop_fix (best
+combination among the number_of_marks nearest fixed marks), the chosen marks are
+a piecewise constant function of the boat position. build_atlas partitions the
+chart extent with the quadtree of accuracy_map.AccuracyMap, split only where the
+corners of a cell do not choose the same marks, and keeps the result as a raster
+of the finest lattice: a small palette of labels and one uint8 / uint16 palette
+index per cell, saved with np.savez_compressed.
+
+At run time MarkAtlas.best_marks is one lookup in the raster. The cells of the
+region boundaries (the cells whose corners disagree, their neighbours of
+another label, dilated by margin cells) are flagged, and there the exact
+selection of BoatSimu.marks_combination_costs is done instead. Inside a region
+the atlas and the exact selection only differ on ties (triples whose third LOP
+does not cut the wedge intersection of the two others have the same cost).
+
+A MarkAtlas has the near_marks and best_marks methods of a NearMarksTracker, so
+it is passed as tracker to go_to_waypoint. """
+import hashlib
+import logging
+import math
+import time
+import numpy as np
+import navigation as nav
+from accuracy_map import AccuracyMap
+
+
+def atlas_marks(marks_map: nav.MarksMap) -> list[nav.Mark]:
+    """ fixed marks of marks_map in a stable order (MarksMap sorts them by distance) """
+    return sorted(marks_map.fixed_marks, key=lambda mark: (mark.position[0], mark.position[1]))
+
+
+def encode(indices, number: int) -> int:
+    """ label of a combination of mark indices, indices sorted, base number """
+    label = 0
+    for index in sorted(indices):
+        label = label * number + int(index)
+    return label
+
+
+def decode(label: int, number: int, size: int) -> tuple[int, ...]:
+    indices = []
+    for _ in range(size):
+        label, index = divmod(int(label), number)
+        indices.append(index)
+    return tuple(reversed(indices))
+
+
+def selection_evaluator(marks: list[nav.Mark], size: int = 3, sigma: float = nav.SIGMA,
+                        number_of_marks: int = 6):
+    """ evaluator(points (N, 2)) -> best cost (N,) and label (N,) of the best size
+    marks among the number_of_marks nearest, as update_2lop_fix / update_3lop_fix """
+    positions = np.array([mark.position for mark in marks]).reshape(-1, 2)
+
+    def evaluate(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        costs = np.empty(len(points))
+        labels = np.empty(len(points), dtype=np.int64)
+        for i, point in enumerate(points):
+            distances = np.hypot(positions[:, 0] - point[0], positions[:, 1] - point[1])
+            nearest = np.argsort(distances, kind='stable')[:number_of_marks]
+            boat_simu = nav.BoatSimu(point, point, sigma=sigma)
+            comb, comb_costs = boat_simu.marks_combination_costs([marks[j] for j in nearest], size)
+            best = int(np.argmin(comb_costs))
+            costs[i] = comb_costs[best]
+            labels[i] = encode(nearest[list(comb[best])], len(marks))
+        return costs, labels
+    return evaluate
+
+
+def atlas_signature(marks: list[nav.Mark], size: int, sigma: float, number_of_marks: int,
+                    extent: tuple[float, float, float, float], max_level: int) -> str:
+    """ hash of everything the labels depend on """
+    digest = hashlib.sha1(np.array([mark.position for mark in marks], dtype=float).tobytes())
+    digest.update(np.array([size, sigma, number_of_marks, *extent, max_level], dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+class MarkAtlas:
+    """ raster (rows along y, columns along x) of palette indices over extent
+    (x_min, x_max, y_min, y_max), boundary flags the cells checked exactly """
+    def __init__(self, marks_map: nav.MarksMap, extent: tuple[float, float, float, float], raster: np.ndarray,
+                 boundary: np.ndarray, palette: np.ndarray, size: int = 3, sigma: float = nav.SIGMA,
+                 number_of_marks: int = 6, signature: str = ''):
+        self.marks_map = marks_map
+        self.marks = atlas_marks(marks_map)
+        self.extent = extent
+        self.raster = raster
+        self.boundary = boundary
+        self.palette = palette
+        self.size = size
+        self.sigma = sigma
+        self.number_of_marks = number_of_marks
+        self.signature = signature
+        self.tracker = nav.NearMarksTracker(marks_map)
+        self.lookup_count = 0
+        self.exact_count = 0
+        self._combinations = [tuple(self.marks[i] for i in decode(label, len(self.marks), size))
+                              for label in palette.tolist()]
+
+    def cell(self, position) -> tuple[int, int] | None:
+        """ (row, column) of the raster cell of position, None outside of the extent """
+        x_min, x_max, y_min, y_max = self.extent
+        rows, columns = self.raster.shape
+        column = math.floor((position[0] - x_min) / (x_max - x_min) * columns)
+        row = math.floor((position[1] - y_min) / (y_max - y_min) * rows)
+        if 0 <= row < rows and 0 <= column < columns:
+            return row, column
+        return None
+
+    def lookup(self, position) -> tuple[nav.Mark, ...] | None:
+        """ marks of the region of position, None outside of the extent or near a boundary """
+        cell = self.cell(position)
+        if cell is None or self.boundary[cell]:
+            return None
+        return self._combinations[self.raster[cell]]
+
+    def near_marks(self, boat: nav.Boat, number: int) -> list[nav.Mark]:
+        return self.tracker.near_marks(boat, number)
+
+    def best_marks(self, boat_simu: nav.BoatSimu, nearest_marks: list[nav.Mark], size: int) -> tuple:
+        """ best combination of size marks among nearest_marks, as get_2best_marks and
+        get_3best_marks, from the raster when the cell is inside a region """
+        marks = self.lookup(boat_simu.boat_true.position) if size == self.size else None
+        if marks is not None and {id(mark) for mark in marks} <= {id(mark) for mark in nearest_marks}:
+            self.lookup_count += 1
+            return marks
+        self.exact_count += 1
+        comb, costs = boat_simu.marks_combination_costs(nearest_marks, size)
+        return tuple(nearest_marks[i] for i in comb[int(np.argmin(costs))])
+
+    def plot(self, ax=None):
+        """ regions in colors, boundary cells in white """
+        plt = nav.plt
+        ax = plt.gca() if ax is None else ax
+        image = np.ma.masked_array(self.raster, self.boundary)
+        return ax.imshow(image, origin='lower', extent=self.extent, cmap='tab20', interpolation='nearest')
+
+
+def build_atlas(marks_map: nav.MarksMap, extent: tuple[float, float, float, float], size: int = 3,
+                sigma: float = nav.SIGMA, number_of_marks: int = 6, min_level: int = 3, max_level: int = 7,
+                margin: int = 1) -> MarkAtlas:
+    """ atlas of the best size marks over extent on a raster of 2**max_level cells
+    per side. Regions smaller than the cells of min_level may be missed by the
+    quadtree, min_level sets the smallest region surely found """
+    marks = atlas_marks(marks_map)
+    if len(marks) < size:
+        raise ValueError(f'{len(marks)} fixed marks, {size} needed')
+    evaluator = selection_evaluator(marks, size, sigma, number_of_marks)
+    quadtree = AccuracyMap(evaluator, extent, np.inf, min_level, max_level, label_tolerance=0.0)
+    side = quadtree.side
+    labels = np.zeros((side, side), dtype=np.int64)
+    boundary = np.zeros((side, side), dtype=bool)
+    for i, j, cell_size in quadtree.leaves:
+        corners = [quadtree.labels[quadtree._points[point]] for point in quadtree._samples((i, j, cell_size))]
+        labels[j:j + cell_size, i:i + cell_size] = corners[0]
+        if len(set(corners)) > 1:
+            boundary[j:j + cell_size, i:i + cell_size] = True
+    # cells next to a cell of another label
+    boundary[1:, :] |= labels[1:, :] != labels[:-1, :]
+    boundary[:-1, :] |= labels[1:, :] != labels[:-1, :]
+    boundary[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+    boundary[:, :-1] |= labels[:, 1:] != labels[:, :-1]
+    for _ in range(margin):
+        dilated = boundary.copy()
+        dilated[1:, :] |= boundary[:-1, :]
+        dilated[:-1, :] |= boundary[1:, :]
+        dilated[:, 1:] |= boundary[:, :-1]
+        dilated[:, :-1] |= boundary[:, 1:]
+        boundary = dilated
+    palette, raster = np.unique(labels, return_inverse=True)
+    dtype = np.uint8 if len(palette) <= 256 else np.uint16 if len(palette) <= 65536 else np.int32
+    logging.info('mark atlas: %s evaluations, %s regions, %.1f %% boundary cells',
+                 quadtree.evaluations, len(palette), 100 * boundary.mean())
+    signature = atlas_signature(marks, size, sigma, number_of_marks, extent, max_level)
+    return MarkAtlas(marks_map, extent, raster.reshape(side, side).astype(dtype), boundary, palette,
+                     size, sigma, number_of_marks, signature)
+
+
+def save_atlas(atlas: MarkAtlas, file_name: str) -> None:
+    try:
+        np.savez_compressed(file_name, signature=np.array(atlas.signature), extent=np.array(atlas.extent),
+                            raster=atlas.raster, boundary=np.packbits(atlas.boundary, axis=1),
+                            palette=atlas.palette, parameters=np.array([atlas.size, atlas.number_of_marks]),
+                            sigma=np.array(atlas.sigma))
+    except OSError as error:
+        logging.warning('mark atlas %s not written: %s', file_name, error)
+
+
+def read_atlas(file_name: str, marks_map: nav.MarksMap, signature: str = None) -> MarkAtlas | None:
+    """ atlas of marks_map saved in file_name, None when it is missing or out of date
+    (its signature is not signature, or its marks are not the ones of marks_map) """
+    try:
+        with np.load(file_name) as data:
+            extent = tuple(data['extent'].tolist())
+            raster = data['raster']
+            size, number_of_marks = data['parameters'].tolist()
+            sigma = float(data['sigma'])
+            boundary = np.unpackbits(data['boundary'], axis=1, count=raster.shape[1]).astype(bool)
+            palette = data['palette']
+            saved_signature = str(data['signature'])
+    except (OSError, KeyError, ValueError):
+        return None
+    max_level = int(np.log2(raster.shape[0]))
+    expected = atlas_signature(atlas_marks(marks_map), size, sigma, number_of_marks, extent, max_level)
+    if saved_signature != expected or (signature is not None and signature != expected):
+        return None
+    return MarkAtlas(marks_map, extent, raster, boundary, palette, size, sigma, number_of_marks, saved_signature)
+
+
+def load_atlas(marks_map: nav.MarksMap, extent: tuple[float, float, float, float], file_name: str,
+               size: int = 3, sigma: float = nav.SIGMA, number_of_marks: int = 6, min_level: int = 3,
+               max_level: int = 7, margin: int = 1) -> MarkAtlas:
+    """ atlas from file_name when it is up to date, built and saved otherwise """
+    signature = atlas_signature(atlas_marks(marks_map), size, sigma, number_of_marks, extent, max_level)
+    atlas = read_atlas(file_name, marks_map, signature)
+    if atlas is None:
+        logging.info('building mark atlas %s', file_name)
+        atlas = build_atlas(marks_map, extent, size, sigma, number_of_marks, min_level, max_level, margin)
+        save_atlas(atlas, file_name)
+    return atlas
+
+
+def main():
+    import os
+    import tempfile
+    logging.disable(logging.WARNING)
+    plt = nav.plt
+    marks_map = nav.MarksMap()
+    for mark in [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                 nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                 nav.Mark([100.0, 100.0], 'church'), nav.Mark([700.0, 400.0], 'major_lighthouse'),
+                 nav.Mark([300.0, 50.0], 'land_tower')]:
+        marks_map.append_mark(mark)
+    extent = (0.0, 600.0, 0.0, 600.0)
+    file_name = os.path.join(tempfile.mkdtemp(), 'mark_atlas.npz')
+    start = time.perf_counter()
+    atlas = load_atlas(marks_map, extent, file_name, max_level=7)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    atlas = load_atlas(marks_map, extent, file_name, max_level=7)
+    loaded = time.perf_counter() - start
+    print(f'atlas {atlas.raster.shape} built in {built:.2f} s, loaded in {loaded * 1000:.1f} ms, '
+          f'{len(atlas.palette)} regions, {100 * atlas.boundary.mean():.1f} % boundary cells, '
+          f'file {os.path.getsize(file_name)} bytes')
+    rng = np.random.default_rng(0)
+    points = rng.uniform(50.0, 550.0, (300, 2))
+    timings = {}
+    mismatches = 0
+    for name in ('exact', 'atlas'):
+        choices = []
+        start = time.perf_counter()
+        for point in points:
+            boat_simu = nav.BoatSimu(point, point)
+            nearest_marks = boat_simu.select_near_fixed_marks(marks_map, 0, 6)
+            if name == 'exact':
+                choices.append(boat_simu.get_3best_marks(nearest_marks))
+            else:
+                choices.append(atlas.best_marks(boat_simu, nearest_marks, 3))
+        timings[name] = time.perf_counter() - start
+        if name == 'exact':
+            exact_choices = choices
+        else:
+            mismatches = sum({id(mark) for mark in a} != {id(mark) for mark in b}
+                             for a, b in zip(exact_choices, choices))
+    print(f'{len(points)} selections: exact {timings["exact"]:.2f} s, atlas {timings["atlas"]:.2f} s '
+          f'({atlas.lookup_count} lookups, {atlas.exact_count} exact), {mismatches} different choices')
+    plt.figure(1)
+    atlas.plot()
+    for mark in marks_map.fixed_marks:
+        mark.plot_mark()
+    plt.title('regions of the best triple of marks')
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,126 @@
+""" Mark and track type names shared by navigation and nautical_marker.
+
+Kept free of any plotting import so that the navigation core can classify marks
+without loading matplotlib. The names also have integer codes (IntEnum/IntFlag)
+so that compact objects can store a type as a small int and test a category
+with an integer operation instead of a string set lookup. """
+from enum import IntEnum, IntFlag
+
+LANDMARKS_SET : set[str] = {'lighthouse', 'major_lighthouse', 'light_tower', 
+                            'land_tower', 'water_tower', 'church'}
+DANGERS_SET : set[str] = {'wreck', 'wreck_depth', 'danger','rock_covers','rock_depth'}
+SEAMARK_SET : set[str] = {'conical','can','spherical','spar','pillar','tower'}
+
+HARBOURS_SET : set[str] = {'marina','anchorage','no_anchorage', 'fish',
+                           'no_fish', 'slipway', 'steps'}
+TOPMARKS_SET : set[str] = {'green', 'green_bis', 'red', 'red_bis', 'north', 'south', 'east', 'west',
+                'danger', 'special', 'safe_water', 'emergency'}
+
+TRACK_SET : set[str] = {'waypoint', 'water_track', 'ground_track', 'tide_track', 'dead_reckoning'}
+
+
+class MarkCategory(IntFlag):
+    """ category of a mark type """
+    NONE = 0
+    LANDMARK = 1
+    DANGER = 2
+    SEAMARK = 4
+    HARBOUR = 8
+
+
+class MarkType(IntEnum):
+    """ mark type code, UNKNOWN for names not in the sets above (svg icons, ...) """
+    UNKNOWN = 0
+    LIGHTHOUSE = 1
+    MAJOR_LIGHTHOUSE = 2
+    LIGHT_TOWER = 3
+    LAND_TOWER = 4
+    WATER_TOWER = 5
+    CHURCH = 6
+    WRECK = 7
+    WRECK_DEPTH = 8
+    DANGER = 9
+    ROCK_COVERS = 10
+    ROCK_DEPTH = 11
+    CONICAL = 12
+    CAN = 13
+    SPHERICAL = 14
+    SPAR = 15
+    PILLAR = 16
+    TOWER = 17
+    MARINA = 18
+    ANCHORAGE = 19
+    NO_ANCHORAGE = 20
+    FISH = 21
+    NO_FISH = 22
+    SLIPWAY = 23
+    STEPS = 24
+
+
+class TopMark(IntEnum):
+    """ topmark code """
+    NONE = 0
+    GREEN = 1
+    GREEN_BIS = 2
+    RED = 3
+    RED_BIS = 4
+    NORTH = 5
+    SOUTH = 6
+    EAST = 7
+    WEST = 8
+    DANGER = 9
+    SPECIAL = 10
+    SAFE_WATER = 11
+    EMERGENCY = 12
+
+
+class TrackType(IntEnum):
+    """ track type code """
+    UNKNOWN = 0
+    WAYPOINT = 1
+    WATER_TRACK = 2
+    GROUND_TRACK = 3
+    TIDE_TRACK = 4
+    DEAD_RECKONING = 5
+
+
+def _category_of(name: str) -> MarkCategory:
+    category = MarkCategory.NONE
+    if name in LANDMARKS_SET:
+        category |= MarkCategory.LANDMARK
+    if name in DANGERS_SET:
+        category |= MarkCategory.DANGER
+    if name in SEAMARK_SET:
+        category |= MarkCategory.SEAMARK
+    if name in HARBOURS_SET:
+        category |= MarkCategory.HARBOUR
+    return category
+
+
+# category of each MarkType, indexed by the code
+MARK_CATEGORIES : tuple[MarkCategory, ...] = tuple(_category_of(code.name.lower()) for code in MarkType)
+_MARK_TYPE_CODES : dict[str, MarkType] = {code.name.lower(): code for code in MarkType}
+_TOP_MARK_CODES : dict[str, TopMark] = {code.name.lower(): code for code in TopMark}
+_TRACK_TYPE_CODES : dict[str, TrackType] = {code.name.lower(): code for code in TrackType}
+
+
+def mark_type_code(mark_type: str) -> MarkType:
+    """ code of a mark type name """
+    return _MARK_TYPE_CODES.get(mark_type.lower(), MarkType.UNKNOWN)
+
+
+def top_mark_code(top_mark_type: str | None) -> TopMark:
+    """ code of a topmark name, TopMark.NONE for None or unknown names """
+    if top_mark_type is None:
+        return TopMark.NONE
+    return _TOP_MARK_CODES.get(top_mark_type.lower(), TopMark.NONE)
+
+
+def track_type_code(track_type: str) -> TrackType:
+    """ code of a track type name """
+    return _TRACK_TYPE_CODES.get(track_type.lower(), TrackType.UNKNOWN)
+
+
+def mark_category(code: MarkType) -> MarkCategory:
+    """ category of a mark type code """
+    return MARK_CATEGORIES[code]
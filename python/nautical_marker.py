@@ -3,29 +3,26 @@ from math import pi
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 import matplotlib.transforms as transforms
+import svg_icon
 
-LANDMARKS_SET : set[str] = {'lighthouse', 'major_lighthouse', 'light_tower', 
-                            'land_tower', 'water_tower', 'church'}
-DANGERS_SET : set[str] = {'wreck', 'wreck_depth', 'danger','rock_covers','rock_depth'}
-SEAMARK_SET : set[str] = {'conical','can','spherical','spar','pillar','tower'}
+from mark_types import LANDMARKS_SET, DANGERS_SET, SEAMARK_SET, HARBOURS_SET, TOPMARKS_SET, TRACK_SET
 
-HARBOURS_SET : set[str] = {'marina','anchorage','no_anchorage', 'fish',
-                           'no_fish', 'slipway', 'steps'}
-TOPMARKS_SET : set[str] = {'green', 'green_bis', 'red', 'red_bis', 'north', 'south', 'east', 'west',
-                'danger', 'special', 'safe_water', 'emergency'}
+# chart symbols of svg_nautical_icon/, loaded from the precompiled icon cache
+SVG_ICONS : dict[str, Path] = svg_icon.load_icons()
+SVG_ICON_SET : set[str] = set(SVG_ICONS)
 
-TRACK_SET : set[str] = {'waypoint', 'water_track', 'ground_track', 'tide_track', 'dead_reckoning'}
-
-MARKS_LIST : set[str] = LANDMARKS_SET | DANGERS_SET | SEAMARK_SET | HARBOURS_SET
+MARKS_LIST : set[str] = LANDMARKS_SET | DANGERS_SET | SEAMARK_SET | HARBOURS_SET | SVG_ICON_SET
 
 class PlotMark:
-    """ Plot mark """
+    """ Plot mark, with pyplot when given in place of matplotlib.pyplot
+    (an object with its plot and text functions, as svg_chart.LayerRecorder) """
     text_shift = 0.0002
     markersize = 30
 
     def __init__(self, position_x :float, position_y : float, mark_type : str,
                  top_mark_type : str = None, light_color:str=None, name:str=None,
-                 floating:bool = False, show_top_mark:bool = True):
+                 floating:bool = False, show_top_mark:bool = True, pyplot=None):
+        self.pyplot = plt if pyplot is None else pyplot
         self.position_x = position_x
         self.position_y = position_y
         self.mark_type = mark_type.lower()
@@ -44,19 +41,21 @@ class PlotMark:
             self.plot_land_mark()
         if self.mark_type in HARBOURS_SET:
             self.plot_harbour_mark()
+        if self.mark_type in SVG_ICON_SET:
+            self.plot_svg_mark()
         if light_color is not None:
             self.plot_light_mark(light_color)
         if self.name is not None:
-            plt.text(self.position_x + self.text_shift,
-                     self.position_y + self.text_shift, self.name)
+            self.pyplot.text(self.position_x + self.text_shift,
+                             self.position_y + self.text_shift, self.name)
 
     def plot_light_mark(self, color : str, angle : float=None) -> None:
         """ Plot light mark """
         if angle is None:
             angle = -0.45
         marker = BuildPath.light(angle)
-        plt.plot(self.position_x, self.position_y, marker=marker, linestyle=None,
-                 markeredgecolor=color,
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker, linestyle=None,
+                         markeredgecolor=color,
                 markerfacecolor=color, markersize=self.markersize)
 
     def plot_harbour_mark(self) -> None:
@@ -78,9 +77,16 @@ class PlotMark:
                 marker = BuildPath.steps()
             case _:
                 print('not defined harbour')
-        plt.plot(self.position_x, self.position_y, marker=marker,
-                 markersize = PlotMark.markersize/2,
-                 fillstyle='none', markeredgewidth=1, markeredgecolor='m')
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker,
+                         markersize = PlotMark.markersize/2,
+                         fillstyle='none', markeredgewidth=1, markeredgecolor='m')
+
+    def plot_svg_mark(self) -> None:
+        """ Plot chart symbol loaded from svg_nautical_icon """
+        marker = BuildPath.svg_icon(self.mark_type)
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker, linestyle='None',
+                         markerfacecolor='none', markeredgecolor='k', markeredgewidth=0.5,
+                         markersize=self.markersize)
 
     def plot_danger_mark(self) -> None:
         """ plot danger marks """
@@ -106,7 +112,7 @@ class PlotMark:
                 marker_size = marker_size/2
             case _:
                 print('not defined danger')
-        plt.plot(self.position_x, self.position_y, marker=marker, linestyle='solid',
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker, linestyle='solid',
             markerfacecolor=facecolor, markeredgecolor='k',
             markeredgewidth=0.5,
             markersize=marker_size, label=type)
@@ -143,18 +149,18 @@ class PlotMark:
                 markersize = markersize/4
             case _:
                 print('not defined landmark!')
-        plt.plot(self.position_x, self.position_y, marker=marker, linestyle='solid',
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker, linestyle='solid',
                 markerfacecolor=facecolor, markeredgecolor='k',
                 markersize=markersize, label=type)
         if self.mark_type == 'light_tower':
             markersize = markersize / 3
             marker = Path.unit_regular_star(5, 0.3)
-            plt.plot(self.position_x, self.position_y, marker=marker,
-                     linestyle='solid', markerfacecolor='k', markeredgecolor='k',
-                     markersize=markersize, label=type)
+            self.pyplot.plot(self.position_x, self.position_y, marker=marker,
+                             linestyle='solid', markerfacecolor='k', markeredgecolor='k',
+                             markersize=markersize, label=type)
 
         if self.mark_type in ('major_lighthouse', 'light_tower'):
-            plt.plot(self.position_x, self.position_y, marker='o', linestyle='solid',
+            self.pyplot.plot(self.position_x, self.position_y, marker='o', linestyle='solid',
                 markerfacecolor=self.light_color, markeredgecolor=self.light_color,
                 markersize=markersize/6, label=type)
 
@@ -185,11 +191,11 @@ class PlotMark:
         else:
             self.plot_ref_line(self.markersize/2)
 
-        plt.plot(self.position_x, self.position_y, marker=symbol_marker, linestyle='solid',
+        self.pyplot.plot(self.position_x, self.position_y, marker=symbol_marker, linestyle='solid',
                 markerfacecolor=color,
                 markeredgecolor='k',markeredgewidth=0.5,
                 markersize=markersize)
-        plt.plot(self.position_x, self.position_y, marker=symbol_marker2, linestyle='solid',
+        self.pyplot.plot(self.position_x, self.position_y, marker=symbol_marker2, linestyle='solid',
                 markerfacecolor=color2,
                 markeredgecolor='k',markeredgewidth=0.5,
                 markersize=markersize)
@@ -200,7 +206,7 @@ class PlotMark:
     def plot_ref_line(self,size) -> None:
         """ Build point path """
         marker = Path([(-1,0), (1,0)],[1,2])
-        plt.plot(self.position_x, self.position_y, marker=marker,
+        self.pyplot.plot(self.position_x, self.position_y, marker=marker,
                 markeredgecolor='k',
                 markeredgewidth=0.5,
                 markersize=size)
@@ -208,7 +214,7 @@ class PlotMark:
     def plot_white_circle(self, circle_size: float) -> None:
         """ plot white circle"""
         circle_path = BuildPath.circle(circle_size,0)
-        plt.plot(self.position_x, self.position_y, marker=circle_path,
+        self.pyplot.plot(self.position_x, self.position_y, marker=circle_path,
                 markerfacecolor='white', markeredgecolor='k',
                 markeredgewidth=0.2,
                 markersize=self.markersize/12)
@@ -403,6 +409,11 @@ class PlotMark:
 
 class BuildPath:
     """ Build path"""
+    @staticmethod
+    def svg_icon(name: str) -> Path:
+        """ Return the path of a chart symbol of svg_nautical_icon, see SVG_ICON_SET """
+        return SVG_ICONS[name.lower()]
+
     @staticmethod
     def triangle(width : float, height : float, shift_up : float) -> Path:
         """ Build a triangle path """
@@ -660,6 +671,13 @@ class BuildPath:
         
 def plot_track(position_x :float, position_y :float, track_type : str, angle :float, markersize = 20):
     """ Plot Nav """
+    marker = track_path(track_type, angle)
+    plt.plot(position_x, position_y, marker=marker,
+                markersize = markersize,
+                fillstyle='none', markeredgewidth=1, markeredgecolor='k', linestyle='None', label=track_type)
+
+def track_path(track_type : str, angle :float) -> Path:
+    """ Build the path of a track symbol, rotated to angle (course, radian) """
     match track_type:
         case 'waypoint':
             cross_h = Path([(-1, 0), (1, 0)], [1, 2])
@@ -683,10 +701,7 @@ def plot_track(position_x :float, position_y :float, track_type : str, angle :fl
             print(f'the string {track_type} not defined in TRACK_SET! {TRACK_SET}')
     line = Path([(-2,0), (1,0)], [1,2])
     marker = Path.make_compound_path(marker, line)
-    marker = marker.transformed(transforms.Affine2D().rotate(-angle + pi/2))
-    plt.plot(position_x, position_y, marker=marker,
-                markersize = markersize,
-                fillstyle='none', markeredgewidth=1, markeredgecolor='k', linestyle='None', label=track_type)
+    return marker.transformed(transforms.Affine2D().rotate(-angle + pi/2))
 
 def main():
 
@@ -726,6 +741,11 @@ def main():
     for i, mark in enumerate(HARBOURS_SET):
         plt.text(i*2 + 4,24,mark.capitalize(), horizontalalignment='left', rotation = 30)
         danger_mark = PlotMark(i*2+4,23,mark)
+
+    plt.text(1, 31,'SVG chart symbols')
+    for i, mark in enumerate(sorted(SVG_ICON_SET)):
+        plt.text(i*2 + 4, 33, mark, horizontalalignment='left', rotation = 30)
+        PlotMark(i*2+4, 31, mark)
     
     plt.text(1, 27,'Navigation marks')
     for i, track_type in enumerate(TRACK_SET):
@@ -1,28 +1,52 @@
 # %%
 from itertools import combinations
+from collections import OrderedDict, namedtuple
+from array import array
+import sys
 from enum import Enum, auto
 import math
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.transforms as transforms
-from matplotlib.path import Path # For marker construction
-import nautical_marker as  marker
-import pandas as pd
-from shapely.geometry import Polygon
-import shapely
+import mark_types
+# plotting, CSV and polygon libraries are only imported on first use,
+# so that the fix computations only need numpy at import time
+from lazy_import import lazy_module
+plt = lazy_module('matplotlib.pyplot')
+transforms = lazy_module('matplotlib.transforms')
+mpath = lazy_module('matplotlib.path') # For marker construction
+marker = lazy_module('nautical_marker')
+pd = lazy_module('pandas')
+shapely = lazy_module('shapely')
+half_plane = lazy_module('half_plane')
+robust_fix = lazy_module('robust_fix')
+running_fix = lazy_module('running_fix')
+
+
+# default half angle of the bearing error (radian) and fix period of a BoatSimu
+SIGMA : float = np.pi/90 # 2 degree
+FIX_PERIOD : float = 1.0
 
 
 class FixType(Enum):
     FIX_3LOP = auto()
     FIX_2LOP = auto()
     FIX_RUNNING = auto()
+    FIX_ROBUST = auto()
+    FIX_RUNNING_WINDOW = auto()
+    FIX_NLOP = auto()
     
     
+def coordinates(position) -> array:
+    """ fixed size (2 doubles) coordinate storage used by Waypoint, Track, Boat and Mark """
+    return array('d', (float(position[0]), float(position[1])))
+
+
 class Waypoint:
     """ create a waypoint object """
+    __slots__ = ('position', 'waypoint_number')
+
     def __init__(self, position :list[float, float], waypoint_number: int = None):
-        self.position = position
+        self.position = coordinates(position)
         self.waypoint_number = waypoint_number
         
     def plot(self):
@@ -34,12 +58,14 @@ class Waypoint:
 
 class Track:
     """ track class """
+    __slots__ = ('start_position', 'speed', 'course', 'track_type', 'track_code')
     markersize = 20
     def __init__(self, start_position:list[float,float], speed:float = 0, course:float = 0, track_type:str = 'ground_track'):
-        self.start_position = start_position
+        self.start_position = coordinates(start_position)
         self.speed = speed
         self.course = course
-        self.track_type = track_type
+        self.track_type = sys.intern(track_type)
+        self.track_code = mark_types.track_type_code(track_type)
         
     def plot_track(self):
         """ Show speed with direction of course"""
@@ -63,6 +89,9 @@ class Track:
 
 class Boat:
     """ Boat class """
+    __slots__ = ('position', 'ground_track', 'water_track', 'tide_track', 'color',
+                 'waypoint_distance', 'boat_size')
+
     def __init__(self, position :list[float, float],
         ground_track:Track = Track([0,0],track_type='ground_track'),
         water_track:Track = Track([0,0],track_type='water_track'),
@@ -71,14 +100,14 @@ class Boat:
         boat_size=10
         ):
         
-        self.position = position
+        self.position = coordinates(position)
         self.ground_track = ground_track
         self.water_track = water_track
         self.tide_track = tide_track
         self.color = color
         self.waypoint_distance = waypoint_distance
-        self.ground_track.start_position = position
-        self.tide_track.start_position = position
+        self.ground_track.start_position = self.position
+        self.tide_track.start_position = self.position
         self.boat_size = boat_size
         
     def update_course_to_steer(self):
@@ -122,7 +151,7 @@ class Boat:
         """ plot with a boat marker in the direction of the course """
         vertices = [(-2, 1), (1, 2), (3, 0), (1, -2), (-2, -1), (-2, 1)]
         codes = [1,3,2,3,1,79]
-        boat_marker = Path(vertices,codes)
+        boat_marker = mpath.Path(vertices,codes)
         if self.water_track.course is not None:
             angle = self.water_track.course - np.pi/2
             boat_marker = boat_marker.transformed(transforms.Affine2D().rotate(-angle))
@@ -132,7 +161,7 @@ class Boat:
 
     def set_position(self,position : list[float, float]) -> None:
         """ Set boat with new position """
-        self.position = position
+        self.position = coordinates(position)
  
     def set_waypoint_course(self, position :list[float, float]) -> None:
         """ give course to go to position """
@@ -155,12 +184,20 @@ class Boat:
 
 
 class Mark:
-    """ Mark class, including landmarks and Seamarks """
+    """ Mark class, including landmarks and Seamarks.
+    mark_type and top_mark_type are also stored as integer codes (type_code,
+    top_mark_code, category) of mark_types """
+    __slots__ = ('position', 'mark_type', 'top_mark_type', 'light_color', 'name', 'floating',
+                 'show_top_mark', 'bearing', 'distance', 'type_code', 'top_mark_code', 'category')
+
     def __init__(self,position :list[float, float], mark_type = 'lighthouse',  top_mark_type = None,
                  light_color = None, name = None, floating:bool=False, show_top_mark:bool=True, bearing = None, distance = None):
-        self.position = position
-        self.mark_type = mark_type.lower()
+        self.position = coordinates(position)
+        self.mark_type = sys.intern(mark_type.lower())
         self.top_mark_type = top_mark_type
+        self.type_code = mark_types.mark_type_code(self.mark_type)
+        self.top_mark_code = mark_types.top_mark_code(top_mark_type)
+        self.category = mark_types.mark_category(self.type_code)
         self.light_color = light_color
         self.name = name
         self.floating = floating
@@ -174,12 +211,11 @@ class Mark:
                         self.light_color, self.name, self.floating, self.show_top_mark  )
 
     def plot_mark_bearing(self, boat:Boat):
-        """ Plot LOP of a mark with dotted line"""
+        """ Plot LOP of a mark with dotted line, see LopBatch to plot many LOP"""
         lop = self.bearing - np.pi
-        x_line = (self.position[0] + np.sin(lop) *
-                  math.dist(self.position,boat.position))
-        y_line = (self.position[1] + np.cos(lop) *
-                  math.dist(self.position,boat.position))
+        distance = math.dist(self.position, boat.position)
+        x_line = self.position[0] + np.sin(lop) * distance
+        y_line = self.position[1] + np.cos(lop) * distance
         plt.plot([self.position[0], x_line],
                  [self.position[1], y_line],
                  '--k', linewidth=0.5)
@@ -227,9 +263,9 @@ class MarksMap:
 
     def append_mark(self, mark:Mark):
         self.map_marks.append(mark)
-        if mark.mark_type in marker.LANDMARKS_SET:
+        if mark.category & mark_types.MarkCategory.LANDMARK:
             self.fixed_marks.append(mark)
-        if (mark.mark_type in marker.SEAMARK_SET) and (mark.floating is None):
+        if (mark.category & mark_types.MarkCategory.SEAMARK) and (mark.floating is None):
             self.fixed_marks.append(mark)
 
     def plot_map(self):
@@ -269,136 +305,463 @@ class MarksMap:
 
 
 
+class NearMarksTracker:
+    """ Incremental selection of the fixed marks of a MarksMap near a moving boat.
+
+    Verlet list: when rebuilt at position p0 it keeps as candidates the fixed marks
+    closer than d_k + 2*skin, d_k being the distance of the k-th nearest mark.
+    As long as the boat stays within skin of p0, the k nearest marks are among the
+    candidates, so only the candidates are sorted at each step.
+
+    The best pair or triple of marks is the exact search of marks_combination_costs
+    at every step. With reuse_best it is reused while the small wedge area model
+    (area of the intersection of two LOP wedges proportional to r1*r2/sin(angle))
+    bounds the change of every combination cost since it was computed, and no other
+    combination can have become cheaper than the chosen one. This is an
+    approximation of the exact search: the bounds are those of the model, applied
+    as ratios to the shapely intersection areas, which only follow the model for
+    small wedges. A reused combination can differ from the one the exact search
+    would choose when two costs are very close """
+    def __init__(self, marks_map:MarksMap, skin:float = None, reuse_best:bool = False):
+        self.marks_map = marks_map
+        self.skin = skin
+        self.reuse_best = reuse_best
+        self.rebuild_count = 0
+        self.best_evaluation_count = 0
+        self.best_reuse_count = 0
+        self._marks : list[Mark] = []
+        self._positions = np.zeros((0, 2))
+        self._candidates : list[Mark] = []
+        self._candidate_positions = np.zeros((0, 2))
+        self._reference = None
+        self._current_skin = 0.0
+        self._number = 0
+        self._best = None
+
+    def _rebuild(self, position, number:int):
+        """ rebuild the candidate list around position """
+        if len(self._marks) != len(self.marks_map.fixed_marks):
+            self._marks = list(self.marks_map.fixed_marks)
+            self._positions = np.array([mark.position for mark in self._marks]).reshape(-1, 2)
+        distances = np.hypot(self._positions[:, 0] - position[0], self._positions[:, 1] - position[1])
+        k = min(number, len(distances))
+        distance_k = np.partition(distances, k - 1)[k - 1] if k > 0 else 0.0
+        skin = self.skin if self.skin is not None else max(0.1 * distance_k, 1e-9)
+        selected = np.flatnonzero(distances <= distance_k + 2 * skin)
+        self._candidates = [self._marks[i] for i in selected]
+        self._candidate_positions = self._positions[selected]
+        self._reference = (position[0], position[1])
+        self._current_skin = skin
+        self._number = number
+        self.rebuild_count += 1
+
+    def near_marks(self, boat:Boat, number:int) -> list[Mark]:
+        """ the number fixed marks nearest to the boat, sorted by distance """
+        position = boat.position
+        if (self._reference is None or number != self._number
+                or len(self._marks) != len(self.marks_map.fixed_marks)
+                or math.dist(position, self._reference) > self._current_skin):
+            self._rebuild(position, number)
+        distances = np.hypot(self._candidate_positions[:, 0] - position[0],
+                             self._candidate_positions[:, 1] - position[1])
+        order = np.argsort(distances, kind='stable')[:number]
+        nearest_marks = []
+        for i in order:
+            mark = self._candidates[i]
+            mark.distance = float(distances[i])
+            nearest_marks.append(mark)
+        return nearest_marks
+
+    def best_marks(self, boat_simu:'BoatSimu', nearest_marks:list[Mark], size:int) -> tuple:
+        """ best combination of size (2 or 3) marks, as BoatSimu.get_2best_marks and
+        get_3best_marks, reused from the previous call with reuse_best when the model
+        bounds show it is still optimal """
+        key = (size, frozenset(id(mark) for mark in nearest_marks))
+        position = boat_simu.boat_true.position
+        if (self.reuse_best and self._best is not None and self._best['key'] == key
+                and self._still_optimal(position)):
+            self.best_reuse_count += 1
+            return self._best['marks']
+        comb, costs = boat_simu.marks_combination_costs(nearest_marks, size)
+        self.best_evaluation_count += 1
+        index_min = int(np.argmin(costs))
+        marks_position = np.array([mark.position for mark in nearest_marks])
+        self._best = {
+            'key': key,
+            'reference': (position[0], position[1]),
+            'distance': np.hypot(marks_position[:, 0] - position[0], marks_position[:, 1] - position[1]),
+            'bearing': np.array([mark.bearing for mark in nearest_marks]),
+            'combinations': np.array(comb),
+            'costs': np.array(costs, dtype=float),
+            'index': index_min,
+            'marks': tuple(nearest_marks[i] for i in comb[index_min]),
+        }
+        return tuple(nearest_marks[i] for i in comb[index_min])
+
+    def _still_optimal(self, position) -> bool:
+        """ bound the cost variation of every combination since the last evaluation
+        with the r1*r2/sin(angle) model, an approximation for the shapely areas """
+        best = self._best
+        delta = math.dist(position, best['reference'])
+        if delta == 0.0:
+            return True
+        distance = best['distance']
+        costs = best['costs']
+        if delta >= 0.5 * distance.min() or costs[best['index']] <= 0.0:
+            return False
+        bearing_change = np.arcsin(delta / distance)
+        combinations_index = best['combinations']
+        upper = np.ones(len(costs))
+        lower = np.ones(len(costs))
+        for first, second in combinations(range(combinations_index.shape[1]), 2):
+            i, j = combinations_index[:, first], combinations_index[:, second]
+            angle = np.mod(best['bearing'][i] - best['bearing'][j], np.pi)
+            change = bearing_change[i] + bearing_change[j]
+            sin_minus = np.sin(angle - change)
+            sin_plus = np.sin(angle + change)
+            valid = (angle > change) & (angle < np.pi - change)
+            sin_min = np.where(valid, np.minimum(sin_minus, sin_plus), 0.0)
+            sin_max = np.where(np.abs(angle - np.pi/2) <= change, 1.0, np.maximum(sin_minus, sin_plus))
+            ratio = np.sin(angle)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pair_upper = ((distance[i] + delta) * (distance[j] + delta) / (distance[i] * distance[j])
+                              * np.where(sin_min > 0, ratio / sin_min, np.inf))
+                pair_lower = ((distance[i] - delta) * (distance[j] - delta) / (distance[i] * distance[j])
+                              * ratio / sin_max)
+            upper = np.maximum(upper, pair_upper)
+            lower = np.minimum(lower, pair_lower)
+        # discarded combinations may become valid, nothing bounds them
+        lower = np.where(costs >= 100000, 0.0, lower)
+        others = np.delete(costs * lower, best['index'])
+        return bool(others.size == 0 or costs[best['index']] * upper[best['index']] < others.min())
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class IntersectionCache:
+    """ Bounded LRU memoization of LOP wedge intersections (compute_intersection_2lop
+    and compute_intersection_3lop of the BoatSimu objects sharing it).
+
+    The key holds sigma, the boat position quantized to tolerance, and for each mark
+    its position and its bearing quantized to the same tolerance at the range of
+    the boat (bearing * distance / tolerance), so a hit returns the intersection
+    computed for a boat less than about tolerance away.
+
+    hits and misses count one lookup per call of compute_intersection_2lop or
+    compute_intersection_3lop. A 3 LOP miss also looks up the pair of its first two
+    marks: cache_info(2) and cache_info(3) count every lookup of the pair and of the
+    triple entries, nested ones included """
+    def __init__(self, maxsize:int = 4096, tolerance:float = 1e-6):
+        self.maxsize = maxsize
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        # number of marks -> [hits, misses] of every lookup
+        self._lookups = {2: [0, 0], 3: [0, 0]}
+        self._store = OrderedDict()
+
+    def key(self, boat:Boat, marks:tuple[Mark, ...], sigma:float) -> tuple:
+        tolerance = self.tolerance
+        boat_x = round(boat.position[0] / tolerance)
+        boat_y = round(boat.position[1] / tolerance)
+        marks_key = []
+        for mark in marks:
+            distance = math.dist(mark.position, boat.position)
+            marks_key.append((mark.position[0], mark.position[1],
+                              round(mark.bearing * distance / tolerance)))
+        return (sigma, boat_x, boat_y, tuple(sorted(marks_key)))
+
+    def get(self, key:tuple, counted:bool = True):
+        """ cached intersection or None, counted False for the lookups nested in
+        another call (only counted in cache_info(size)) """
+        value = self._store.get(key)
+        lookups = self._lookups.setdefault(len(key[3]), [0, 0])
+        if value is None:
+            lookups[1] += 1
+            if counted:
+                self.misses += 1
+            return None
+        self._store.move_to_end(key)
+        lookups[0] += 1
+        if counted:
+            self.hits += 1
+        return value
+
+    def put(self, key:tuple, value) -> None:
+        self._store[key] = value
+        self._store.move_to_end(key)
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def cache_info(self, size:int = None) -> CacheInfo:
+        """ hits and misses of the calls, or of every lookup of the entries of size marks """
+        if size is None:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._store))
+        hits, misses = self._lookups.get(size, (0, 0))
+        return CacheInfo(hits, misses, self.maxsize, sum(len(key[3]) == size for key in self._store))
+
+    def clear(self) -> None:
+        self._store.clear()
+        self.hits = 0
+        self.misses = 0
+        self._lookups = {2: [0, 0], 3: [0, 0]}
+
+
 class BoatSimu:
     """ BoatSimu class, 
     instantian Boat_true that represent the boat with its true parameter
     and boat_estimate taht represent the boat with estimated parameters"""
-    def __init__(self, true_position:list[float, float], estimate_position: list[float, float], boat_size=10):
+    def __init__(self, true_position:list[float, float], estimate_position: list[float, float], boat_size=10,
+                 intersection_cache:'IntersectionCache'=None, lop_batch:'LopBatch'=None,
+                 sigma:float=SIGMA, fix_period:float=FIX_PERIOD):
         self.boat_true = Boat( true_position, color='g', boat_size=boat_size)
         self.boat_estimate = Boat( estimate_position, color='r', boat_size=boat_size)
+        # half angle of the bearing error of the error polygones and period between fixes
+        self.sigma = sigma
+        self.fix_period = fix_period
+        # optional memoization of the LOP intersections, may be shared by several BoatSimu
+        self.intersection_cache = intersection_cache
+        # LopBatch collecting the LOP and error areas instead of plotting them one by one
+        self.lop_batch = lop_batch
+        # marks and area of the error polygone of the last fix
+        self.fix_marks : tuple[Mark, ...] = ()
+        self.fix_area : float = None
+        # bearings kept by the last robust fix
+        self.fix_inliers = None
+        # running_fix.SlidingRunningFix of update_window_fix
+        self.running_window = None
 
     def plot_boat(self) ->None:
         " plot boat true and boat estimate"
         self.boat_true.plot_boat()
         self.boat_estimate.plot_boat()
 
-    def compute_position_3lop(self, mark1:Mark, mark2:Mark, mark3:Mark, show_lop:bool):
+    def plot_lop(self, mark:Mark) -> None:
+        """ plot the LOP of mark, or add it to lop_batch """
+        if self.lop_batch is None:
+            mark.plot_mark_bearing(self.boat_true)
+        else:
+            self.lop_batch.add_lop(mark, self.boat_true)
+
+    def plot_area(self, x, y) -> None:
+        """ plot the error area of a fix, or add it to lop_batch """
+        if self.lop_batch is None:
+            plt.plot(x, y, c='g')
+        else:
+            self.lop_batch.add_area(x, y)
+
+    def compute_position_3lop(self, mark1:Mark, mark2:Mark, mark3:Mark, show_lop:bool, show_area:bool=True):
         """ Comput fix position with triangulation of 3 Lines Of Position (LOP) 
-        using intersection of boat estimated polygone error position"""
-        sigma = np.pi/90 # 2 degree
+        using intersection of boat estimated polygone error position,
+        show_area=False skips the plot of the error area (headless computations)"""
+        sigma = self.sigma
         mark1.compute_bearing(self.boat_true, 0)
         mark2.compute_bearing(self.boat_true, 0)
         mark3.compute_bearing(self.boat_true, 0)
         if show_lop:
-            mark1.plot_mark_bearing(self.boat_true)
-            mark2.plot_mark_bearing(self.boat_true)
-            mark3.plot_mark_bearing(self.boat_true)
+            self.plot_lop(mark1)
+            self.plot_lop(mark2)
+            self.plot_lop(mark3)
         poly_intersection = self.compute_intersection_3lop(mark1, mark2, mark3, sigma)
         if poly_intersection.is_empty:
             logging.warning('Empty intersection at position %s, use of the hat method as default',self.boat_true.position)
             inter1 = compute_intersection(mark1, mark2)
             inter2 = compute_intersection(mark1, mark3)
             inter3 = compute_intersection(mark2, mark3)
-            plt.plot( [inter1[0], inter2[0], inter3[0], inter1[0]], [inter1[1], inter2[1], inter3[1], inter1[1]], c='g')
+            if show_area:
+                self.plot_area([inter1[0], inter2[0], inter3[0], inter1[0]], [inter1[1], inter2[1], inter3[1], inter1[1]])
             barycentre_x = (inter1[0] + inter2[0] + inter3[0])/3
             barycentre_y = (inter1[1] + inter2[1] + inter3[1])/3
             barycentre = [ barycentre_x, barycentre_y]
+            self.fix_area = triangle_area(inter1, inter2, inter3)
         elif poly_intersection.area == 0.0:
             logging.warning('Intersection at position %s, is a point that is used as barycentre',self.boat_true.position)
             barycentre = shapely.get_coordinates(poly_intersection.centroid).tolist()[0]
+            self.fix_area = 0.0
         else:
-            x, y = poly_intersection.exterior.xy
-            plt.plot(x,y, c='g')
+            if show_area:
+                x, y = poly_intersection.exterior.xy
+                self.plot_area(x, y)
             barycentre = shapely.get_coordinates(poly_intersection.centroid).tolist()[0]
+            self.fix_area = poly_intersection.area
+        self.fix_marks = (mark1, mark2, mark3)
         self.boat_estimate.set_position(barycentre)
         return barycentre
     
-    def compute_position_3lop_hat(self, mark1:Mark, mark2:Mark, mark3:Mark, show_lop:bool):
+    def compute_position_3lop_hat(self, mark1:Mark, mark2:Mark, mark3:Mark, show_lop:bool, show_area:bool=True):
         """ Comput fix position with triangulation of 3 Lines Of Position (LOP)
         using the hat algorithm """
-        sigma = np.pi/90 # 2 degree
+        sigma = self.sigma
         mark1.compute_bearing(self.boat_true,sigma)
         mark2.compute_bearing(self.boat_true,sigma)
         mark3.compute_bearing(self.boat_true,sigma)
         if show_lop:
-            mark1.plot_mark_bearing(self.boat_true)
-            mark2.plot_mark_bearing(self.boat_true)
-            mark3.plot_mark_bearing(self.boat_true)
+            self.plot_lop(mark1)
+            self.plot_lop(mark2)
+            self.plot_lop(mark3)
             
         inter1 = compute_intersection(mark1, mark2)
         inter2 = compute_intersection(mark1, mark3)
         inter3 = compute_intersection(mark2, mark3)
-        plt.plot( [inter1[0], inter2[0], inter3[0], inter1[0]], [inter1[1], inter2[1], inter3[1], inter1[1]], c='g')
+        if show_area:
+            self.plot_area([inter1[0], inter2[0], inter3[0], inter1[0]], [inter1[1], inter2[1], inter3[1], inter1[1]])
         barycentre_x = (inter1[0] + inter2[0] + inter3[0])/3
         barycentre_y = (inter1[1] + inter2[1] + inter3[1])/3
         barycentre = [ barycentre_x, barycentre_y]
+        self.fix_marks = (mark1, mark2, mark3)
+        self.fix_area = triangle_area(inter1, inter2, inter3)
         self.boat_estimate.set_position(barycentre)
         return barycentre
 
-    def compute_position_2lop(self, mark1:Mark, mark2:Mark, show_lop:bool):
+    def compute_position_2lop(self, mark1:Mark, mark2:Mark, show_lop:bool, show_area:bool=True):
         """ Compute estimated position with 2 LOP"""
-        sigma = np.pi/90 # 2d egrees
+        sigma = self.sigma
         mark1.compute_bearing(self.boat_true,0)
         mark2.compute_bearing(self.boat_true,0)
         if show_lop:
-            mark1.plot_mark_bearing(self.boat_true)
-            mark2.plot_mark_bearing(self.boat_true)
+            self.plot_lop(mark1)
+            self.plot_lop(mark2)
         poly_intersection = self.compute_intersection_2lop(mark1, mark2, sigma)
         if poly_intersection.is_empty:
             logging.warning('empty intersection for 2LOP for boat at position %s, using tradition intersection of 2LOP as default', self.boat_true.position)
             barycentre = compute_intersection(mark1, mark2)
         else:
-            x, y = poly_intersection.exterior.xy
-            plt.plot(x,y, c='g')
+            if show_area:
+                x, y = poly_intersection.exterior.xy
+                self.plot_area(x, y)
             barycentre = shapely.get_coordinates(poly_intersection.centroid).tolist()[0]
+        self.fix_marks = (mark1, mark2)
+        self.fix_area = poly_intersection.area
+        self.boat_estimate.set_position(barycentre)
+        return barycentre
+
+    def compute_position_nlop(self, marks:list[Mark], show_lop:bool, show_area:bool=True):
+        """ Compute fix position with the LOP of any number of marks, exact intersection
+        of the error polygones by half-plane intersection (half_plane.lop_region),
+        mean of the LOP intersections when it is empty """
+        for mark in marks:
+            mark.compute_bearing(self.boat_true, 0)
+            if show_lop:
+                self.plot_lop(mark)
+        region = half_plane.lop_region([mark.position for mark in marks], [mark.bearing for mark in marks],
+                                       self.boat_true.position, self.sigma)
+        if region.centroid is None:
+            logging.warning('Empty intersection of %s LOP at position %s, mean of the LOP intersections as default',
+                            len(marks), self.boat_true.position)
+            intersections = np.array([compute_intersection(mark1, mark2) for mark1, mark2 in combinations(marks, 2)])
+            barycentre = np.nanmean(intersections, axis=0).tolist()
+            self.fix_area = 0.0
+        else:
+            if show_area:
+                vertices = np.vstack([region.vertices, region.vertices[:1]])
+                self.plot_area(vertices[:, 0], vertices[:, 1])
+            barycentre = region.centroid.tolist()
+            self.fix_area = region.area
+        self.fix_marks = tuple(marks)
+        self.boat_estimate.set_position(barycentre)
+        return barycentre
+
+    def compute_position_robust(self, marks:list[Mark], show_lop:bool, show_area:bool=True, bearings=None):
+        """ Compute fix position with all the LOP of marks, rejecting the bearings that
+        disagree with the consensus (robust_fix.robust_fix). bearings are the observed
+        bearings, the true ones by default. fix_inliers flags the bearings kept """
+        if bearings is None:
+            for mark in marks:
+                mark.compute_bearing(self.boat_true, 0)
+            bearings = [mark.bearing for mark in marks]
+        else:
+            for mark, bearing in zip(marks, bearings):
+                mark.bearing = bearing
+        fix = robust_fix.robust_fix([mark.position for mark in marks], bearings, self.sigma)
+        if show_lop:
+            for mark in marks:
+                self.plot_lop(mark)
+        kept = [mark for mark, inlier in zip(marks, fix.inliers) if inlier]
+        region = half_plane.lop_region([mark.position for mark in kept], [mark.bearing for mark in kept],
+                                       self.boat_true.position, self.sigma)
+        if show_area and region.centroid is not None:
+            vertices = np.vstack([region.vertices, region.vertices[:1]])
+            self.plot_area(vertices[:, 0], vertices[:, 1])
+        self.fix_marks = tuple(kept)
+        self.fix_area = region.area
+        self.fix_inliers = fix.inliers
+        barycentre = fix.position.tolist()
         self.boat_estimate.set_position(barycentre)
         return barycentre
     
-    def compute_intersection_2lop(self, mark1:Mark, mark2:Mark, sigma:float):
+    def wedge_polygone(self, mark:Mark, sigma:float, wedges:dict=None):
+        """ polygone of the possible boat positions given the LOP of mark,
+        wedges is an optional dict id(mark) -> polygone of the wedges already built """
+        if wedges is None:
+            return shapely.Polygon(mark.polygone_estimate(self.boat_true, sigma))
+        if id(mark) not in wedges:
+            wedges[id(mark)] = shapely.Polygon(mark.polygone_estimate(self.boat_true, sigma))
+        return wedges[id(mark)]
+
+    def compute_intersection_2lop(self, mark1:Mark, mark2:Mark, sigma:float, wedges:dict=None):
         """ compute intersection of two polygones"""
-        poly_tuple1 = mark1.polygone_estimate(self.boat_true, sigma)
-        polygone1 = Polygon(poly_tuple1)
-        poly_tuple2 = mark2.polygone_estimate(self.boat_true, sigma)
-        polygone2 = Polygon(poly_tuple2)
+        return self._intersection_2lop(mark1, mark2, sigma, wedges, True)
+
+    def _intersection_2lop(self, mark1:Mark, mark2:Mark, sigma:float, wedges:dict, counted:bool):
+        """ compute_intersection_2lop, counted False when nested in compute_intersection_3lop """
+        cache = self.intersection_cache
+        if cache is not None:
+            key = cache.key(self.boat_true, (mark1, mark2), sigma)
+            poly_intersection = cache.get(key, counted)
+            if poly_intersection is not None:
+                return poly_intersection
+        polygone1 = self.wedge_polygone(mark1, sigma, wedges)
+        polygone2 = self.wedge_polygone(mark2, sigma, wedges)
         poly_intersection = polygone1.intersection(polygone2)
+        if cache is not None:
+            cache.put(key, poly_intersection)
         return poly_intersection
     
-    def compute_intersection_3lop(self, mark1:Mark, mark2:Mark, mark3:Mark, sigma:float):
-        """ compute intersection of two polygones"""
-        polygone_2lop = self.compute_intersection_2lop(mark1, mark2, sigma)
-        poly_tuple3 = mark3.polygone_estimate(self.boat_true, sigma)
-        polygone3 = Polygon(poly_tuple3)        
+    def compute_intersection_3lop(self, mark1:Mark, mark2:Mark, mark3:Mark, sigma:float,
+                                  wedges:dict=None, pairs:dict=None):
+        """ compute intersection of three polygones,
+        pairs is an optional dict (id(mark1), id(mark2)) -> intersection of the pairs already built """
+        cache = self.intersection_cache
+        if cache is not None:
+            key = cache.key(self.boat_true, (mark1, mark2, mark3), sigma)
+            polygone_3lop = cache.get(key)
+            if polygone_3lop is not None:
+                return polygone_3lop
+        if pairs is None:
+            polygone_2lop = self._intersection_2lop(mark1, mark2, sigma, wedges, False)
+        else:
+            pair_key = (id(mark1), id(mark2))
+            if pair_key not in pairs:
+                pairs[pair_key] = self._intersection_2lop(mark1, mark2, sigma, wedges, False)
+            polygone_2lop = pairs[pair_key]
+        polygone3 = self.wedge_polygone(mark3, sigma, wedges)
         polygone_3lop = polygone_2lop.intersection(polygone3)
+        if cache is not None:
+            cache.put(key, polygone_3lop)
         return polygone_3lop
     
         
-    def get_2best_marks(self, mark_table:MarksMap) -> tuple():
-        """ Get the two best mark from a set of mark, considering area of intersection"""
-        sigma = np.pi/90 # 2d egrees
+    def marks_combination_costs(self, mark_table:list[Mark], size:int) -> tuple[list[tuple], list[float]]:
+        """ Cost (area of intersection of the error polygones) of every combination of
+        size marks (2 or 3) of mark_table. Combinations of 3 marks with an empty or flat
+        intersection are discarded with a cost of 100000 """
+        sigma = self.sigma
         for i, mark in enumerate(mark_table):
             mark.compute_bearing(self.boat_true, 0)
-        comb = list(combinations(range(len(mark_table)), 2))
-        min_cost = 100000
-        for i, comb_i in enumerate(comb):
-            poly_intersection = self.compute_intersection_2lop(
-                mark_table[comb_i[0]], mark_table[comb_i[1]], sigma)
-            cost = poly_intersection.area
-            if cost < min_cost:
-                min_cost = cost
-                index_min = i
-        mark_index = comb[index_min]
-        return mark_table[mark_index[0]], mark_table[mark_index[1]]
-    
-    def get_3best_marks(self, mark_table:MarksMap) -> tuple():
-        """ Get the three best mark from a set of mark, considering area of intersection """
-        sigma = np.pi/90 # 2d egrees
-        for i, mark in enumerate(mark_table):
-            mark.compute_bearing(self.boat_true, 0)
-        comb = list(combinations(range(len(mark_table)), 3))
-        min_cost = 100000
-        for i, comb_i in enumerate(comb):
+        comb = list(combinations(range(len(mark_table)), size))
+        # wedges and pair intersections are built once and shared by every combination
+        wedges = {}
+        pairs = {}
+        costs = []
+        for comb_i in comb:
+            if size == 2:
+                poly_intersection = self.compute_intersection_2lop(
+                    mark_table[comb_i[0]], mark_table[comb_i[1]], sigma, wedges)
+                costs.append(poly_intersection.area)
+                continue
             poly_intersection = self.compute_intersection_3lop(
-                mark_table[comb_i[0]], mark_table[comb_i[1]],  mark_table[comb_i[2]], sigma)
+                mark_table[comb_i[0]], mark_table[comb_i[1]],  mark_table[comb_i[2]], sigma, wedges, pairs)
             if poly_intersection.is_empty:
                 logging.warning('Empty intersection at position %s, the mark combinaison %s is discarded',self.boat_true.position, comb_i)
                 cost = 100000
@@ -407,15 +770,25 @@ class BoatSimu:
                 cost = 100000
             else:
                 cost = poly_intersection.area
-            if cost < min_cost:
-                min_cost = cost
-                index_min = i
-        mark_index = comb[index_min]
+            costs.append(cost)
+        return comb, costs
+
+    def get_2best_marks(self, mark_table:MarksMap) -> tuple():
+        """ Get the two best mark from a set of mark, considering area of intersection"""
+        comb, costs = self.marks_combination_costs(mark_table, 2)
+        mark_index = comb[int(np.argmin(costs))]
+        return mark_table[mark_index[0]], mark_table[mark_index[1]]
+    
+    def get_3best_marks(self, mark_table:MarksMap) -> tuple():
+        """ Get the three best mark from a set of mark, considering area of intersection """
+        comb, costs = self.marks_combination_costs(mark_table, 3)
+        mark_index = comb[int(np.argmin(costs))]
         return mark_table[mark_index[0]], mark_table[mark_index[1]], mark_table[mark_index[2]]
 
-    def get_1best_mark(self, mark_table:'MarksMap', fix_period:float):
+    def get_1best_mark(self, mark_table:'MarksMap', fix_period:float=None):
         """ return the mark that is the closet to an 90 degree angle to boat course """
-        sigma = np.pi / 90 # 2d egrees
+        sigma = self.sigma
+        fix_period = self.fix_period if fix_period is None else fix_period
         area_min = 10000
         index_min = 0
         for i, mark in enumerate(mark_table):
@@ -450,23 +823,61 @@ class BoatSimu:
             x, y = poly_intersection.exterior.xy
             if show_lop:
                 plt.plot(mark_shifted.position[0], mark_shifted.position[1],'+k')
-                mark.plot_mark_bearing(self.boat_true)
-                mark_shifted.plot_mark_bearing(self.boat_true)
-                plt.plot(x,y, c='g')
+                self.plot_lop(mark)
+                self.plot_lop(mark_shifted)
+                self.plot_area(x, y)
             barycentre = shapely.get_coordinates(poly_intersection.centroid).tolist()[0]
         del mark_shifted
         self.boat_estimate.set_position(barycentre)
         area = poly_intersection.area
+        self.fix_marks = (mark,)
+        self.fix_area = area
         return barycentre, area
 
-    def update_3lop_fix(self, nearest_marks: Mark) -> None:
-        markA, markB, markC = self.get_3best_marks(nearest_marks)
+    def update_window_fix(self, nearest_marks:list[Mark], fix_period:float, window:int=8,
+                          marks_per_fix:int=1) -> list[float]:
+        """ run fix_period, take the bearings of the marks_per_fix nearest marks and fix
+        with the LOP of the last window bearings carried forward by the dead reckoning
+        (running_fix.SlidingRunningFix), the dead reckoning is kept until two of them cross """
+        if self.running_window is None or self.running_window.window != window:
+            self.running_window = running_fix.SlidingRunningFix(window, self.sigma)
+        # sigma only scales the covariance, the bearings of the window stay valid
+        self.running_window.sigma = self.sigma
+        track = self.boat_estimate.ground_track
+        run = track.speed * fix_period
+        self.run(fix_period)
+        self.running_window.advance((run * np.sin(track.course), run * np.cos(track.course)))
+        marks = nearest_marks[:marks_per_fix]
+        for mark in marks:
+            mark.compute_bearing(self.boat_true, 0)
+            self.running_window.observe(mark.position, mark.bearing, self.boat_estimate.position)
+        position = self.running_window.position()
+        if position is not None:
+            self.boat_estimate.set_position(position)
+        self.fix_marks = tuple(marks)
+        self.fix_area = self.running_window.area()
+        return list(self.boat_estimate.position)
+
+    def update_3lop_fix(self, nearest_marks: Mark, tracker:'NearMarksTracker'=None) -> None:
+        if tracker is None:
+            markA, markB, markC = self.get_3best_marks(nearest_marks)
+        else:
+            markA, markB, markC = tracker.best_marks(self, nearest_marks, 3)
         self.compute_position_3lop(markA, markB, markC, show_lop=False)
 
-    def update_2lop_fix(self, nearest_marks: Mark) -> None:
-        markA, markB = self.get_2best_marks(nearest_marks)
+    def update_2lop_fix(self, nearest_marks: Mark, tracker:'NearMarksTracker'=None) -> None:
+        if tracker is None:
+            markA, markB = self.get_2best_marks(nearest_marks)
+        else:
+            markA, markB = tracker.best_marks(self, nearest_marks, 2)
         self.compute_position_2lop(markA, markB, show_lop=False)
 
+    def update_robust_fix(self, nearest_marks: Mark) -> None:
+        self.compute_position_robust(nearest_marks, show_lop=False, show_area=False)
+
+    def update_nlop_fix(self, nearest_marks: Mark) -> None:
+        self.compute_position_nlop(nearest_marks, show_lop=False, show_area=False)
+
     def update_run_fix(self, nearest_marks: Mark, fix_period: float, sigma: float) -> None:
         best_mark = self.get_1best_mark(nearest_marks, fix_period)
         self.run_fix(best_mark, fix_period, sigma, show_lop=True)
@@ -479,6 +890,10 @@ class BoatSimu:
         self.boat_estimate.set_waypoint_course(position)
         self.boat_true.set_waypoint_course(position)
         
+    def set_water_speed(self, speed:float) -> None:
+        self.boat_estimate.water_track.speed = speed
+        self.boat_true.water_track.speed = speed
+
     def set_tide_track(self, course:float=0, speed:float=0):
         self.boat_estimate.tide_track.course = course
         self.boat_estimate.tide_track.speed = speed
@@ -490,38 +905,75 @@ class BoatSimu:
         self.boat_estimate.compute_waypoint_distance(waypoint)
         self.boat_true.compute_waypoint_distance(waypoint)
 
-    def select_near_fixed_marks(self, marks_map:MarksMap, sigma: float, number_of_marks: int):
-        marks_map.compute_fixed_mark_disance(self.boat_estimate)
-        nearest_marks = marks_map.select_near_fixed_marks(number_of_marks)
+    def select_near_fixed_marks(self, marks_map:MarksMap, sigma: float, number_of_marks: int,
+                                tracker:'NearMarksTracker'=None):
+        """ select the number_of_marks fixed marks nearest to the estimated position,
+        incrementally when a NearMarksTracker of marks_map is given """
+        if tracker is None:
+            marks_map.compute_fixed_mark_disance(self.boat_estimate)
+            nearest_marks = marks_map.select_near_fixed_marks(number_of_marks)
+        else:
+            nearest_marks = tracker.near_marks(self.boat_estimate, number_of_marks)
         for mark in nearest_marks:
             mark.compute_bearing(self.boat_true, sigma)
         return nearest_marks
 
-    def go_to_waypoint(self, waypoint:Waypoint, marks_map:MarksMap, sigma:float, fix_period:float, fix_type:FixType):
+    def go_to_waypoint(self, waypoint:Waypoint, marks_map:MarksMap, sigma:float=None, fix_period:float=None,
+                       fix_type:FixType=FixType.FIX_3LOP,
+                       tracker:'NearMarksTracker'=None, recorder=None, corridor=None):
+        """ run and fix up to the waypoint, sigma and fix_period default to the ones of
+        the BoatSimu, given values replace them so that every fix of the leg uses them.
+        tracker (NearMarksTracker of marks_map) makes the selection of near and best
+        marks incremental between steps, each step is appended to recorder
+        (trajectory_recorder.TrajectoryRecorder) when given.
+        corridor (danger_corridor.DangerCorridor) logs the dangers of the leg and
+        the ones approached by the estimated position at each step """
+        if sigma is not None:
+            self.sigma = sigma
+        if fix_period is not None:
+            self.fix_period = fix_period
+        sigma, fix_period = self.sigma, self.fix_period
         self.compute_waypoint_distance(waypoint)
+        if corridor is not None:
+            corridor.start_leg(self.boat_estimate.position, waypoint.position)
         while self.boat_true.waypoint_distance > self.boat_true.ground_track.speed * fix_period:
             self.set_waypoint_course(waypoint.position)
             self.plot_boat()
-            nearest_marks = self.select_near_fixed_marks(marks_map, sigma, 6)
-            self.run_and_fix(nearest_marks, fix_period, fix_type, sigma)
+            nearest_marks = self.select_near_fixed_marks(marks_map, sigma, 6, tracker)
+            self.run_and_fix(nearest_marks, fix_period, fix_type, sigma, tracker, recorder)
             self.compute_waypoint_distance(waypoint)
+            if corridor is not None:
+                corridor.watch(self.boat_estimate)
         # finish to go
         finish_period = self.boat_true.waypoint_distance / self.boat_true.ground_track.speed
         self.set_waypoint_course(waypoint.position)
         self.plot_boat()
-        nearest_marks = self.select_near_fixed_marks(marks_map, sigma, 6)
-        self.run_and_fix(nearest_marks, finish_period, fix_type, sigma)
+        nearest_marks = self.select_near_fixed_marks(marks_map, sigma, 6, tracker)
+        self.run_and_fix(nearest_marks, finish_period, fix_type, sigma, tracker, recorder)
+        if corridor is not None:
+            corridor.watch(self.boat_estimate)
 
-    def run_and_fix(self, nearest_marks, fix_period:float, fix_type:FixType, sigma:float):
+    def run_and_fix(self, nearest_marks, fix_period:float, fix_type:FixType, sigma:float,
+                    tracker:'NearMarksTracker'=None, recorder=None):
         match fix_type:
             case FixType.FIX_2LOP:
                 self.run(fix_period)
-                self.update_2lop_fix(nearest_marks)
+                self.update_2lop_fix(nearest_marks, tracker)
             case FixType.FIX_3LOP:
                 self.run(fix_period)
-                self.update_3lop_fix(nearest_marks)
+                self.update_3lop_fix(nearest_marks, tracker)
             case FixType.FIX_RUNNING:
                 self.update_run_fix(nearest_marks, fix_period, sigma)
+            case FixType.FIX_ROBUST:
+                self.run(fix_period)
+                self.update_robust_fix(nearest_marks)
+            case FixType.FIX_RUNNING_WINDOW:
+                self.update_window_fix(nearest_marks, fix_period)
+            case FixType.FIX_NLOP:
+                self.run(fix_period)
+                self.update_nlop_fix(nearest_marks)
+        if recorder is not None:
+            recorder.record(self, fix_period, fix_type)
         
         
 
@@ -591,6 +1043,65 @@ def compute_intersection(mark1 : Mark, mark2 : Mark) -> list[float,float]:
     return intersection
 
 
+def lop_segments(marks_position, bearings, boats_position) -> np.ndarray:
+    """ (N, 2, 2) segments of the LOP of N (mark, boat) pairs, from the mark to the
+    distance of the boat, as Mark.plot_mark_bearing """
+    marks_position = np.asarray(marks_position, dtype=float).reshape(-1, 2)
+    boats_position = np.asarray(boats_position, dtype=float).reshape(-1, 2)
+    lop = np.asarray(bearings, dtype=float) - np.pi
+    distance = np.hypot(*(marks_position - boats_position).T)
+    ends = marks_position + distance[:, None] * np.column_stack([np.sin(lop), np.cos(lop)])
+    return np.stack([marks_position, ends], axis=1)
+
+
+class LopBatch:
+    """ Collect LOP and error polygones and draw them with one LineCollection and
+    one PolyCollection, much faster than one plt.plot per line for dense plots """
+    def __init__(self):
+        self.marks_position : list = []
+        self.bearings : list[float] = []
+        self.boats_position : list = []
+        self.areas : list = []
+
+    def add_lop(self, mark:Mark, boat:Boat) -> None:
+        self.marks_position.append(tuple(mark.position))
+        self.bearings.append(mark.bearing)
+        self.boats_position.append(tuple(boat.position))
+
+    def add_lops(self, marks_position, bearings, boats_position) -> None:
+        """ add N LOP given as arrays """
+        self.marks_position.extend(map(tuple, np.asarray(marks_position).reshape(-1, 2)))
+        self.bearings.extend(np.asarray(bearings, dtype=float).ravel())
+        self.boats_position.extend(map(tuple, np.asarray(boats_position).reshape(-1, 2)))
+
+    def add_area(self, x, y) -> None:
+        self.areas.append(np.column_stack([x, y]))
+
+    def draw(self, ax=None, lop_color='k', area_color='g'):
+        """ draw everything collected, return the (LineCollection, PolyCollection) """
+        collections = lazy_module('matplotlib.collections')
+        ax = plt.gca() if ax is None else ax
+        lines = polygones = None
+        if self.bearings:
+            segments = lop_segments(self.marks_position, self.bearings, self.boats_position)
+            lines = collections.LineCollection(segments, colors=lop_color, linestyles='--', linewidths=0.5)
+            ax.add_collection(lines)
+        if self.areas:
+            polygones = collections.PolyCollection(self.areas, facecolors='none', edgecolors=area_color)
+            ax.add_collection(polygones)
+        ax.autoscale_view()
+        return lines, polygones
+
+    def clear(self) -> None:
+        self.__init__()
+
+
+def triangle_area(point1, point2, point3) -> float:
+    """ area of the triangle (hat) defined by three points """
+    return abs((point2[0] - point1[0]) * (point3[1] - point1[1]) -
+               (point3[0] - point1[0]) * (point2[1] - point1[1])) / 2
+
+
 def legend_unique():
     """ Remove duplicated labels """
     handles, labels = plt.gca().get_legend_handles_labels()
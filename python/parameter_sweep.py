@@ -0,0 +1,146 @@
+# %%
+""" Sensitivity sweeps over sigma, fix period, speed and tide.
+
+A SweepEngine evaluates a pipeline of stages. Each stage declares the
+parameters it reads and the stages it takes as inputs; its result is cached
+under the values of the parameters it depends on (its own and the ones of its
+inputs). Sweeping one parameter therefore recomputes only the stages downstream
+of that parameter, everything else comes from the cache.
+
+leg_engine builds the pipeline of a leg from start to waypoint:
+    geometry   mark positions                          (no parameter)
+    track      fix positions along the leg             (water_speed, tide_course, tide_speed, fix_period)
+    ranges     ranges and bearings of the near marks   (track)
+    selection  wedge area cost of the best triple      (ranges)
+    errors     expected fix error, sigma * sqrt(cost)  (sigma, selection)
+    summary    duration, mean and max fix error        (track, errors)
+so a sigma sweep recomputes errors and summary only. """
+import itertools
+import time
+from collections import namedtuple
+import numpy as np
+import navigation as nav
+import route_planner
+
+Stage = namedtuple('Stage', ['function', 'parameters', 'inputs'], defaults=[(), ()])
+Stage.__doc__ = """ function(*inputs results, **parameters values) """
+
+SweepInfo = namedtuple('SweepInfo', ['evaluations', 'hits'])
+
+
+class SweepEngine:
+    """ cached evaluation of a pipeline of stages, default parameters values in parameters """
+    def __init__(self, stages: dict[str, Stage], **parameters):
+        self.stages = stages
+        self.parameters = parameters
+        self._cache : dict[tuple, object] = {}
+        self.evaluations : dict[str, int] = {name: 0 for name in stages}
+        self.hits = 0
+        self._dependencies = {}
+        for name in stages:
+            self.dependencies(name)
+
+    def dependencies(self, name: str) -> tuple[str, ...]:
+        """ sorted parameters read by the stage name and by its inputs """
+        if name not in self._dependencies:
+            stage = self.stages[name]
+            parameters = set(stage.parameters)
+            for input_name in stage.inputs:
+                parameters.update(self.dependencies(input_name))
+            self._dependencies[name] = tuple(sorted(parameters))
+        return self._dependencies[name]
+
+    def evaluate(self, name: str, **parameters):
+        """ result of the stage name, parameters override the default values """
+        values = {**self.parameters, **parameters}
+        key = (name,) + tuple(values[parameter] for parameter in self.dependencies(name))
+        if key in self._cache:
+            self.hits += 1
+            return self._cache[key]
+        stage = self.stages[name]
+        inputs = [self.evaluate(input_name, **values) for input_name in stage.inputs]
+        result = stage.function(*inputs, **{parameter: values[parameter] for parameter in stage.parameters})
+        self.evaluations[name] += 1
+        self._cache[key] = result
+        return result
+
+    def sweep(self, name: str, **ranges) -> list[tuple[dict, object]]:
+        """ evaluate the stage name for every combination of the values of ranges,
+        e.g. sweep('summary', sigma=[...], fix_period=[...]) """
+        names = list(ranges)
+        results = []
+        for values in itertools.product(*(ranges[parameter] for parameter in names)):
+            parameters = dict(zip(names, values))
+            results.append((parameters, self.evaluate(name, **parameters)))
+        return results
+
+    def sweep_info(self) -> SweepInfo:
+        return SweepInfo(dict(self.evaluations), self.hits)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+def leg_track(start: np.ndarray, waypoint: np.ndarray, water_speed: float, tide_course: float,
+              tide_speed: float, fix_period: float) -> np.ndarray:
+    """ (N, 2) true positions of the fixes from start to waypoint, as go_to_waypoint
+    without fix error: course to steer against the tide, one fix per fix_period """
+    vector = waypoint - start
+    distance = np.hypot(*vector)
+    course = np.arctan2(vector[0], vector[1])
+    ground_speed = route_planner.ground_speeds(water_speed, tide_course, tide_speed, [course])[0]
+    if ground_speed <= 0:
+        raise ValueError(f'the tide ({tide_speed} at {tide_course}) can not be stemmed at {water_speed}')
+    run = ground_speed * fix_period
+    steps = np.arange(1, int(np.ceil(distance / run)) + 1) * run
+    return start + np.minimum(steps, distance)[:, None] * (vector / distance)
+
+
+def leg_summary(track: np.ndarray, errors: np.ndarray, fix_period: float) -> dict[str, float]:
+    return {'fixes': len(track), 'duration': len(track) * fix_period,
+            'mean_error': float(np.mean(errors)), 'max_error': float(np.max(errors))}
+
+
+def leg_engine(marks_map: nav.MarksMap, start, waypoint, number_of_marks: int = 6, **parameters) -> SweepEngine:
+    """ SweepEngine of the leg start -> waypoint among the fixed marks of marks_map,
+    parameters: sigma, fix_period, water_speed, tide_course, tide_speed """
+    start = np.asarray(start, dtype=float)
+    waypoint = np.asarray(waypoint, dtype=float)
+    stages = {
+        'geometry': Stage(lambda: np.array([mark.position for mark in marks_map.fixed_marks]).reshape(-1, 2)),
+        'track': Stage(lambda **values: leg_track(start, waypoint, **values),
+                       ('water_speed', 'tide_course', 'tide_speed', 'fix_period')),
+        'ranges': Stage(lambda geometry, track: route_planner.mark_ranges(track, geometry, number_of_marks),
+                        inputs=('geometry', 'track')),
+        'selection': Stage(lambda ranges: route_planner.best_triple_costs(*ranges), inputs=('ranges',)),
+        'errors': Stage(lambda costs, sigma: sigma * np.sqrt(costs), ('sigma',), ('selection',)),
+        'summary': Stage(leg_summary, ('fix_period',), ('track', 'errors')),
+    }
+    defaults = {'sigma': nav.SIGMA, 'fix_period': nav.FIX_PERIOD, 'water_speed': 1.0,
+                'tide_course': 0.0, 'tide_speed': 0.0}
+    return SweepEngine(stages, **{**defaults, **parameters})
+
+
+def main():
+    marks_map = nav.MarksMap()
+    for mark in [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                 nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                 nav.Mark([100.0, 100.0], 'church'), nav.Mark([700.0, 400.0], 'major_lighthouse')]:
+        marks_map.append_mark(mark)
+    engine = leg_engine(marks_map, [120.0, 130.0], [480.0, 470.0], water_speed=5.0,
+                        tide_course=np.pi/2, tide_speed=1.0, fix_period=0.1)
+    sigmas = np.radians([0.5, 1, 2, 3, 5])
+    start = time.perf_counter()
+    results = engine.sweep('summary', sigma=sigmas, fix_period=[0.05, 0.1, 0.2],
+                           tide_speed=[0.0, 1.0, 2.0])
+    elapsed = time.perf_counter() - start
+    for parameters, summary in results:
+        if parameters['fix_period'] == 0.1 and parameters['tide_speed'] == 1.0:
+            print(f"sigma {np.degrees(parameters['sigma']):.1f} degree: {summary['fixes']} fixes, "
+                  f"mean error {summary['mean_error']:.2f}, max error {summary['max_error']:.2f}")
+    print(f'{len(results)} points in {elapsed*1000:.1f} ms, stage evaluations {engine.sweep_info().evaluations}')
+
+
+if __name__ == "__main__":
+
+    main()
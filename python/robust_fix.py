@@ -0,0 +1,132 @@
+# %%
+""" Robust fix from all the bearings, with rejection of the wrong ones.
+
+With 2 or 3 bearings a misidentified mark or a blunder moves the fix, and is
+only noticed when the error polygones do not intersect. robust_fix uses all the
+bearings of the near marks:
+    1. every pair of LOP gives a hypothesis, the intersection of the two LOP,
+       all the pairs are intersected in one vectorized pass (fleet.lop_intersection)
+    2. the bearing residuals of every mark from every hypothesis are one
+       (pairs, k) array: a mark is an inlier of a hypothesis when the hypothesis
+       is inside its error wedge, |residual| <= threshold (sigma by default)
+    3. the hypothesis with the most inliers wins, ties go to the smallest sum of
+       the squared residuals of its inliers
+    4. the fix is refitted on the inliers by weighted least squares of the
+       distances to their LOP, weighted by 1 / range**2 (the same angular error
+       at every mark), and the inliers are taken again from the refitted fix
+For k marks there are k*(k-1)/2 hypotheses and k*k*(k-1)/2 residuals, for the 6
+near marks of go_to_waypoint 15 hypotheses, fewer polygones than the 20
+triples of get_3best_marks and no GEOS call. """
+import logging
+import math
+import time
+from collections import namedtuple
+from itertools import combinations
+import numpy as np
+import navigation as nav
+from fleet import lop_intersection
+
+RobustFix = namedtuple('RobustFix', ['position', 'inliers', 'residuals', 'hypotheses'])
+RobustFix.__doc__ = """ fixed position (2,), inliers (k,) bool, bearing residuals (k,) from the
+position (radian), number of pair hypotheses evaluated """
+
+
+def bearing_residuals(points: np.ndarray, marks: np.ndarray, bearings: np.ndarray) -> np.ndarray:
+    """ (N, k) observed bearings of marks (k, 2) minus their bearings from points (N, 2),
+    in [-pi, pi) """
+    expected = np.arctan2(marks[None, :, 0] - points[:, None, 0], marks[None, :, 1] - points[:, None, 1])
+    return np.mod(bearings[None, :] - expected + np.pi, 2 * np.pi) - np.pi
+
+
+def weighted_fit(marks: np.ndarray, bearings: np.ndarray, position: np.ndarray, iterations: int = 2) -> np.ndarray:
+    """ point minimizing the sum of the squared distances to the LOP of marks divided
+    by the squared ranges, the ranges are taken from position then from the fit """
+    normals = np.column_stack([np.cos(bearings), -np.sin(bearings)])
+    offsets = np.einsum('ij,ij->i', normals, marks)
+    for _ in range(iterations):
+        ranges = np.hypot(marks[:, 0] - position[0], marks[:, 1] - position[1])
+        weights = 1 / np.maximum(ranges, 1e-9) ** 2
+        matrix = (normals * weights[:, None]).T @ normals
+        if abs(np.linalg.det(matrix)) < 1e-12 * np.trace(matrix) ** 2:
+            break
+        position = np.linalg.solve(matrix, (normals * weights[:, None]).T @ offsets)
+    return position
+
+
+def robust_fix(marks, bearings, sigma: float = nav.SIGMA, threshold: float = None) -> RobustFix:
+    """ consensus fix from the bearings (k,) of marks (k, 2), k >= 2, threshold the
+    largest residual of an inlier (default sigma, the half angle of the wedges) """
+    marks = np.asarray(marks, dtype=float).reshape(-1, 2)
+    bearings = np.asarray(bearings, dtype=float)
+    if len(marks) < 2 or len(marks) != len(bearings):
+        raise ValueError(f'{len(marks)} marks and {len(bearings)} bearings, at least 2 of each are needed')
+    threshold = sigma if threshold is None else threshold
+    first, second = np.array(list(combinations(range(len(marks)), 2))).T
+    hypotheses = lop_intersection(marks[first], bearings[first], marks[second], bearings[second])
+    residuals = bearing_residuals(hypotheses, marks, bearings)
+    with np.errstate(invalid='ignore'):
+        inliers = np.abs(residuals) <= threshold
+    counts = inliers.sum(axis=1)
+    scores = np.where(inliers, residuals ** 2, 0.0).sum(axis=1)
+    valid = np.isfinite(hypotheses).all(axis=1)
+    if not valid.any():
+        logging.warning('robust fix: all the LOP are parallel')
+        return RobustFix(np.full(2, np.nan), np.zeros(len(marks), dtype=bool), np.full(len(marks), np.nan),
+                         len(hypotheses))
+    order = np.lexsort((scores, -counts, ~valid))
+    best = order[0]
+    inlier = inliers[best]
+    position = hypotheses[best]
+    if inlier.sum() >= 2:
+        position = weighted_fit(marks[inlier], bearings[inlier], position)
+        final = bearing_residuals(position[None], marks, bearings)[0]
+        refitted = np.abs(final) <= threshold
+        if refitted.sum() >= inlier.sum():
+            inlier = refitted
+    residual = bearing_residuals(position[None], marks, bearings)[0]
+    if inlier.sum() < len(marks):
+        logging.info('robust fix: %s of %s bearings rejected', len(marks) - int(inlier.sum()), len(marks))
+    return RobustFix(position, inlier, residual, len(hypotheses))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    mark_table = [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                  nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                  nav.Mark([100.0, 100.0], 'church'), nav.Mark([700.0, 400.0], 'major_lighthouse')]
+    rng = np.random.default_rng(0)
+    boats = rng.uniform(150.0, 450.0, (300, 2))
+    noise = np.pi / 360
+    errors = {'best triple': [], 'robust': []}
+    timings = {'best triple': 0.0, 'robust': 0.0}
+    rejected = 0
+    for boat in boats:
+        boat_simu = nav.BoatSimu(boat, boat)
+        true_bearings = np.array([math.atan2(mark.position[0] - boat[0], mark.position[1] - boat[1])
+                                  for mark in mark_table])
+        bearings = true_bearings + rng.normal(0.0, noise, len(mark_table))
+        # one blunder: a bearing 20 degree off
+        blunder = rng.integers(len(mark_table))
+        bearings[blunder] += np.radians(20)
+        start = time.perf_counter()
+        marks = boat_simu.get_3best_marks(mark_table)
+        chosen = [mark_table.index(mark) for mark in marks]
+        boat_simu.compute_position_3lop(*marks, show_lop=False, show_area=False)
+        timings['best triple'] += time.perf_counter() - start
+        # the selection is made on the geometry, the same triple is fixed with the observed bearings
+        observed = robust_fix([mark_table[i].position for i in chosen], bearings[chosen], boat_simu.sigma, np.inf)
+        errors['best triple'].append(math.dist(observed.position, boat))
+        start = time.perf_counter()
+        fix = boat_simu.compute_position_robust(mark_table, show_lop=False, show_area=False, bearings=bearings)
+        timings['robust'] += time.perf_counter() - start
+        errors['robust'].append(math.dist(fix, boat))
+        rejected += not boat_simu.fix_inliers[blunder]
+    for name in errors:
+        print(f'{name:11s}: {timings[name] / len(boats) * 1000:.2f} ms per fix, median error '
+              f'{np.median(errors[name]):.2f}, 95 % error {np.percentile(errors[name], 95):.2f}')
+    print(f'blunder rejected in {rejected} of {len(boats)} fixes')
+
+
+if __name__ == "__main__":
+
+    main()
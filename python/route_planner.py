@@ -0,0 +1,282 @@
+# %%
+""" Route planning over the chart extent.
+
+The extent is covered by a regular lattice of nodes linked to their 8
+neighbours. Everything the search needs is computed once as arrays when the
+planner is built:
+    - blocked nodes, closer than clearance to a danger mark (DANGERS_SET types),
+      and edges passing closer than clearance to a danger between their nodes,
+    - expected fix error at every node, sigma * sqrt of the wedge area model
+      cost of the best triple of near fixed marks (fleet.best_triples),
+    - ground speed along the 8 directions given the water speed and the tide,
+    - edge costs (N, 8) combining distance, time and fix error.
+plan() is then an A* search whose inner loop only reads these arrays. The path
+is simplified into legs, and a leg keeps the intermediate lattice nodes of the
+path where the shortcut would pass closer than clearance to a danger. """
+import heapq
+import time
+import numpy as np
+import navigation as nav
+from danger_corridor import DangerIndex
+from fleet import best_triples
+
+# the 8 neighbours of a lattice node (column, row steps)
+DIRECTIONS : tuple[tuple[int, int], ...] = ((1, 0), (1, 1), (0, 1), (-1, 1),
+                                            (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+
+def danger_mask(points: np.ndarray, dangers: np.ndarray, clearance: float, chunk_size: int = 4096) -> np.ndarray:
+    """ (N,) True for the points (N, 2) closer than clearance to a danger (M, 2) """
+    blocked = np.zeros(len(points), dtype=bool)
+    if len(dangers) == 0:
+        return blocked
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        distances = np.hypot(chunk[:, None, 0] - dangers[None, :, 0], chunk[:, None, 1] - dangers[None, :, 1])
+        blocked[start:start + len(chunk)] = (distances < clearance).any(axis=1)
+    return blocked
+
+
+def mark_ranges(points: np.ndarray, marks: np.ndarray, number_of_marks: int = 6,
+                with_index: bool = False) -> tuple[np.ndarray, ...]:
+    """ (N, k) ranges and bearings from the points (N, 2) of their k nearest marks (M, 2),
+    nearest first, followed by the (N, k) indices of these marks when with_index """
+    vector_x = marks[None, :, 0] - points[:, None, 0]
+    vector_y = marks[None, :, 1] - points[:, None, 1]
+    distances = np.hypot(vector_x, vector_y)
+    nearest = np.argsort(distances, axis=1)[:, :min(number_of_marks, len(marks))]
+    bearing = np.arctan2(np.take_along_axis(vector_x, nearest, axis=1), np.take_along_axis(vector_y, nearest, axis=1))
+    if with_index:
+        return np.take_along_axis(distances, nearest, axis=1), bearing, nearest
+    return np.take_along_axis(distances, nearest, axis=1), bearing
+
+
+def best_triple_costs(distance: np.ndarray, bearing: np.ndarray) -> np.ndarray:
+    """ (N,) wedge area model cost of the best triple among the marks at ranges and
+    bearings (N, k) (fleet.best_triples), inf when k < 3. The fix error is about
+    sigma * sqrt(cost), the best triple does not depend on sigma """
+    return best_triples(distance, bearing)[0]
+
+
+def fix_error_map(points: np.ndarray, marks: np.ndarray, sigma: float, number_of_marks: int = 6,
+                  chunk_size: int = 4096) -> np.ndarray:
+    """ (N,) expected 3 LOP fix error at the points (N, 2) from the fixed marks (M, 2),
+    inf where less than 3 marks are available """
+    errors = np.full(len(points), np.inf)
+    if len(marks) < 3:
+        return errors
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        costs = best_triple_costs(*mark_ranges(chunk, marks, number_of_marks))
+        errors[start:start + len(chunk)] = sigma * np.sqrt(costs)
+    return errors
+
+
+def ground_speeds(water_speed: float, tide_course: float, tide_speed: float, courses) -> np.ndarray:
+    """ ground speed along each ground course, as Boat.update_course_to_steer,
+    0 where the tide can not be compensated or pushes the boat backward """
+    courses = np.asarray(courses, dtype=float)
+    cross = np.sin(tide_course - courses) * tide_speed
+    along = np.cos(tide_course - courses) * tide_speed
+    with np.errstate(invalid='ignore'):
+        speed = along + np.sqrt(water_speed**2 - cross**2)
+    return np.where((np.abs(cross) <= water_speed) & (speed > 0), speed, 0.0)
+
+
+class RoutePlanner:
+    """ A* route planner on a lattice over extent (x_min, x_max, y_min, y_max).
+    The cost of a leg is
+        distance_weight * length + time_weight * length / ground_speed
+        + fix_weight * length * expected fix error
+    nodes and legs closer than clearance to a danger mark are never crossed """
+    def __init__(self, marks_map: nav.MarksMap, extent: tuple[float, float, float, float],
+                 resolution: float, clearance: float, sigma: float = nav.SIGMA,
+                 water_speed: float = 1.0, tide_course: float = 0.0, tide_speed: float = 0.0,
+                 distance_weight: float = 1.0, time_weight: float = 0.0, fix_weight: float = 0.0,
+                 number_of_marks: int = 6):
+        self.extent = extent
+        self.resolution = resolution
+        self.clearance = clearance
+        self.weights = (distance_weight, time_weight, fix_weight)
+        x_min, x_max, y_min, y_max = extent
+        self.grid_x = np.arange(x_min, x_max + resolution / 2, resolution)
+        self.grid_y = np.arange(y_min, y_max + resolution / 2, resolution)
+        self.shape = (len(self.grid_y), len(self.grid_x))
+        mesh_x, mesh_y = np.meshgrid(self.grid_x, self.grid_y)
+        self.points = np.column_stack([mesh_x.ravel(), mesh_y.ravel()])
+
+        self.danger_index = DangerIndex(marks_map)
+        dangers = self.danger_index.positions
+        fixed_marks = np.array([mark.position for mark in marks_map.fixed_marks]).reshape(-1, 2)
+        self.blocked = danger_mask(self.points, dangers, clearance)
+        self.fix_error = fix_error_map(self.points, fixed_marks, sigma, number_of_marks)
+
+        courses = np.array([np.arctan2(column, row) for column, row in DIRECTIONS])
+        lengths = np.array([np.hypot(column, row) for column, row in DIRECTIONS]) * resolution
+        self.speeds = ground_speeds(water_speed, tide_course, tide_speed, courses)
+        self.neighbours, self.costs = self._edges(lengths)
+        self._max_speed = self.speeds.max()
+        # python lists are much faster than numpy scalars in the search loop
+        self._adjacency = [[(neighbour, cost) for neighbour, cost in zip(neighbours, costs) if neighbour >= 0]
+                           for neighbours, costs in zip(self.neighbours.tolist(), self.costs.tolist())]
+
+    def _edges(self, lengths: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ (N, 8) neighbour node and cost of every edge, -1 and inf for the missing ones """
+        rows, columns = np.divmod(np.arange(len(self.points)), self.shape[1])
+        neighbours = np.full((len(self.points), len(DIRECTIONS)), -1, dtype=np.int64)
+        costs = np.full((len(self.points), len(DIRECTIONS)), np.inf)
+        distance_weight, time_weight, fix_weight = self.weights
+        for k, (column_step, row_step) in enumerate(DIRECTIONS):
+            row, column = rows + row_step, columns + column_step
+            inside = (row >= 0) & (row < self.shape[0]) & (column >= 0) & (column < self.shape[1])
+            target = np.where(inside, row * self.shape[1] + column, 0)
+            valid = inside & ~self.blocked & ~self.blocked[target]
+            if len(self.danger_index):
+                # an edge between two clear nodes can still pass within clearance of a danger
+                edges = np.flatnonzero(valid)
+                legs, _, _ = self.danger_index.query(self.points[edges], self.points[target[edges]], self.clearance)
+                valid[edges[legs]] = False
+            if self.speeds[k] <= 0 and time_weight > 0:
+                # this course can not be sailed against the tide
+                costs[:, k] = np.inf
+                continue
+            cost = distance_weight * lengths[k]
+            if time_weight > 0:
+                cost = cost + time_weight * lengths[k] / self.speeds[k]
+            if fix_weight > 0:
+                cost = cost + fix_weight * lengths[k] * (self.fix_error + self.fix_error[target]) / 2
+            neighbours[valid, k] = target[valid]
+            costs[:, k] = np.where(valid, cost, np.inf)
+        costs[~np.isfinite(costs)] = np.inf
+        return neighbours, costs
+
+    def node(self, position) -> int:
+        """ index of the lattice node nearest to position """
+        column = int(np.clip(round((position[0] - self.grid_x[0]) / self.resolution), 0, self.shape[1] - 1))
+        row = int(np.clip(round((position[1] - self.grid_y[0]) / self.resolution), 0, self.shape[0] - 1))
+        return row * self.shape[1] + column
+
+    def _heuristic(self, goal_position: np.ndarray):
+        """ admissible A* heuristic: octile distance on the lattice and time at the
+        best ground speed """
+        distance_weight, time_weight, _ = self.weights
+        factor = distance_weight + (time_weight / self._max_speed if time_weight > 0 and self._max_speed > 0 else 0.0)
+        delta = np.abs(self.points - goal_position)
+        octile = delta.max(axis=1) + (np.sqrt(2) - 1) * delta.min(axis=1)
+        return factor * octile
+
+    def search(self, start: int, goal: int) -> list[int]:
+        """ nodes of the cheapest path from start to goal, [] when there is none """
+        if self.blocked[start] or self.blocked[goal]:
+            return []
+        if self.weights[1] > 0 and self._max_speed <= 0:
+            # the tide can not be stemmed in any direction, no edge can be sailed
+            return []
+        heuristic = self._heuristic(self.points[goal]).tolist()
+        adjacency = self._adjacency
+        best = {start: 0.0}
+        previous = {start: -1}
+        queue = [(heuristic[start], 0.0, start)]
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            if cost > best[node]:
+                continue
+            for neighbour, edge_cost in adjacency[node]:
+                new_cost = cost + edge_cost
+                if new_cost < best.get(neighbour, np.inf):
+                    best[neighbour] = new_cost
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_cost + heuristic[neighbour], new_cost, neighbour))
+        if goal not in previous:
+            return []
+        path = [goal]
+        while previous[path[-1]] >= 0:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def leg_is_clear(self, start, end) -> bool:
+        """ the leg start-end passes at least clearance from every danger """
+        return len(self.danger_index.query(start, end, self.clearance)[0]) == 0
+
+    def plan(self, start_position, goal_position, tolerance: float = None) -> nav.Route:
+        """ Route from start_position to goal_position. The lattice path is simplified
+        (see simplify_path) with tolerance, default the lattice resolution, so the legs
+        stay within tolerance of the cheapest path and clear of the dangers """
+        if self.weights[1] > 0 and self._max_speed <= 0:
+            raise ValueError('no route: the ground speed is 0 along every course of the lattice')
+        path = self.search(self.node(start_position), self.node(goal_position))
+        if not path:
+            raise ValueError(f'no safe route from {start_position} to {goal_position} '
+                             f'with a clearance of {self.clearance}')
+        points = self.points[path]
+        points[0], points[-1] = start_position, goal_position
+        tolerance = self.resolution if tolerance is None else tolerance
+        route = nav.Route()
+        for index in simplify_path(points, tolerance, self.leg_is_clear):
+            route.append_waypoint(nav.Waypoint(points[index].tolist()))
+        return route
+
+    def path_cost(self, path: list[int]) -> float:
+        """ cost of a path of neighbour nodes """
+        path = np.asarray(path)
+        edges = self.neighbours[path[:-1]] == path[1:, None]
+        return float(self.costs[path[:-1]][edges].sum())
+
+
+def simplify_path(points: np.ndarray, tolerance: float, is_clear=None) -> list[int]:
+    """ indices of the points (N, 2) kept by the Douglas-Peucker simplification:
+    every removed point is within tolerance of the kept polyline. is_clear(start, end)
+    -> bool, when given, also keeps the farthest intermediate point of a shortcut
+    that is not clear, down to the original segments """
+    keep = [0, len(points) - 1] if len(points) > 1 else [0]
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        offsets = points[first + 1:last] - points[first]
+        length = np.hypot(*segment)
+        if length == 0:
+            deviation = np.hypot(*offsets.T)
+        else:
+            deviation = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(deviation))
+        if deviation[farthest] > tolerance or (is_clear is not None and not is_clear(points[first], points[last])):
+            middle = first + 1 + farthest
+            keep.append(middle)
+            stack += [(first, middle), (middle, last)]
+    return sorted(keep)
+
+def main():
+    plt = nav.plt
+    marks_map = nav.MarksMap()
+    for mark in [nav.Mark([100.0, 500.0], 'church'), nav.Mark([250.0, 510.0], 'lighthouse'),
+                 nav.Mark([500.0, 500.0], 'land_tower'), nav.Mark([500.0, 100.0], 'water_tower'),
+                 nav.Mark([100.0, 100.0], 'church'), nav.Mark([300.0, 300.0], 'wreck'),
+                 nav.Mark([250.0, 200.0], 'rock_covers'), nav.Mark([380.0, 380.0], 'danger')]:
+        marks_map.append_mark(mark)
+    start = time.perf_counter()
+    planner = RoutePlanner(marks_map, (0, 600, 0, 600), resolution=2.0, clearance=40.0,
+                           water_speed=5, tide_course=np.pi/2, tide_speed=2,
+                           time_weight=5.0, fix_weight=1.0)
+    built = time.perf_counter()
+    route = planner.plan([120.0, 130.0], [480.0, 470.0])
+    planned = time.perf_counter()
+    print(f'{planner.shape[0]}x{planner.shape[1]} lattice built in {built - start:.2f} s, '
+          f'route of {route.number_of_waypoint} waypoints planned in {planned - built:.3f} s')
+    plt.figure(1)
+    plt.imshow(np.where(planner.blocked, np.nan, planner.fix_error).reshape(planner.shape),
+               origin='lower', extent=planner.extent, cmap='viridis_r')
+    plt.colorbar(label='expected fix error')
+    marks_map.plot_map()
+    route.plot_route()
+    plt.title('route avoiding dangers, cost = distance + time + fix error')
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    main()
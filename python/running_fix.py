@@ -0,0 +1,167 @@
+# %%
+""" Sliding window running fix over the last k bearings.
+
+BoatSimu.run_fix crosses two bearings of one mark taken fix_period apart: the
+first LOP is carried forward by the dead reckoned run (a shifted Mark) and the
+two wedges are intersected with shapely. SlidingRunningFix keeps the last
+window bearings, of one or several marks, and the position is the weighted least
+squares point of all their LOP, each carried forward by the run since it was
+taken.
+
+A bearing b of mark m taken when the boat was at p - D (D the run since then)
+is the line n.(p - D - m) = 0, n = (cos b, -sin b). With S the total run since
+the start and s the total run when the bearing was taken, D = S - s, so
+
+    A = sum w n n^T        c = sum w n (n.(m - s))        p = A^-1 c + S
+
+A and c do not change when the boat runs, only S does: a run is O(1), a new
+bearing adds its terms and the bearing leaving the window subtracts its terms,
+O(1) as well, and the 2x2 system is solved in closed form. The weights are
+1 / range**2 (the same angular error for every bearing), so the covariance of
+the position is sigma**2 A^-1. The sums are rebuilt from the window every
+window bearings so that the rounding errors of the subtractions do not pile up. """
+import logging
+import math
+import time
+from collections import deque, namedtuple
+import numpy as np
+import navigation as nav
+
+Observation = namedtuple('Observation', ['mark', 'bearing', 'run', 'weight'])
+Observation.__doc__ = """ mark position (x, y), bearing (radian), total run (x, y) when the
+bearing was taken and weight (1 / range**2) """
+
+
+class SlidingRunningFix:
+    """ running fix from the last window bearings, sigma the bearing error (radian) """
+    def __init__(self, window: int = 8, sigma: float = nav.SIGMA):
+        if window < 2:
+            raise ValueError(f'a running fix needs a window of at least 2 bearings, not {window}')
+        self.window = window
+        self.sigma = sigma
+        self.observations : deque[Observation] = deque()
+        # total run since the start
+        self.run_x = 0.0
+        self.run_y = 0.0
+        # sums of A (symmetric) and c
+        self._a = [0.0, 0.0, 0.0]
+        self._c = [0.0, 0.0]
+        self._removed = 0
+
+    def _accumulate(self, observation: Observation, sign: float) -> None:
+        normal_x, normal_y = math.cos(observation.bearing), -math.sin(observation.bearing)
+        weight = sign * observation.weight
+        offset = (normal_x * (observation.mark[0] - observation.run[0])
+                  + normal_y * (observation.mark[1] - observation.run[1]))
+        self._a[0] += weight * normal_x * normal_x
+        self._a[1] += weight * normal_x * normal_y
+        self._a[2] += weight * normal_y * normal_y
+        self._c[0] += weight * normal_x * offset
+        self._c[1] += weight * normal_y * offset
+
+    def _rebuild(self) -> None:
+        self._a = [0.0, 0.0, 0.0]
+        self._c = [0.0, 0.0]
+        for observation in self.observations:
+            self._accumulate(observation, 1.0)
+        self._removed = 0
+
+    def advance(self, displacement) -> None:
+        """ dead reckoned run (x, y) of the boat since the last call """
+        self.run_x += displacement[0]
+        self.run_y += displacement[1]
+
+    def observe(self, mark_position, bearing: float, position) -> None:
+        """ bearing of the mark at mark_position taken now, position the estimated
+        position of the boat (for the range of the weight) """
+        distance = max(math.dist(mark_position, position), 1e-9)
+        observation = Observation((float(mark_position[0]), float(mark_position[1])), float(bearing),
+                                  (self.run_x, self.run_y), 1 / distance ** 2)
+        self.observations.append(observation)
+        self._accumulate(observation, 1.0)
+        if len(self.observations) > self.window:
+            self._accumulate(self.observations.popleft(), -1.0)
+            self._removed += 1
+            if self._removed >= self.window:
+                self._rebuild()
+
+    def _determinant(self) -> float:
+        return self._a[0] * self._a[2] - self._a[1] * self._a[1]
+
+    def solvable(self) -> bool:
+        """ at least two LOP of the window are not parallel """
+        trace = self._a[0] + self._a[2]
+        return len(self.observations) >= 2 and self._determinant() > 1e-10 * trace * trace
+
+    def position(self) -> list[float] | None:
+        """ current position, None when the window LOP are all parallel """
+        if not self.solvable():
+            return None
+        determinant = self._determinant()
+        x = (self._a[2] * self._c[0] - self._a[1] * self._c[1]) / determinant
+        y = (self._a[0] * self._c[1] - self._a[1] * self._c[0]) / determinant
+        return [x + self.run_x, y + self.run_y]
+
+    def covariance(self) -> np.ndarray | None:
+        """ (2, 2) covariance of the position, sigma**2 A^-1 """
+        if not self.solvable():
+            return None
+        determinant = self._determinant()
+        return self.sigma ** 2 * np.array([[self._a[2], -self._a[1]], [-self._a[1], self._a[0]]]) / determinant
+
+    def area(self) -> float:
+        """ area of the one sigma error ellipse, inf when not solvable """
+        if not self.solvable():
+            return math.inf
+        return math.pi * self.sigma ** 2 / math.sqrt(self._determinant())
+
+    def clear(self) -> None:
+        self.observations.clear()
+        self._rebuild()
+
+
+def main():
+    logging.disable(logging.WARNING)
+    rng = np.random.default_rng(0)
+    mark_table = [nav.Mark([300.0, 500.0], 'lighthouse'), nav.Mark([600.0, 300.0], 'land_tower')]
+    course, speed, fix_period, steps = np.radians(60), 5.0, 1.0, 200
+    noise = np.pi / 360
+    velocity = speed * np.array([np.sin(course), np.cos(course)])
+    for window in (2, 4, 8, 16):
+        for marks in (mark_table[:1], mark_table):
+            running = SlidingRunningFix(window)
+            position = np.array([100.0, 100.0])
+            errors = []
+            start = time.perf_counter()
+            for step in range(steps):
+                position = position + velocity * fix_period
+                running.advance(velocity * fix_period)
+                mark = marks[step % len(marks)]
+                bearing = math.atan2(mark.position[0] - position[0], mark.position[1] - position[1])
+                running.observe(mark.position, bearing + rng.normal(0.0, noise), position)
+                estimate = running.position()
+                if estimate is not None and step >= window:
+                    errors.append(math.dist(estimate, position))
+            elapsed = time.perf_counter() - start
+            print(f'window {window:2d}, {len(marks)} mark(s): {elapsed / steps * 1e6:.1f} us per bearing, '
+                  f'median error {np.median(errors):.2f}, 95 % error {np.percentile(errors, 95):.2f}')
+    boat_simu = nav.BoatSimu([100.0, 100.0], [100.0, 100.0], fix_period=fix_period)
+    for boat in (boat_simu.boat_true, boat_simu.boat_estimate):
+        boat.ground_track.course = boat.water_track.course = course
+        boat.ground_track.speed = speed
+    start = time.perf_counter()
+    for _ in range(steps):
+        boat_simu.update_window_fix(mark_table, fix_period, window=8)
+    elapsed = time.perf_counter() - start
+    print(f'BoatSimu.update_window_fix: {elapsed / steps * 1e6:.1f} us per fix, error '
+          f'{math.dist(boat_simu.boat_true.position, boat_simu.boat_estimate.position):.2e}')
+    start = time.perf_counter()
+    for _ in range(steps):
+        boat_simu.run_fix(mark_table[0], fix_period, boat_simu.sigma, False)
+    elapsed = time.perf_counter() - start
+    print(f'BoatSimu.run_fix: {elapsed / steps * 1e6:.1f} us per fix')
+
+
+if __name__ == "__main__":
+
+    main()
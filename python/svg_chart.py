@@ -0,0 +1,282 @@
+# %%
+""" Streaming SVG chart writer.
+
+Marks, routes, tracks, boats, LOP and error areas are written straight to an
+SVG file without building a matplotlib figure. Each symbol (mark type with its
+topmark, colours and light, boat, track arrows) is converted once from the
+BuildPath vertices and codes to a <symbol> and then placed with <use>, so a
+chart of thousands of marks stays small and costs only string formatting. The
+layers of a mark symbol are the markers PlotMark plots, recorded by
+LayerRecorder in place of pyplot, so both draw the same marks.
+The elements are written as they are added, the <defs> of the symbols used are
+written by close().
+
+Symbols keep the matplotlib marker conventions: a marker path is scaled so that
+its largest coordinate is half of markersize, in points. """
+import math
+import time
+from collections import namedtuple
+from html import escape
+import numpy as np
+from matplotlib import colors as mcolors, rcParams
+from matplotlib.markers import MarkerStyle
+from matplotlib.path import Path
+import nautical_marker as marker
+import navigation as nav
+
+# one filled/stroked marker path of a symbol, size is the matplotlib markersize
+Layer = namedtuple('Layer', ['path', 'facecolor', 'edgecolor', 'linewidth', 'size'])
+
+BOAT_PATH : Path = Path([(-2, 1), (1, 2), (3, 0), (1, -2), (-2, -1), (-2, 1)], [1, 3, 2, 3, 1, 79])
+
+
+def svg_color(color) -> str:
+    """ matplotlib color to svg color """
+    if color is None or (isinstance(color, str) and color.lower() == 'none'):
+        return 'none'
+    return mcolors.to_hex(color)
+
+
+def path_data(path: Path, scale: float = 1.0) -> str:
+    """ svg path data of a matplotlib path, y axis flipped """
+    commands = []
+    for vertices, code in path.iter_segments(simplify=False, curves=True):
+        points = ' '.join(f'{x * scale:.3g},{-y * scale:.3g}' for x, y in vertices.reshape(-1, 2))
+        match code:
+            case Path.MOVETO:
+                commands.append('M' + points)
+            case Path.LINETO:
+                commands.append('L' + points)
+            case Path.CURVE3:
+                commands.append('Q' + points)
+            case Path.CURVE4:
+                commands.append('C' + points)
+            case Path.CLOSEPOLY:
+                commands.append('Z')
+    return ''.join(commands)
+
+
+def marker_path(path: Path) -> Path:
+    """ path normalized as a matplotlib marker: largest coordinate 0.5 """
+    rescale = np.max(np.abs(path.vertices)) if len(path.vertices) else 1.0
+    return Path(path.vertices * (0.5 / rescale), path.codes)
+
+
+class LayerRecorder:
+    """ pyplot of a PlotMark (nautical_marker): the markers it plots are recorded
+    as layers instead of drawn """
+    def __init__(self):
+        self.layers : list[Layer] = []
+
+    def plot(self, x, y, marker=None, markersize: float = None, markerfacecolor=None, markeredgecolor=None,
+             markeredgewidth: float = None, fillstyle: str = None, **kwargs) -> None:
+        """ as pyplot.plot, the colors not given are the first color of the property cycle """
+        style = MarkerStyle(marker, fillstyle)
+        line_color = rcParams['axes.prop_cycle'].by_key()['color'][0]
+        facecolor = 'none' if not style.is_filled() else line_color if markerfacecolor is None else markerfacecolor
+        self.layers.append(Layer(style.get_path().transformed(style.get_transform()), facecolor,
+                                 line_color if markeredgecolor is None else markeredgecolor,
+                                 rcParams['lines.markeredgewidth'] if markeredgewidth is None else markeredgewidth,
+                                 rcParams['lines.markersize'] if markersize is None else markersize))
+
+    def text(self, *args, **kwargs) -> None:
+        """ names are written by SvgChartWriter.add_text """
+
+
+def mark_layers(mark_type: str, top_mark_type: str = None, light_color: str = None,
+                floating: bool = False, show_top_mark: bool = True) -> list[Layer]:
+    """ layers of the symbol drawn by PlotMark for a mark, in its drawing order """
+    recorder = LayerRecorder()
+    marker.PlotMark(0.0, 0.0, mark_type, top_mark_type, light_color, None, floating, show_top_mark,
+                    pyplot=recorder)
+    return recorder.layers
+
+
+class SvgChartWriter:
+    """ Write a chart of extent (x_min, x_max, y_min, y_max) to target (file name
+    or text file), width in pixels, the height follows with an equal aspect """
+    def __init__(self, target, extent: tuple[float, float, float, float], width: float = 800,
+                 background: str = 'white', precision: int = 2):
+        self._own_file = isinstance(target, str)
+        self.file = open(target, 'w', encoding='utf-8') if self._own_file else target
+        self.extent = extent
+        self.scale = width / (extent[1] - extent[0])
+        self.width = width
+        self.height = (extent[3] - extent[2]) * self.scale
+        self.precision = precision
+        # symbol id of each symbol key, and its layers until written in <defs>
+        self._symbols : dict[tuple, str] = {}
+        self._layers : dict[str, list[Layer]] = {}
+        self.file.write(f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                        f'width="{width:.0f}" height="{self.height:.0f}" '
+                        f'viewBox="0 0 {width:.0f} {self.height:.0f}">\n')
+        if background is not None:
+            self.file.write(f'<rect width="100%" height="100%" fill="{svg_color(background)}"/>\n')
+
+    def xy(self, x, y) -> tuple:
+        """ pixel coordinates of data coordinates (scalars or arrays) """
+        return ((np.asarray(x) - self.extent[0]) * self.scale,
+                (self.extent[3] - np.asarray(y)) * self.scale)
+
+    def _points(self, x, y) -> str:
+        pixel_x, pixel_y = self.xy(x, y)
+        return ' '.join(f'{a:.{self.precision}f},{b:.{self.precision}f}'
+                        for a, b in zip(np.ravel(pixel_x), np.ravel(pixel_y)))
+
+    def _symbol(self, key: tuple, layers) -> str:
+        """ id of the symbol of key, layers is called the first time only """
+        symbol_id = self._symbols.get(key)
+        if symbol_id is None:
+            symbol_id = f's{len(self._symbols)}'
+            self._symbols[key] = symbol_id
+            self._layers[symbol_id] = layers()
+        return symbol_id
+
+    def _use(self, symbol_id: str, x: float, y: float, angle: float = 0.0) -> None:
+        pixel_x, pixel_y = self.xy(x, y)
+        rotation = f' rotate({angle:.1f})' if angle else ''
+        self.file.write(f'<use xlink:href="#{symbol_id}" transform="translate({pixel_x:.{self.precision}f},'
+                        f'{pixel_y:.{self.precision}f}){rotation}"/>\n')
+
+    def add_mark(self, mark: nav.Mark) -> None:
+        key = ('mark', mark.mark_type, mark.top_mark_type, mark.light_color, bool(mark.floating),
+               mark.show_top_mark is not False)
+        symbol_id = self._symbol(key, lambda: mark_layers(mark.mark_type, mark.top_mark_type, mark.light_color,
+                                                          mark.floating, mark.show_top_mark))
+        self._use(symbol_id, mark.position[0], mark.position[1])
+        if mark.name is not None:
+            self.add_text(mark.position[0] + marker.PlotMark.text_shift,
+                          mark.position[1] + marker.PlotMark.text_shift, mark.name)
+
+    def add_marks(self, marks) -> None:
+        """ add the marks of a MarksMap or of a list of marks """
+        for mark in marks.map_marks if isinstance(marks, nav.MarksMap) else marks:
+            self.add_mark(mark)
+
+    def add_text(self, x: float, y: float, text, color='k', size: float = 10, anchor: str = 'start') -> None:
+        pixel_x, pixel_y = self.xy(x, y)
+        self.file.write(f'<text x="{pixel_x:.{self.precision}f}" y="{pixel_y:.{self.precision}f}" '
+                        f'font-size="{size}" text-anchor="{anchor}" fill="{svg_color(color)}">'
+                        f'{escape(str(text))}</text>\n')
+
+    def add_line(self, x, y, color='k', linewidth: float = 1.0, dashed: bool = False) -> None:
+        """ polyline through x, y """
+        dash = ' stroke-dasharray="4,2"' if dashed else ''
+        self.file.write(f'<polyline points="{self._points(x, y)}" fill="none" stroke="{svg_color(color)}" '
+                        f'stroke-width="{linewidth}"{dash}/>\n')
+
+    def add_polygon(self, x, y, facecolor='none', edgecolor='g', linewidth: float = 1.0) -> None:
+        self.file.write(f'<polygon points="{self._points(x, y)}" fill="{svg_color(facecolor)}" '
+                        f'stroke="{svg_color(edgecolor)}" stroke-width="{linewidth}"/>\n')
+
+    def add_segments(self, segments: np.ndarray, color='k', linewidth: float = 0.5, dashed: bool = True) -> None:
+        """ (N, 2, 2) segments as a single path """
+        start_x, start_y = self.xy(segments[:, 0, 0], segments[:, 0, 1])
+        end_x, end_y = self.xy(segments[:, 1, 0], segments[:, 1, 1])
+        data = ''.join(f'M{a:.{self.precision}f},{b:.{self.precision}f}L{c:.{self.precision}f},{d:.{self.precision}f}'
+                       for a, b, c, d in zip(start_x, start_y, end_x, end_y))
+        dash = ' stroke-dasharray="4,2"' if dashed else ''
+        self.file.write(f'<path d="{data}" fill="none" stroke="{svg_color(color)}" '
+                        f'stroke-width="{linewidth}"{dash}/>\n')
+
+    def add_lop_batch(self, lop_batch: nav.LopBatch) -> None:
+        """ LOP and error areas collected by a LopBatch """
+        if lop_batch.bearings:
+            self.add_segments(nav.lop_segments(lop_batch.marks_position, lop_batch.bearings,
+                                               lop_batch.boats_position))
+        for area in lop_batch.areas:
+            self.add_polygon(area[:, 0], area[:, 1])
+
+    def add_route(self, route: nav.Route, color='b') -> None:
+        """ route legs and numbered waypoints, as Route.plot_route """
+        positions = np.array([waypoint.position for waypoint in route.route]).reshape(-1, 2)
+        self.add_line(positions[:, 0], positions[:, 1], color, linewidth=2)
+        symbol_id = self._symbol(('waypoint', svg_color(color)),
+                                 lambda: [Layer(Path.unit_circle(), color, color, 1.0, 15)])
+        for waypoint in route.route:
+            self._use(symbol_id, *waypoint.position)
+            self.add_text(*waypoint.position, waypoint.waypoint_number, color='w', anchor='middle')
+
+    def add_track(self, track: nav.Track) -> None:
+        """ track vector with its arrow symbol, as Track.plot_track """
+        x, y = track.start_position
+        end_x, end_y = x + track.speed * np.sin(track.course), y + track.speed * np.cos(track.course)
+        self.add_line([x, end_x], [y, end_y])
+        symbol_id = self._symbol(('track', track.track_type), lambda: [
+            Layer(marker.track_path(track.track_type, math.pi / 2), 'none', 'k', 1.0, track.markersize)])
+        self._use(symbol_id, (x + end_x) / 2, (y + end_y) / 2, math.degrees(track.course - math.pi / 2))
+
+    def add_boat(self, boat: nav.Boat) -> None:
+        """ boat symbol in the direction of the course, as Boat.plot_boat """
+        symbol_id = self._symbol(('boat', boat.color, boat.boat_size),
+                                 lambda: [Layer(BOAT_PATH, 'none', boat.color, 1.0, boat.boat_size)])
+        angle = 0.0 if boat.water_track.course is None else math.degrees(boat.water_track.course - math.pi / 2)
+        self._use(symbol_id, boat.position[0], boat.position[1], angle)
+
+    def add_boat_simu(self, boat_simu: nav.BoatSimu) -> None:
+        self.add_boat(boat_simu.boat_true)
+        self.add_boat(boat_simu.boat_estimate)
+
+    def _write_defs(self) -> None:
+        self.file.write('<defs>\n')
+        for symbol_id, layers in self._layers.items():
+            self.file.write(f'<symbol id="{symbol_id}" overflow="visible">\n')
+            for layer in layers:
+                # matplotlib markersize is in points, 1 pixel per point here
+                self.file.write(f'<path d="{path_data(marker_path(layer.path), layer.size)}" '
+                                f'fill="{svg_color(layer.facecolor)}" stroke="{svg_color(layer.edgecolor)}" '
+                                f'stroke-width="{layer.linewidth}"/>\n')
+            self.file.write('</symbol>\n')
+        self.file.write('</defs>\n')
+        self._layers.clear()
+
+    def close(self) -> None:
+        """ write the symbol definitions and end the document """
+        if self.file is None:
+            return
+        self._write_defs()
+        self.file.write('</svg>\n')
+        if self._own_file:
+            self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    import os
+    import tempfile
+    plt = nav.plt
+    rng = np.random.default_rng(0)
+    types = ['church', 'lighthouse', 'major_lighthouse', 'water_tower', 'wreck', 'rock_covers', 'danger']
+    marks = [nav.Mark(position, types[i % len(types)], light_color='red' if i % 5 == 0 else None)
+             for i, position in enumerate(rng.uniform(0, 1000, (500, 2)))]
+    marks += [nav.Mark(position, 'can', 'red', 'red', floating=True)
+              for position in rng.uniform(0, 1000, (100, 2))]
+    directory = tempfile.mkdtemp()
+    charts = 10
+    start = time.perf_counter()
+    for i in range(charts):
+        with SvgChartWriter(os.path.join(directory, f'chart_{i}.svg'), (0, 1000, 0, 1000)) as writer:
+            writer.add_marks(marks)
+    svg_time = (time.perf_counter() - start) / charts
+    svg_size = os.path.getsize(os.path.join(directory, 'chart_0.svg'))
+    start = time.perf_counter()
+    plt.figure()
+    for mark in marks:
+        mark.plot_mark()
+    plt.savefig(os.path.join(directory, 'chart.svg'))
+    plt.close()
+    matplotlib_time = time.perf_counter() - start
+    matplotlib_size = os.path.getsize(os.path.join(directory, 'chart.svg'))
+    print(f'{len(marks)} marks: svg writer {svg_time*1000:.0f} ms and {svg_size/1e3:.0f} kB per chart, '
+          f'matplotlib {matplotlib_time*1000:.0f} ms and {matplotlib_size/1e3:.0f} kB')
+
+
+if __name__ == "__main__":
+
+    main()
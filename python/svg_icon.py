@@ -0,0 +1,337 @@
+# %%
+""" Load the nautical chart symbols of svg_nautical_icon/ as matplotlib Path markers.
+
+The SVG files are parsed only once: the resulting paths are stored in a compact
+npz cache (float32 vertices, uint8 codes) next to the SVG files. The cache holds a
+signature of the SVG contents and is rebuilt when one of the files changes, so a
+normal start only reads the cache and never parses XML. """
+import os
+import re
+import hashlib
+import logging
+import math
+import numpy as np
+from matplotlib.path import Path
+
+SVG_DIRECTORY : str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'svg_nautical_icon')
+CACHE_NAME : str = '.svg_icon_cache.npz'
+CACHE_VERSION : int = 1
+
+_SVG_NAMESPACE = '{http://www.w3.org/2000/svg}'
+_TOKEN_RE = re.compile(r'[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_TRANSFORM_RE = re.compile(r'(\w+)\s*\(([^)]*)\)')
+_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+# number of parameters used by each path command
+_COMMAND_SIZE = {'m': 2, 'l': 2, 'h': 1, 'v': 1, 'c': 6, 's': 4, 'q': 4, 't': 2, 'a': 7, 'z': 0}
+
+
+def icon_name(file_name: str) -> str:
+    """ chsym-cardbuoy-N-c.svg -> cardbuoy_n_c """
+    stem = os.path.splitext(os.path.basename(file_name))[0].lower()
+    if stem.startswith('chsym-'):
+        stem = stem[len('chsym-'):]
+    return stem.replace('-', '_')
+
+
+def svg_files(directory: str = SVG_DIRECTORY) -> list[str]:
+    """ sorted list of the svg files of the directory """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith('.svg'))
+
+
+def svg_signature(files: list[str]) -> str:
+    """ hash of names and contents of the svg files, used to invalidate the cache """
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    for file in files:
+        digest.update(os.path.basename(file).encode())
+        with open(file, 'rb') as svg:
+            digest.update(svg.read())
+    return digest.hexdigest()
+
+
+def parse_transform(transform: str) -> np.ndarray:
+    """ convert a SVG transform attribute into a 3x3 affine matrix """
+    matrix = np.eye(3)
+    for name, args in _TRANSFORM_RE.findall(transform or ''):
+        values = [float(value) for value in _NUMBER_RE.findall(args)]
+        step = np.eye(3)
+        match name:
+            case 'matrix':
+                step[0, :] = [values[0], values[2], values[4]]
+                step[1, :] = [values[1], values[3], values[5]]
+            case 'translate':
+                step[0, 2] = values[0]
+                step[1, 2] = values[1] if len(values) > 1 else 0.0
+            case 'scale':
+                step[0, 0] = values[0]
+                step[1, 1] = values[1] if len(values) > 1 else values[0]
+            case 'rotate':
+                angle = math.radians(values[0])
+                rotation = np.array([[math.cos(angle), -math.sin(angle), 0],
+                                     [math.sin(angle), math.cos(angle), 0],
+                                     [0, 0, 1]])
+                if len(values) == 3:
+                    shift = np.array([[1, 0, values[1]], [0, 1, values[2]], [0, 0, 1]])
+                    unshift = np.array([[1, 0, -values[1]], [0, 1, -values[2]], [0, 0, 1]])
+                    rotation = shift @ rotation @ unshift
+                step = rotation
+            case 'skewX':
+                step[0, 1] = math.tan(math.radians(values[0]))
+            case 'skewY':
+                step[1, 0] = math.tan(math.radians(values[0]))
+            case _:
+                logging.warning('SVG transform %s is not supported', name)
+        matrix = matrix @ step
+    return matrix
+
+
+def arc_to_bezier(start, radius_x, radius_y, rotation, large_arc, sweep, end) -> list[tuple]:
+    """ convert a SVG elliptical arc into cubic bezier control points
+    (endpoint to center parametrization of the SVG specification) """
+    if radius_x == 0 or radius_y == 0 or start == end:
+        return [end, end, end]
+    radius_x, radius_y = abs(radius_x), abs(radius_y)
+    phi = math.radians(rotation)
+    cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+    dx, dy = (start[0] - end[0]) / 2, (start[1] - end[1]) / 2
+    x1p = cos_phi * dx + sin_phi * dy
+    y1p = -sin_phi * dx + cos_phi * dy
+    scale = (x1p / radius_x) ** 2 + (y1p / radius_y) ** 2
+    if scale > 1:
+        radius_x *= math.sqrt(scale)
+        radius_y *= math.sqrt(scale)
+    numerator = radius_x**2 * radius_y**2 - radius_x**2 * y1p**2 - radius_y**2 * x1p**2
+    denominator = radius_x**2 * y1p**2 + radius_y**2 * x1p**2
+    coef = math.sqrt(max(numerator, 0) / denominator)
+    if large_arc == sweep:
+        coef = -coef
+    cxp = coef * radius_x * y1p / radius_y
+    cyp = -coef * radius_y * x1p / radius_x
+    center_x = cos_phi * cxp - sin_phi * cyp + (start[0] + end[0]) / 2
+    center_y = sin_phi * cxp + cos_phi * cyp + (start[1] + end[1]) / 2
+    theta1 = math.atan2((y1p - cyp) / radius_y, (x1p - cxp) / radius_x)
+    theta2 = math.atan2((-y1p - cyp) / radius_y, (-x1p - cxp) / radius_x)
+    delta = theta2 - theta1
+    if sweep and delta < 0:
+        delta += 2 * math.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * math.pi
+    segments = max(1, math.ceil(abs(delta) / (math.pi / 2) - 1e-9))
+    step = delta / segments
+    k = 4 / 3 * math.tan(step / 4)
+
+    def ellipse_point(theta):
+        return (center_x + radius_x * math.cos(theta) * cos_phi - radius_y * math.sin(theta) * sin_phi,
+                center_y + radius_x * math.cos(theta) * sin_phi + radius_y * math.sin(theta) * cos_phi)
+
+    def ellipse_derivative(theta):
+        return (-radius_x * math.sin(theta) * cos_phi - radius_y * math.cos(theta) * sin_phi,
+                -radius_x * math.sin(theta) * sin_phi + radius_y * math.cos(theta) * cos_phi)
+
+    points = []
+    for i in range(segments):
+        theta_a = theta1 + i * step
+        theta_b = theta_a + step
+        point_a, point_b = ellipse_point(theta_a), ellipse_point(theta_b)
+        derivative_a, derivative_b = ellipse_derivative(theta_a), ellipse_derivative(theta_b)
+        points.append((point_a[0] + k * derivative_a[0], point_a[1] + k * derivative_a[1]))
+        points.append((point_b[0] - k * derivative_b[0], point_b[1] - k * derivative_b[1]))
+        points.append(point_b)
+    points[-1] = end
+    return points
+
+
+def parse_path_data(path_data: str) -> tuple[list, list]:
+    """ convert the d attribute of a SVG path into vertices and matplotlib codes """
+    tokens = _TOKEN_RE.findall(path_data)
+    vertices, codes = [], []
+    current = (0.0, 0.0)
+    subpath_start = (0.0, 0.0)
+    last_control = None
+    command = None
+    index = 0
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+            if command in 'zZ':
+                if codes:
+                    vertices.append(subpath_start)
+                    codes.append(Path.CLOSEPOLY)
+                current = subpath_start
+                last_control = None
+                continue
+        elif command is None or command in 'zZ':
+            logging.warning('unexpected value %s in SVG path data', tokens[index])
+            break
+        size = _COMMAND_SIZE[command.lower()]
+        values = [float(value) for value in tokens[index:index + size]]
+        index += size
+        relative = command.islower()
+        origin_x, origin_y = current if relative else (0.0, 0.0)
+        match command.lower():
+            case 'm':
+                current = (origin_x + values[0], origin_y + values[1])
+                subpath_start = current
+                vertices.append(current)
+                codes.append(Path.MOVETO)
+                # following pairs are implicit lineto
+                command = 'l' if relative else 'L'
+                last_control = None
+            case 'l':
+                current = (origin_x + values[0], origin_y + values[1])
+                vertices.append(current)
+                codes.append(Path.LINETO)
+                last_control = None
+            case 'h':
+                current = (origin_x + values[0], current[1])
+                vertices.append(current)
+                codes.append(Path.LINETO)
+                last_control = None
+            case 'v':
+                current = (current[0], origin_y + values[0])
+                vertices.append(current)
+                codes.append(Path.LINETO)
+                last_control = None
+            case 'c' | 's':
+                if command.lower() == 'c':
+                    control1 = (origin_x + values[0], origin_y + values[1])
+                    values = values[2:]
+                elif last_control is not None:
+                    control1 = (2 * current[0] - last_control[0], 2 * current[1] - last_control[1])
+                else:
+                    control1 = current
+                control2 = (origin_x + values[0], origin_y + values[1])
+                current = (origin_x + values[2], origin_y + values[3])
+                vertices.extend([control1, control2, current])
+                codes.extend([Path.CURVE4] * 3)
+                last_control = control2
+            case 'q' | 't':
+                if command.lower() == 'q':
+                    control = (origin_x + values[0], origin_y + values[1])
+                    values = values[2:]
+                elif last_control is not None:
+                    control = (2 * current[0] - last_control[0], 2 * current[1] - last_control[1])
+                else:
+                    control = current
+                current = (origin_x + values[0], origin_y + values[1])
+                vertices.extend([control, current])
+                codes.extend([Path.CURVE3] * 2)
+                last_control = control
+            case 'a':
+                end = (origin_x + values[5], origin_y + values[6])
+                points = arc_to_bezier(current, values[0], values[1], values[2],
+                                       bool(values[3]), bool(values[4]), end)
+                vertices.extend(points)
+                codes.extend([Path.CURVE4] * len(points))
+                current = end
+                last_control = None
+    return vertices, codes
+
+
+def parse_svg(file_name: str) -> Path:
+    """ parse all path and rect elements of a SVG file into one compound Path
+    centered on its bounding box, with y axis pointing up """
+    # xml is only needed when the cache is rebuilt
+    import xml.etree.ElementTree as ElementTree
+    root = ElementTree.parse(file_name).getroot()
+    all_vertices, all_codes = [], []
+
+    def walk(element, matrix):
+        tag = element.tag.replace(_SVG_NAMESPACE, '')
+        if tag in ('metadata', 'defs'):
+            return
+        matrix = matrix @ parse_transform(element.get('transform'))
+        match tag:
+            case 'path':
+                vertices, codes = parse_path_data(element.get('d', ''))
+            case 'rect':
+                x, y = float(element.get('x', 0)), float(element.get('y', 0))
+                width, height = float(element.get('width', 0)), float(element.get('height', 0))
+                vertices = [(x, y), (x + width, y), (x + width, y + height), (x, y + height), (x, y)]
+                codes = [Path.MOVETO, Path.LINETO, Path.LINETO, Path.LINETO, Path.CLOSEPOLY]
+            case _:
+                vertices, codes = [], []
+        if vertices:
+            points = np.column_stack([np.asarray(vertices), np.ones(len(vertices))]) @ matrix.T
+            all_vertices.append(points[:, :2])
+            all_codes.append(np.asarray(codes, dtype=np.uint8))
+        for child in element:
+            walk(child, matrix)
+
+    walk(root, np.eye(3))
+    if not all_vertices:
+        logging.warning('no drawable element in %s', file_name)
+        return Path(np.zeros((1, 2)), [Path.MOVETO])
+    vertices = np.concatenate(all_vertices)
+    codes = np.concatenate(all_codes)
+    vertices[:, 1] = -vertices[:, 1]
+    vertices -= (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+    return Path(vertices, codes)
+
+
+def build_cache(files: list[str], cache_file: str, signature: str) -> dict[str, Path]:
+    """ parse every svg file and save the paths in the cache file """
+    icons = {icon_name(file): parse_svg(file) for file in files}
+    names = list(icons)
+    lengths = [len(icons[name].vertices) for name in names]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    vertices = np.concatenate([icons[name].vertices for name in names]).astype(np.float32)
+    codes = np.concatenate([icons[name].codes for name in names]).astype(np.uint8)
+    try:
+        np.savez_compressed(cache_file, signature=np.array(signature), names=np.array(names),
+                            offsets=offsets, vertices=vertices, codes=codes)
+    except OSError as error:
+        logging.warning('svg icon cache %s not written: %s', cache_file, error)
+    return icons
+
+
+def read_cache(cache_file: str, signature: str) -> dict[str, Path] | None:
+    """ read the cache file, None when it is missing or out of date """
+    try:
+        with np.load(cache_file) as cache:
+            if str(cache['signature']) != signature:
+                return None
+            names = cache['names'].tolist()
+            offsets = cache['offsets']
+            vertices = cache['vertices'].astype(float)
+            codes = cache['codes']
+    except (OSError, KeyError, ValueError):
+        return None
+    return {name: Path(vertices[offsets[i]:offsets[i + 1]], codes[offsets[i]:offsets[i + 1]])
+            for i, name in enumerate(names)}
+
+
+def load_icons(directory: str = SVG_DIRECTORY, cache_file: str = None) -> dict[str, Path]:
+    """ return the svg icons as a dict name -> Path, from the cache when it is up to date """
+    files = svg_files(directory)
+    if not files:
+        return {}
+    if cache_file is None:
+        cache_file = os.path.join(directory, CACHE_NAME)
+    signature = svg_signature(files)
+    icons = read_cache(cache_file, signature)
+    if icons is None:
+        logging.info('building svg icon cache %s', cache_file)
+        icons = build_cache(files, cache_file, signature)
+    return icons
+
+
+def main():
+    import matplotlib.pyplot as plt
+    icons = load_icons()
+    plt.figure(1, figsize=(10, 5))
+    for i, (name, path) in enumerate(sorted(icons.items())):
+        plt.plot(i % 7, -(i // 7), marker=path, markersize=40, markerfacecolor='none',
+                 markeredgecolor='k', markeredgewidth=0.5, linestyle='None')
+        plt.text(i % 7, -(i // 7) - 0.45, name, horizontalalignment='center')
+    plt.axis('off')
+    plt.title('SVG nautical icons')
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -117,19 +117,19 @@ mark3.plot_mark()
 mark4.plot_mark()
 mark5.plot_mark()
 mark_table=[mark1, mark2, mark3, mark4, mark5]
+# LOP and error areas of all the boats drawn at once
+lop_batch = nav.LopBatch()
 
 for i in range(150,500,100):
     for j in range(150,500,100):
-        boat_simu = nav.BoatSimu([i, j], [i,j])
+        boat_simu = nav.BoatSimu([i, j], [i,j], lop_batch=lop_batch)
         for mark in mark_table:
             mark.compute_bearing(boat_simu.boat_true,sigma)
         markA, markB, markC = boat_simu.get_3best_marks(mark_table)
         boat_simu.compute_position_3lop(markA, markB, markC, True)
         boat_simu.plot_boat()
-        markA.plot_mark_bearing(boat_simu.boat_true)
-        markB.plot_mark_bearing(boat_simu.boat_true)
-        markC.plot_mark_bearing(boat_simu.boat_true)
         del boat_simu
+lop_batch.draw()
 
 plt.title("3 LOP position fix, with selection of three best marks based on estimate area")
 plt.show()
@@ -1,5 +1,6 @@
 # %%
 import cartopy.crs as ccrs
+import chart_store
 import matplotlib.pyplot as plt
 import nautical_marker as marker
 import navigation as nav
@@ -9,7 +10,7 @@ import pandas as pd
 
 # rade.png obtained from OpenSeaMap
 #img = plt.imread("../map/rade.png")
-img = plt.imread('rade2.png')
+img = chart_store.chart_image('rade2.png')
 
 # values for rade.png-3.3782, -3.33217, 47.715, 47.7309
 lat_min = -3.37706
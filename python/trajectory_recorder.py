@@ -0,0 +1,147 @@
+# %%
+""" Columnar recording of simulated trajectories.
+
+Each step of a BoatSimu (true and estimated positions, fix area, marks used by
+the fix, courses, ...) is appended to preallocated numpy column buffers.
+Without a file the buffers grow by doubling. With a file they have a fixed size
+and are flushed chunk by chunk to a directory holding one raw binary file per
+column and a meta.json (dtypes and number of rows), so memory stays constant
+however long the simulation is. load_trajectory memory maps the columns back. """
+import json
+import logging
+import os
+import numpy as np
+import navigation as nav
+
+META_FILE : str = 'meta.json'
+
+MAX_FIX_MARKS : int = 8
+
+COLUMNS : dict[str, str] = {
+    'time': 'f8',
+    'true_x': 'f8',
+    'true_y': 'f8',
+    'estimate_x': 'f8',
+    'estimate_y': 'f8',
+    'fix_area': 'f8',
+    'ground_course': 'f8',
+    'water_course': 'f8',
+    'ground_speed': 'f8',
+    'fix_type': 'i1',
+    # number of marks of the fix, the first MAX_FIX_MARKS are in the mark columns
+    'mark_count': 'i2',
+}
+
+_MARK_COLUMNS = tuple(f'mark_{i + 1}' for i in range(MAX_FIX_MARKS))
+# index of the marks of the fix in MarksMap.map_marks, -1 when unused or unknown
+COLUMNS.update((name, 'i4') for name in _MARK_COLUMNS)
+
+
+class TrajectoryRecorder:
+    """ record the steps of a BoatSimu in numpy column buffers,
+    streamed to directory when given """
+    def __init__(self, directory: str = None, marks_map: nav.MarksMap = None,
+                 chunk_size: int = 4096, start_time: float = 0.0):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.time = start_time
+        self.written = 0
+        self.size = 0
+        self._mark_index = {}
+        if marks_map is not None:
+            self._mark_index = {id(mark): i for i, mark in enumerate(marks_map.map_marks)}
+        self._buffers = {name: np.empty(chunk_size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for name in COLUMNS:
+                # truncate columns of a previous recording
+                open(self._column_file(name), 'wb').close()
+            self._write_meta()
+
+    def __len__(self) -> int:
+        return self.written + self.size
+
+    def _column_file(self, name: str) -> str:
+        return os.path.join(self.directory, name + '.bin')
+
+    def _write_meta(self) -> None:
+        meta = {'length': self.written, 'columns': COLUMNS}
+        with open(os.path.join(self.directory, META_FILE), 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
+
+    def _grow(self) -> None:
+        """ double the capacity of the in memory buffers """
+        for name, buffer in self._buffers.items():
+            grown = np.empty(2 * len(buffer), dtype=buffer.dtype)
+            grown[:len(buffer)] = buffer
+            self._buffers[name] = grown
+
+    def append(self, **values) -> None:
+        """ append one row, missing columns are set to nan (-1 for integer columns) """
+        if self.size == len(self._buffers['time']):
+            if self.directory is None:
+                self._grow()
+            else:
+                self.flush()
+        for name, buffer in self._buffers.items():
+            default = -1 if buffer.dtype.kind == 'i' else np.nan
+            buffer[self.size] = values.get(name, default)
+        self.size += 1
+
+    def record(self, boat_simu: nav.BoatSimu, duration: float, fix_type: nav.FixType) -> None:
+        """ record the state of boat_simu after a step of duration """
+        self.time += duration
+        marks = [self._mark_index.get(id(mark), -1) for mark in boat_simu.fix_marks]
+        if len(marks) > MAX_FIX_MARKS:
+            logging.warning('fix of %s marks at %s, only the first %s are recorded',
+                            len(marks), self.time, MAX_FIX_MARKS)
+        true, estimate = boat_simu.boat_true, boat_simu.boat_estimate
+        self.append(time=self.time,
+                    true_x=true.position[0], true_y=true.position[1],
+                    estimate_x=estimate.position[0], estimate_y=estimate.position[1],
+                    fix_area=np.nan if boat_simu.fix_area is None else boat_simu.fix_area,
+                    ground_course=true.ground_track.course, water_course=true.water_track.course,
+                    ground_speed=true.ground_track.speed, fix_type=fix_type.value,
+                    mark_count=len(marks), **dict(zip(_MARK_COLUMNS, marks)))
+
+    def flush(self) -> None:
+        """ write the buffered rows to the column files """
+        if self.directory is None or self.size == 0:
+            return
+        for name, buffer in self._buffers.items():
+            with open(self._column_file(name), 'ab') as file:
+                buffer[:self.size].tofile(file)
+        self.written += self.size
+        self.size = 0
+        self._write_meta()
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """ recorded columns, memory mapped from disk when streamed """
+        if self.directory is None:
+            return {name: buffer[:self.size] for name, buffer in self._buffers.items()}
+        self.flush()
+        return load_trajectory(self.directory)
+
+
+def load_trajectory(directory: str, mmap: bool = True) -> dict[str, np.ndarray]:
+    """ columns of a recorded trajectory, memory mapped (read only) by default """
+    with open(os.path.join(directory, META_FILE), encoding='utf-8') as file:
+        meta = json.load(file)
+    length = meta['length']
+    columns = {}
+    for name, dtype in meta['columns'].items():
+        file_name = os.path.join(directory, name + '.bin')
+        if mmap and length > 0:
+            columns[name] = np.memmap(file_name, dtype=dtype, mode='r', shape=(length,))
+        else:
+            columns[name] = np.fromfile(file_name, dtype=dtype, count=length)
+    return columns
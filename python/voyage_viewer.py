@@ -0,0 +1,141 @@
+# %%
+""" Playback of large recorded voyages (see trajectory_recorder).
+
+The true and estimated tracks are memory mapped and never plotted point by
+point: each track is a single line whose data is the min/max decimation of the
+samples visible in the current view. The decimation is computed again when the
+axes limits change, so zooming in refines the track. """
+import math
+import numpy as np
+import matplotlib.pyplot as plt
+import chart_store
+import trajectory_recorder
+
+TRACKS : dict[str, tuple[str, str, str]] = {
+    'true': ('true_x', 'true_y', 'g'),
+    'estimate': ('estimate_x', 'estimate_y', 'r'),
+}
+
+
+def decimate_minmax(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """ indices of the samples to keep so that at most about max_points remain:
+    the samples are split in consecutive buckets and the extreme samples (min and
+    max of x and y) of each bucket are kept, in their original order. nan samples
+    (an estimate before the first fix) are never extremes, a bucket of nan only
+    keeps no sample """
+    count = len(x)
+    if count <= max_points:
+        return np.arange(count)
+    buckets = max(1, max_points // 4)
+    size = math.ceil(count / buckets)
+    buckets = math.ceil(count / size)
+    pad = buckets * size - count
+    x_buckets = np.concatenate([x, np.full(pad, np.nan)]).reshape(buckets, size)
+    y_buckets = np.concatenate([y, np.full(pad, np.nan)]).reshape(buckets, size)
+    # nan are filled with the opposite extreme, and the extremes of the buckets of nan dropped
+    extremes = []
+    for values in (x_buckets, y_buckets):
+        missing = np.isnan(values)
+        empty = missing.all(axis=1)
+        for function, fill in ((np.argmin, np.inf), (np.argmax, -np.inf)):
+            extremes.append(np.where(empty, size, function(np.where(missing, fill, values), axis=1)))
+    extremes = np.column_stack(extremes)
+    extremes.sort(axis=1)
+    indices = (extremes + (np.arange(buckets) * size)[:, None]).ravel()
+    indices = indices[extremes.ravel() < size]
+    keep = np.ones(len(indices), dtype=bool)
+    keep[1:] = indices[1:] != indices[:-1]
+    return indices[keep]
+
+
+def visible_track(x: np.ndarray, y: np.ndarray, view: tuple[float, float, float, float],
+                  max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    """ decimated samples of the track inside view (x_min, x_max, y_min, y_max),
+    with nan breaks where the track leaves the view """
+    x_min, x_max, y_min, y_max = view
+    inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+    # keep the samples just before and after the view so that lines reach its border
+    visible = inside.copy()
+    visible[1:] |= inside[:-1]
+    visible[:-1] |= inside[1:]
+    indices = np.flatnonzero(visible)
+    if len(indices) == 0:
+        return np.empty(0), np.empty(0)
+    kept = indices[decimate_minmax(x[indices], y[indices], max_points)]
+    hidden_before = np.cumsum(~visible)
+    breaks = np.flatnonzero(hidden_before[kept[1:]] - hidden_before[kept[:-1]] > 0) + 1
+    track_x = np.insert(np.asarray(x[kept], dtype=float), breaks, np.nan)
+    track_y = np.insert(np.asarray(y[kept], dtype=float), breaks, np.nan)
+    return track_x, track_y
+
+
+class VoyageViewer:
+    """ Plot the true and estimated tracks of a recorded voyage, optionally over
+    a chart image, with one line artist per track refined on zoom """
+    def __init__(self, directory: str, chart_image: str = None, extent: tuple = None,
+                 max_points: int = 4000, ax=None):
+        self.columns = trajectory_recorder.load_trajectory(directory)
+        self.max_points = max_points
+        self.ax = ax if ax is not None else plt.gca()
+        if chart_image is not None:
+            self.ax.imshow(chart_store.chart_image(chart_image), origin='upper', extent=extent)
+        self.lines = {}
+        for name, (column_x, column_y, color) in TRACKS.items():
+            line, = self.ax.plot([], [], '-', color=color, linewidth=0.8, label=name)
+            self.lines[name] = line
+        self._view = None
+        self.refine(self.full_view() if extent is None else extent)
+        self.ax.set_xlim(self._view[0], self._view[1])
+        self.ax.set_ylim(self._view[2], self._view[3])
+        self.ax.callbacks.connect('xlim_changed', self._on_limits_changed)
+        self.ax.callbacks.connect('ylim_changed', self._on_limits_changed)
+
+    def full_view(self) -> tuple[float, float, float, float]:
+        """ bounding box of all the recorded positions """
+        x = [self.columns[column_x] for column_x, _, _ in TRACKS.values()]
+        y = [self.columns[column_y] for _, column_y, _ in TRACKS.values()]
+        if len(x[0]) == 0:
+            return (0.0, 1.0, 0.0, 1.0)
+        return (min(np.nanmin(values) for values in x), max(np.nanmax(values) for values in x),
+                min(np.nanmin(values) for values in y), max(np.nanmax(values) for values in y))
+
+    def refine(self, view: tuple[float, float, float, float]) -> None:
+        """ decimate the tracks for view (x_min, x_max, y_min, y_max) """
+        view = (min(view[0], view[1]), max(view[0], view[1]),
+                min(view[2], view[3]), max(view[2], view[3]))
+        if view == self._view:
+            return
+        self._view = view
+        for name, (column_x, column_y, _) in TRACKS.items():
+            track_x, track_y = visible_track(self.columns[column_x], self.columns[column_y],
+                                             view, self.max_points)
+            self.lines[name].set_data(track_x, track_y)
+
+    def _on_limits_changed(self, ax) -> None:
+        self.refine(ax.get_xlim() + ax.get_ylim())
+        ax.figure.canvas.draw_idle()
+
+
+def main():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    steps = 1_000_000
+    recorder = trajectory_recorder.TrajectoryRecorder(directory, chunk_size=100_000)
+    course = np.cumsum(rng.normal(0, 0.01, steps))
+    true_x = np.cumsum(np.sin(course))
+    true_y = np.cumsum(np.cos(course))
+    for i in range(steps):
+        recorder.append(time=i, true_x=true_x[i], true_y=true_y[i],
+                        estimate_x=true_x[i] + rng.normal(0, 2), estimate_y=true_y[i] + rng.normal(0, 2))
+    recorder.close()
+    plt.figure(1)
+    VoyageViewer(directory)
+    plt.legend()
+    plt.title(f'{steps} recorded steps')
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    main()